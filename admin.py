@@ -1,5 +1,9 @@
+import argparse
+import logging
+import queue
 import socket
 import threading
+import time
 import tkinter as tk
 from tkinter import messagebox, simpledialog
 import pyttsx3
@@ -8,11 +12,25 @@ from datetime import datetime, timedelta
 import json
 import os
 
+from compression import COMPRESS_OPTION
+from framing import FRAMED_OPTION, FramedSocket
+from tls import SessionCache, client_context
+
+# TLS sessions kept for reconnects to the same server, so they resume instead of a full handshake
+TLS_SESSIONS = SessionCache()
+
+# Receive pipeline: the network thread queues messages, the Tk loop drains them in batches
+DRAIN_INTERVAL_MS = 100      # How often the Tk loop moves queued messages into the text widget
+MAX_DRAIN_BATCH = 1000       # Messages inserted per drain; the rest wait for the next (immediate) pass
+MAX_SCROLLBACK_LINES = 5000  # Older lines are dropped from the message area
+NOTIFY_INTERVAL = 5.0        # Seconds between desktop notifications / spoken alerts; bursts are summarized
+
 class AdminClient:
-    def __init__(self, host='localhost', port=5555):
+    def __init__(self, host='localhost', port=5555, tls_context=None):
         self.host = host
         self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tls_context = tls_context
+        self.socket = FramedSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
         self.username = None
         self.dark_mode_enabled = False
         self.notification_sound_enabled = True
@@ -22,6 +40,14 @@ class AdminClient:
 
         self.engine = pyttsx3.init()
 
+        self.incoming = queue.SimpleQueue()  # Messages from the receive thread, shown by drain_messages()
+        self.send_lock = threading.Lock()    # The receive thread answers heartbeats while the UI sends commands
+        self.unnotified = 0                  # Messages received since the last notification
+        self.latest = None                   # Newest of those, quoted in the notification
+        self.last_notified = 0.0
+        self.alerts = queue.SimpleQueue()    # Notification summaries for the alert thread
+        self.alert_busy = threading.Event()  # Set while a notification or speech is still in progress
+
         # Set up the login window
         self.root = tk.Tk()
         self.root.title("Admin Login - Chat Messenger App")
@@ -44,11 +70,18 @@ class AdminClient:
         password = self.password_entry.get()
 
         try:
-            self.socket.connect((self.host, self.port))
+            if self.tls_context:
+                self.socket = FramedSocket(TLS_SESSIONS.connect(self.tls_context, (self.host, self.port)))
+            else:
+                self.socket.connect((self.host, self.port))
             print("Connected to server.")
 
-            # Send admin choice
-            self.socket.send("admin".encode('utf-8'))
+            # Read the login/register/admin prompt, then send admin choice and ask for framed, compressed messages
+            self.receive_prompt()
+            if self.tls_context:
+                TLS_SESSIONS.save((self.host, self.port), self.socket.sock)  # The session ticket has arrived by now
+            self.socket.send(f"admin {FRAMED_OPTION} {COMPRESS_OPTION}".encode('utf-8'))
+            self.socket.enable_framing()
 
             # Send username
             self.socket.recv(1024)  # Receive username prompt
@@ -60,7 +93,7 @@ class AdminClient:
 
             # Check authentication result
             result = self.socket.recv(1024).decode('utf-8')
-            if "failed" in result.lower():
+            if "successful" not in result.lower():
                 messagebox.showerror("Error", "Authentication failed.")
                 self.root.quit()
             else:
@@ -71,6 +104,16 @@ class AdminClient:
             messagebox.showerror("Error", f"Connection error: {e}")
             self.root.quit()
 
+    def receive_prompt(self):
+        """Read the unframed greeting in full so no raw bytes are left when framing starts."""
+        prompt = b""
+        while not prompt.endswith(b": "):
+            chunk = self.socket.recv(1024)
+            if not chunk:
+                raise ConnectionError("Connection closed by the server.")
+            prompt += chunk
+        return prompt.decode('utf-8')
+
     def start_admin_interface(self):
         self.speak_welcome()
         self.create_admin_window()
@@ -116,6 +159,7 @@ class AdminClient:
             ("Broadcast to Room", "broadcast_room"),
             ("Send Message", "send_message"),
             ("Personal Message", "personal_message"),
+            ("Search Messages", "search"),
             ("Exit", "exit")  # Add the Exit option
         ]
 
@@ -141,11 +185,13 @@ class AdminClient:
         self.send_button = tk.Button(self.input_frame, text="Send", command=self.send_input)
         self.send_button.pack(side=tk.RIGHT, padx=10)
 
-        # Start thread for receiving messages
+        # Start threads for receiving messages and for notifications, which block while speaking
         receive_thread = threading.Thread(target=self.receive_messages)
         receive_thread.daemon = True
         receive_thread.start()
+        threading.Thread(target=self.run_alerts, daemon=True).start()
 
+        self.admin_window.after(DRAIN_INTERVAL_MS, self.drain_messages)
         self.admin_window.mainloop()
 
     def toggle_dark_mode(self):
@@ -199,6 +245,8 @@ class AdminClient:
             self.focus_input()
         elif selection == "personal_message":
             self.personal_message()
+        elif selection == "search":
+            self.search_messages()
         elif selection == "exit":  # Handle the Exit selection
             self.exit_application()
 
@@ -255,6 +303,12 @@ class AdminClient:
     def list_rooms(self):
         self.send_message("/list_rooms")
 
+    def search_messages(self):
+        query = simpledialog.askstring("Search Messages", "Words to find, optionally with filters such as\n"
+                                       "user:<name> room:<room> to:<name> since:2h until:2024-05-01 limit:50")
+        if query:
+            self.send_message(f"/search {query}")
+
     def broadcast_to_room(self):
         room_name = simpledialog.askstring("Broadcast to Room", "Enter room name:")
         if room_name:
@@ -294,34 +348,93 @@ class AdminClient:
 
     def send_message(self, message):
         try:
-            self.socket.send(message.encode('utf-8'))
+            with self.send_lock:
+                self.socket.send(message.encode('utf-8'))
         except Exception as e:
             messagebox.showerror("Error", f"Error sending message: {e}")
 
     # Receiving messages and notifications
     def receive_messages(self):
+        """Network thread: never touches Tk, only queues messages for drain_messages()."""
         while True:
             try:
                 message = self.socket.recv(1024).decode('utf-8')
-                if message:
-                    self.message_text.insert(tk.END, message + "\n")
-                    self.message_text.see(tk.END)
-                    self.show_desktop_notification(message)
+                if message == "PING":
+                    with self.send_lock:
+                        self.socket.send("/pong".encode('utf-8'))  # Server heartbeat; answer it without showing it
+                elif message:
+                    self.incoming.put(message)
                 else:
-                    messagebox.showinfo("Info", "Connection closed by the server.")
+                    self.incoming.put(("info", "Connection closed by the server."))
                     break
             except Exception as e:
-                messagebox.showerror("Error", f"Error receiving message: {e}")
+                self.incoming.put(("error", f"Error receiving message: {e}"))
                 break
 
-    def show_desktop_notification(self, message):
+    def drain_messages(self):
+        """Tk timer: insert everything queued since the last run with one widget update."""
+        lines = []
+        status = None
+        while len(lines) < MAX_DRAIN_BATCH:
+            try:
+                item = self.incoming.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple):
+                status = item
+                break
+            lines.append(item)
+        if lines:
+            self.message_text.insert(tk.END, "\n".join(lines) + "\n")
+            self.trim_scrollback()
+            self.message_text.see(tk.END)
+            self.unnotified += len(lines)
+            self.latest = lines[-1]
+        self.notify_pending()
+        if status:
+            kind, text = status
+            (messagebox.showinfo if kind == "info" else messagebox.showerror)(kind.capitalize(), text)
+            return
+        # Come straight back if the batch limit left messages behind
+        self.admin_window.after(DRAIN_INTERVAL_MS if len(lines) < MAX_DRAIN_BATCH else 1, self.drain_messages)
+
+    def trim_scrollback(self):
+        lines = int(self.message_text.index('end-1c').split('.')[0])
+        if lines > MAX_SCROLLBACK_LINES:
+            self.message_text.delete('1.0', f"{lines - MAX_SCROLLBACK_LINES + 1}.0")
+
+    def notify_pending(self):
+        """At most one alert per NOTIFY_INTERVAL; a burst in between becomes a single summary."""
+        if not self.unnotified or self.alert_busy.is_set():
+            return
+        now = time.monotonic()
+        if now - self.last_notified < NOTIFY_INTERVAL:
+            return
+        self.last_notified = now
+        self.alert_busy.set()
+        self.alerts.put((self.unnotified, self.latest))
+        self.unnotified = 0
+        self.latest = None
+
+    def run_alerts(self):
+        """Alert thread: notifications and speech block, so they run here rather than on the Tk loop."""
+        while True:
+            count, latest = self.alerts.get()
+            try:
+                self.show_desktop_notification(count, latest)
+            except Exception as e:
+                logging.warning(f"Notification failed: {e}")
+            finally:
+                self.alert_busy.clear()
+
+    def show_desktop_notification(self, count, message):
         notification.notify(
-            title="New Message",
+            title="New Message" if count == 1 else f"{count} New Messages",
             message=message,
             timeout=self.notification_timeout
         )
         if self.notification_sound_enabled:
-            self.engine.say("You have a new message.")
+            self.engine.say("You have a new message." if count == 1 else f"You have {count} new messages.")
             self.engine.runAndWait()
 
     def exit_application(self):
@@ -340,5 +453,11 @@ class AdminClient:
         self.root.mainloop()
 
 if __name__ == "__main__":
-    admin = AdminClient()
+    parser = argparse.ArgumentParser(description="Chat Messenger App admin console")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--tls", action="store_true", help="connect with TLS")
+    parser.add_argument("--tls-ca", help="CA certificate to verify the server with (default: system CAs)")
+    args = parser.parse_args()
+    admin = AdminClient(args.host, args.port, client_context(args.tls_ca) if args.tls else None)
     admin.start()
@@ -0,0 +1,573 @@
+import asyncio
+import base64
+import logging
+import os
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_server import ADMIN, SHUTDOWN_NOTICE, USER, ChatServer
+from db import DatabaseError
+from compression import inflate
+from framing import HEADER, MAX_FRAME_SIZE, frame_length, frame_parts
+from handoff import MAX_UNREAD_BYTES, send_message
+from logging_setup import stop_logging
+from outbound import BACKPRESSURE, CORK, OutboundQueue, configure_tcp, set_cork
+from session import Session
+
+
+class StreamConnection:
+    """Socket-like wrapper around an asyncio stream pair.
+
+    The synchronous ChatServer helpers only ever call send() and close() on a
+    client, so they work unchanged on the event loop; reads are awaited. In
+    framed mode frames are cut straight out of the StreamReader's buffer.
+    send() only queues the payload; a writer task drains the queue, handing
+    everything queued during a loop tick to the transport in one write (one
+    write per message on raw connections, which have no delimiter). The
+    task only exists while there is something to write, so an idle client
+    is just this object, its streams and its Session.
+    """
+    __slots__ = ('reader', 'writer', 'framed', 'compressor', 'queue', 'congested', 'drained', 'writer_task',
+                 'metrics', 'cork', 'session', 'reading', 'partial')
+
+    def __init__(self, reader, writer, queue, congested, metrics=None, cork=False):
+        self.reader = reader
+        self.writer = writer
+        self.metrics = metrics
+        self.cork = cork
+        self.session = None
+        self.framed = False
+        self.compressor = None  # Set when the client accepts compressed frames
+        self.queue = queue
+        self.congested = congested  # Server-wide set of clients whose senders must wait
+        self.drained = None  # Created the first time this client falls behind under the backpressure policy
+        self.writer_task = None
+        self.reading = False  # Parked in recv(), i.e. between messages; only then can the client be handed over
+        self.partial = None   # Frame header already taken from the reader while its payload is awaited
+        queue.on_ready = self.wake_writer
+
+    def enable_framing(self):
+        self.framed = True
+
+    def enable_compression(self, compressor):
+        self.compressor = compressor
+
+    def send(self, data, block=False):
+        # Never blocks the loop; senders that should wait for room await relieve_backpressure() instead
+        if not self.queue.put(data, block=False) and not self.queue.closed:
+            logging.warning(f"Disconnecting slow client: {len(self.queue)} messages "
+                            f"({self.queue.nbytes} bytes) waiting to be sent")
+            if self.metrics:
+                self.metrics.inc('connections.evicted.slow')
+            self.abort()
+        elif self.queue.policy == BACKPRESSURE and self.queue.full():
+            if self.drained is None:
+                self.drained = asyncio.Event()
+            self.drained.clear()
+            self.congested.add(self)
+        return len(data)
+
+    def wake_writer(self):
+        if self.writer_task is None:
+            self.writer_task = asyncio.get_running_loop().create_task(self.run_writer())
+
+    async def run_writer(self):
+        """Write until the queue is empty, then exit; the next send() starts a new task."""
+        queue = self.queue
+        idle = False
+        try:
+            while True:
+                if queue.flush_delay and queue.nbytes < queue.flush_bytes and not queue.closed:
+                    await asyncio.sleep(queue.flush_delay)
+                items = queue.pop_all()
+                if items and not self.framed:
+                    for data in items:  # Separate writes, or a legacy client reads them as one line
+                        self.writer.write(data)
+                elif items:
+                    sock = self.writer.get_extra_info('socket') if self.cork else None
+                    if sock:
+                        set_cork(sock, True)
+                    self.writer.writelines(frame_parts(items, self.compressor))
+                    if sock:
+                        set_cork(sock, False)
+                if self.metrics and items:
+                    self.metrics.inc('writes.batches', 1 if self.framed else len(items))
+                    self.metrics.inc('messages.out', len(items))
+                    self.metrics.inc('bytes.out', sum(len(data) for data in items))
+                if self.drained:
+                    self.drained.set()
+                if queue.closed:
+                    break
+                await self.writer.drain()
+                if not queue.items and not queue.closed:
+                    idle = True
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            if idle:
+                self.writer_task = None
+            else:
+                self.writer.close()
+
+    async def recv(self, bufsize):
+        self.reading = True
+        try:
+            if not self.framed:
+                return await self.reader.read(bufsize)
+            header = self.partial = await self.reader.readexactly(HEADER.size)
+            length, compressed = frame_length(HEADER.unpack(header)[0])
+            payload = await self.reader.readexactly(length)
+            self.partial = None
+            return inflate(payload, MAX_FRAME_SIZE) if compressed else payload
+        except asyncio.IncompleteReadError:
+            return b''
+        finally:
+            self.reading = False
+
+    def unread_input(self):
+        """Bytes received from the client but not yet returned by recv(), for handing the connection over."""
+        # StreamReader has no public way to peek at its buffer
+        return (self.partial or b'') + bytes(self.reader._buffer)
+
+    def abort(self):
+        self.queue.pop_all()
+        self.queue.close()
+        self.writer.transport.abort()
+
+    def hangup(self):
+        """End the session from the server side: recv() returns b'' and queued messages still go out."""
+        self.writer.transport.pause_reading()
+        self.reader.feed_eof()
+
+    def close(self, flush=True):
+        """Let the writer task flush what is queued, then close the stream (always flushes, unlike QueuedSocket)."""
+        self.queue.close()
+
+
+def raise_fd_limit():
+    """Lift the soft open-file limit to the hard limit so one process can hold 10k+ sockets."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            logging.info(f"Raised open file limit from {soft} to {hard}")
+        except (ValueError, OSError) as e:
+            logging.warning(f"Could not raise open file limit: {e}")
+
+
+class AsyncChatServer(ChatServer):
+    """ChatServer variant that serves every client from a single asyncio event loop.
+
+    Idle clients cost one StreamReader/StreamWriter pair instead of an OS thread.
+    Blocking database calls run on a worker pool sized to the connection pool.
+    On a hot restart, logged-in clients that are between messages are passed
+    to the new process with their session state instead of disconnected.
+    """
+
+    adopts_clients = True
+
+    def __init__(self, host='0.0.0.0', port=5555, backlog=1024, **kwargs):
+        super().__init__(host, port, backlog=backlog, **kwargs)
+        # One worker per pooled connection, so concurrent logins query in parallel
+        self.db_executor = ThreadPoolExecutor(max_workers=self.db.pool.size, thread_name_prefix="db")
+        self.loop = None
+        self.stop_requested = None  # asyncio.Event mirroring `stopping` on the loop
+        self.congested = set()  # Clients over their queue limit under the backpressure policy
+
+    def start(self):
+        raise_fd_limit()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.stop_requested = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.bind()
+        self.server_socket.setblocking(False)
+        handshake_timeout = (self.monitor.login_timeout or None) if self.tls_context else None
+        server = await asyncio.start_server(self.handle_client, sock=self.server_socket, backlog=self.backlog,
+                                            ssl=self.tls_context, ssl_handshake_timeout=handshake_timeout)
+        logging.info("Async server accepting connections")
+        adopted, self.adopted = self.adopted, []
+        for state, sock in adopted:
+            self.loop.create_task(self.adopt(state, sock))
+
+        if not self.stopping.is_set():
+            await self.stop_requested.wait()
+        started = time.monotonic()
+        successor = self.successor
+        handed_over = 0
+        if successor:
+            send_message(successor, {'type': 'listener'}, [self.server_socket.fileno()])
+        server.close()  # Stops accepting; open connections are left alone
+        if successor:
+            if self.successor_adopts:
+                handed_over = await self.hand_over_clients(successor)
+            send_message(successor, {'type': 'handed_over'})  # It starts serving while we drain the rest
+        closed = await self.drain_async()
+        await self.run_db(self.persist_state)
+        if successor:
+            send_message(successor, {'type': 'done'})
+            successor.close()
+        elif self.handoff:
+            self.handoff.close()
+        logging.info(f"Server stopped in {time.monotonic() - started:.1f}s: {closed} connections closed"
+                     + (f", listening socket and {handed_over} connections handed over" if successor else ""))
+        if handed_over:
+            # Exit without unwinding: cleanup would close the connections that now belong to the new process
+            stop_logging()
+            os._exit(0)
+
+    async def drain_async(self):
+        sessions = list(self.sessions)
+        for session in sessions:
+            if not session.closed:
+                session.conn.send(SHUTDOWN_NOTICE.encode('utf-8'))
+            session.conn.hangup()
+        deadline = time.monotonic() + self.drain_timeout
+        while self.sessions and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for session in list(self.sessions):
+            session.conn.abort()
+        await asyncio.sleep(0)  # Let the aborted connections' handlers finish
+        return len(sessions)
+
+    async def hand_over_clients(self, successor):
+        """Pass every connection that is idle between messages to the successor and return how many went.
+
+        Reading stops first, so whatever a client sends from here on waits in
+        the kernel and is read by the new process. A connection goes over
+        with its session state and any input already buffered here once its
+        output is flushed, and is then forgotten here without the usual
+        cleanup: its user is still online, in the new process. Clients in the
+        middle of logging in, a command, a file transfer or a TLS session
+        stay behind and are drained with the rest.
+        """
+        for session in self.sessions:
+            session.conn.writer.transport.pause_reading()
+        movable = [session for session in self.sessions if self.can_hand_over(session)]
+        deadline = time.monotonic() + self.drain_timeout
+        while time.monotonic() < deadline and not all(self.flushed(session.conn) for session in movable):
+            await asyncio.sleep(0.05)
+
+        # No awaits from here on: nothing may reach these connections once their state has been taken
+        handed_over = 0
+        for session in movable:
+            conn = session.conn
+            if session.closed or not self.can_hand_over(session) or not self.flushed(conn):
+                continue
+            unread = conn.unread_input()
+            if len(unread) > MAX_UNREAD_BYTES:
+                continue
+            username = session.username
+            state = {'username': username, 'framed': conn.framed, 'compress': conn.compressor is not None,
+                     'role': session.role, 'rooms': self.rooms.rooms_of(username),
+                     'active': self.rooms.active_room(username), 'unread': base64.b64encode(unread).decode('ascii'),
+                     'messages_in': session.messages_in, 'bytes_in': session.bytes_in}
+            send_message(successor, {'type': 'client', 'state': state},
+                         [conn.writer.get_extra_info('socket').fileno()])
+            self.monitor.stop(session)
+            self.sessions.discard(session)
+            self.clients.pop(username)
+            handed_over += 1
+        return handed_over
+
+    def can_hand_over(self, session):
+        conn = session.conn
+        return (session.authenticated and conn.reading and not session.closed
+                and conn.writer.get_extra_info('ssl_object') is None)
+
+    def flushed(self, conn):
+        return (not conn.queue.items and conn.writer_task is None
+                and conn.writer.transport.get_write_buffer_size() == 0)
+
+    async def adopt(self, state, sock):
+        """Serve a connection handed over by the previous server process, as if it had just logged in."""
+        reader = asyncio.StreamReader()
+        reader.feed_data(base64.b64decode(state['unread']))  # Before the transport can add anything after it
+        try:
+            transport, protocol = await self.loop.connect_accepted_socket(
+                lambda: asyncio.StreamReaderProtocol(reader), sock)
+        except OSError as e:
+            logging.warning(f"Could not adopt the connection of {state['username']}: {e}")
+            sock.close()
+            return
+        writer = asyncio.StreamWriter(transport, protocol, reader, self.loop)
+        await self.handle_client(reader, writer, adopted=state)
+
+    def restore_client(self, client_socket, state):
+        username = state['username']
+        if state['framed']:
+            client_socket.enable_framing()
+            if state['compress'] and self.compressor:
+                client_socket.enable_compression(self.compressor)
+        client_socket.session.role = state['role']
+        self.rooms.restore(username, state['rooms'], state['active'])
+        client_socket.session.messages_in = state['messages_in']
+        client_socket.session.bytes_in = state['bytes_in']
+        self.metrics.inc('connections.adopted')
+        return username
+
+    def stop(self, successor=None, adopt_clients=False):
+        super().stop(successor, adopt_clients)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_requested.set)  # From a signal handler or the handoff thread
+
+    def call_soon(self, func, *args):
+        # Client streams may only be touched from the loop (before it starts there are no clients to touch)
+        if self.loop is None:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    async def run_db(self, func, *args):
+        return await self.loop.run_in_executor(self.db_executor, func, *args)
+
+    async def relieve_backpressure(self):
+        """Hold the current sender until congested recipients drain, dropping those that don't."""
+        while self.congested:
+            conn = self.congested.pop()
+            try:
+                await asyncio.wait_for(conn.drained.wait(), self.backpressure_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Disconnecting slow client: no progress for {self.backpressure_timeout}s")
+                conn.abort()
+
+    async def handle_client(self, reader, writer, adopted=None):
+        peer = writer.get_extra_info('peername')
+        configure_tcp(writer.get_extra_info('socket'), self.tcp_mode)
+        if self.tls_context and not adopted:
+            self.tls_established(writer.get_extra_info('ssl_object'))  # asyncio has finished the handshake
+        queue = OutboundQueue(self.queue_size, self.slow_consumer_policy, self.backpressure_timeout,
+                              self.write_delay, self.write_batch_bytes, self.max_outbound_bytes, self.outbound_grace)
+        client_socket = StreamConnection(reader, writer, queue, self.congested, self.metrics, self.tcp_mode == CORK)
+        session = client_socket.session = Session(client_socket, peer[0], self.message_limits.bucket(),
+                                                  self.command_limits.bucket())
+        self.sessions.add(session)
+        self.monitor.watch(session)
+        self.metrics.inc('connections.accepted')
+        logging.info("New connection from %s", peer)
+        username = None
+        try:
+            if adopted:
+                username = self.restore_client(client_socket, adopted)
+            else:
+                with self.metrics.timer('auth.handshake'):
+                    username = await self.authenticate(client_socket, peer[0])
+            if not username:
+                logging.info(f"Authentication failed for a client")
+                return
+
+            logging.info("User %s %s", username, "carried over from the previous process" if adopted
+                         else "authenticated successfully")
+            session.username = username
+            self.monitor.logged_in(session)
+            self.add_client(username, client_socket, announce=not adopted)
+
+            while True:
+                try:
+                    data = await client_socket.recv(1024)
+                    session.received(len(data))
+                    self.metrics.inc('bytes.in', len(data))
+                    message = data.decode('utf-8')
+                    if message:
+                        self.metrics.inc('messages.in')
+                        if self.message_log.allow():
+                            logging.debug("Received message from %s: %s", username, self.loggable(message))
+                        if not self.within_rate(session, message):
+                            continue
+                        if message.startswith('/'):
+                            await self.handle_command(message, username, client_socket)
+                        else:
+                            self.handle_chat(message, username)
+                        await self.relieve_backpressure()
+                    else:
+                        logging.info(f"Empty message received from {username}, closing connection")
+                        break
+                except Exception as e:
+                    logging.error(f"Error processing message from {username}: {str(e)}")
+                    break
+        except ConnectionError as e:
+            logging.error(f"Socket error with client {username}: {str(e)}")
+        except Exception as e:
+            logging.error(f"Unexpected error with client {username}: {str(e)}", exc_info=True)
+        finally:
+            self.monitor.stop(session)
+            if username:
+                logging.info("Session of %s ended: %s", username, session.summary())
+            self.remove_client(username)
+            client_socket.close()  # Still open if authentication failed
+            self.sessions.discard(session)
+            self.metrics.inc('connections.closed')
+
+    async def authenticate(self, client_socket, address):
+        try:
+            choice, options = self.parse_choice(
+                await self.prompt(client_socket, "Do you want to login, register, or admin? (login/register/admin): "))
+            logging.debug("Authentication choice: %s", choice)
+            self.negotiate(client_socket, options)
+
+            if choice == 'file':
+                await self.handle_file_channel(client_socket, options)
+                return None
+
+            if choice not in ('register', 'login', 'admin'):
+                logging.warning(f"Invalid authentication choice: {choice}")
+                client_socket.send("Invalid choice. Connection closed.".encode('utf-8'))
+                return None
+
+            if not self.admit_login(client_socket, address):
+                return None
+            if choice == 'register':
+                return await self.register_user(client_socket)
+            elif choice == 'login':
+                return await self.handle_login(client_socket)
+            else:
+                return await self.handle_admin_login(client_socket)
+        except ConnectionError as e:
+            logging.info(f"Client left during authentication: {e}")
+            return None
+        except Exception as e:
+            logging.error(f"Error during authentication: {e}")
+            return None
+
+    async def handle_file_channel(self, client_socket, options):
+        transfer = self.files.claim(options[0]) if options else None
+        if transfer is None and options and self.bus:
+            await asyncio.sleep(0.2)
+            transfer = self.files.claim(options[0])
+        if transfer is None:
+            client_socket.send("Invalid or expired transfer token.".encode('utf-8'))
+            return
+        self.monitor.stop(client_socket.session)  # Transfers may legitimately take longer than a login
+        if transfer.kind == 'download':
+            with self.metrics.timer('files.download'):
+                sent = await self.files.send_download_async(transfer, self.loop, client_socket.writer)
+            self.metrics.inc('files.bytes_out', sent)
+        else:
+            client_socket.send("READY".encode('utf-8'))
+            with self.metrics.timer('files.upload'):
+                result = await self.files.receive_upload_async(transfer, self.loop, client_socket.reader)
+            self.upload_finished(transfer, result, client_socket)
+
+    async def prompt(self, client_socket, text):
+        client_socket.send(text.encode('utf-8'))
+        data = await client_socket.recv(1024)
+        if not data:
+            raise ConnectionError("Connection closed during login")
+        return data.decode('utf-8').strip()
+
+    async def register_user(self, client_socket):
+        try:
+            username = await self.prompt(client_socket, "Enter username: ")
+            password = await self.prompt(client_socket, "Enter password: ")
+
+            if not self.enter_verification(client_socket):
+                return None
+            try:
+                with self.metrics.timer('auth.verify'):
+                    await self.run_db(self.create_user, username, await self.credentials.hash_async(password))
+            finally:
+                self.admission.leave()
+            client_socket.session.role = USER
+            logging.info(f"New user registered: {username}")
+            return username
+        except DatabaseError as err:
+            logging.error(f"Database error during registration: {err}")
+            client_socket.send("Registration failed. Please try again.".encode('utf-8'))
+            return None
+
+    async def handle_login(self, client_socket):
+        try:
+            username = await self.prompt(client_socket, "Enter username: ")
+            password = await self.prompt(client_socket, "Enter password: ")
+
+            if self.login_limited('user', username, client_socket):
+                return None
+
+            if not self.enter_verification(client_socket):
+                return None
+            # Cache hits are answered on the loop without a trip to the DB workers
+            try:
+                with self.metrics.timer('auth.verify'):
+                    user = (self.auth_cache.lookup(USER, username, password)
+                            or await self.check_password(USER, username, password))
+            finally:
+                self.admission.leave()
+
+            if user:
+                if username in self.sanctions.banned:
+                    client_socket.send("You are banned from this server.".encode('utf-8'))
+                    logging.info(f"Banned user {username} attempted to log in")
+                    return None
+                client_socket.session.role = USER
+                logging.info(f"User {username} authenticated successfully")
+                client_socket.send("Login successful".encode('utf-8'))
+                return username
+            else:
+                client_socket.send("Invalid credentials. Try again.".encode('utf-8'))
+                logging.info(f"Invalid credentials for user {username}")
+                return None
+        except DatabaseError as err:
+            logging.error(f"Database error during login: {err}")
+            client_socket.send("Login failed. Please try again.".encode('utf-8'))
+            return None
+
+    async def handle_admin_login(self, client_socket):
+        try:
+            username = await self.prompt(client_socket, "Enter admin username: ")
+            password = await self.prompt(client_socket, "Enter admin password: ")
+
+            if self.login_limited('admin', username, client_socket):
+                return None
+
+            if not self.enter_verification(client_socket):
+                return None
+            try:
+                with self.metrics.timer('auth.verify'):
+                    admin = (self.auth_cache.lookup(ADMIN, username, password)
+                             or await self.check_password(ADMIN, username, password))
+            finally:
+                self.admission.leave()
+
+            if admin:
+                client_socket.session.role = ADMIN
+                logging.info(f"Admin {username} authenticated successfully")
+                client_socket.send("Admin login successful ".encode('utf-8'))
+                return username
+            else:
+                client_socket.send("Invalid admin credentials. Try again.".encode('utf-8'))
+                logging.info(f"Invalid admin credentials for {username}")
+                return None
+        except DatabaseError as err:
+            logging.error(f"Database error during admin login: {err}")
+            client_socket.send("Admin login failed. Please try again.".encode('utf-8'))
+            return None
+
+    async def check_password(self, kind, username, password):
+        stored = await self.run_db(self.load_password, kind, username)
+        matches, upgrade = await self.credentials.verify_async(password, stored)
+        if matches:
+            if upgrade:
+                await self.run_db(self.store_password, kind, username, await self.credentials.hash_async(password))
+            self.auth_cache.store(kind, username, password)
+        return matches
+
+    async def handle_command(self, message, username, client_socket):
+        parts = message.split()
+        # A room's first history read goes to the database; keep that off the loop
+        if (parts[0] == "/history" and len(parts) > 1 and self.has_history(parts[1])
+                and not self.history.is_warm(parts[1])):
+            await self.run_db(self.history.load, parts[1])
+        # /profile stop joins the sampler thread; don't hold the loop while it finishes its sleep
+        if parts[0] == "/profile" and parts[1:2] == ["stop"] and client_socket.session.role == ADMIN:
+            await self.loop.run_in_executor(None, self.profiler.stop)
+        # Index lookups fault in mmapped segments and can match many messages; search and format off the loop
+        if parts[0] == "/search" and client_socket.session.role == ADMIN:
+            with self.metrics.timer("command./search"):
+                reply = await self.loop.run_in_executor(None, self.search_reply, parts[0], parts[1:])
+            client_socket.send(reply.encode('utf-8'))
+            return
+        # The command helpers only queue writes on the stream, so they can run inline on the loop
+        super().handle_command(message, username, client_socket)
@@ -0,0 +1,68 @@
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+
+class AuthCache:
+    """In-process cache of recently verified logins with TTL and LRU eviction.
+
+    Entries hold an HMAC of the password under a per-process key, never the
+    password itself, keyed by ('user' | 'admin', username). Only successful
+    logins are cached, so a wrong password always goes to the database.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = os.urandom(32)
+        self.entries = collections.OrderedDict()  # (kind, username) -> (digest, expires_at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(self, password):
+        return hmac.new(self.key, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def lookup(self, kind, username, password):
+        """Return True if this login was verified within the TTL."""
+        key = (kind, username)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now and hmac.compare_digest(entry[0], self.digest(password)):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            if entry and entry[1] <= now:
+                del self.entries[key]
+            self.misses += 1
+            return False
+
+    def store(self, kind, username, password):
+        with self.lock:
+            key = (kind, username)
+            self.entries[key] = (self.digest(password), time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(('user', username), None)
+            self.entries.pop(('admin', username), None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from async_server import raise_fd_limit
+from framing import FRAMED_OPTION, HEADER
+
+# Chat lines sent by simulated clients: "bench <client> <seq> <sent_ns>"
+BENCH_PREFIX = "bench"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_bytes(pid):
+    """Resident set size of a process, from /proc (Linux only)."""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError(f"No VmRSS for process {pid}")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+class SimClient:
+    """One simulated user speaking the framed protocol."""
+
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.index = index
+        self.username = f"bench{index}"
+        self.reader = None
+        self.writer = None
+
+    async def recv_raw_prompt(self):
+        prompt = b""
+        while not prompt.endswith(b": "):
+            chunk = await self.reader.read(1024)
+            if not chunk:
+                raise ConnectionError("Server closed the connection during login")
+            prompt += chunk
+
+    async def recv(self):
+        (length,) = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+        return (await self.reader.readexactly(length)).decode('utf-8')
+
+    def send(self, text):
+        data = text.encode('utf-8')
+        self.writer.write(HEADER.pack(len(data)) + data)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.bench.port)
+        await self.recv_raw_prompt()
+        self.writer.write(f"register {FRAMED_OPTION}".encode('utf-8'))
+        await self.recv()  # Enter username
+        self.send(self.username)
+        await self.recv()  # Enter password
+        self.send("bench")
+        # Registration has finished, password hashing included, once the server welcomes us
+        welcome = f"Welcome, {self.username}!"
+        while not (await self.recv()).startswith(welcome):
+            pass
+
+    async def read_loop(self):
+        latencies = self.bench.latencies
+        try:
+            while True:
+                message = await self.recv()
+                if message == "PING":
+                    self.send("/pong")
+                    continue
+                # Room lines look like "[room] user: bench <client> <seq> <sent_ns>"
+                marker = message.find(f": {BENCH_PREFIX} ")
+                if marker >= 0:
+                    sent_ns = int(message.rsplit(" ", 1)[1])
+                    latencies.append(time.perf_counter_ns() - sent_ns)
+                    self.bench.delivered += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def send_loop(self, rate, deadline):
+        interval = 1.0 / rate
+        seq = 0
+        next_send = time.perf_counter()
+        while next_send < deadline:
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+            self.send(f"{BENCH_PREFIX} {self.index} {seq} {time.perf_counter_ns()}")
+            self.bench.sent += 1
+            seq += 1
+            next_send += interval
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class Benchmark:
+    """Starts a chat server on a throwaway SQLite database and drives simulated clients against it."""
+
+    def __init__(self, mode, clients, rooms, rate, duration, server_args=()):
+        self.mode = mode
+        self.clients = clients
+        self.rooms = rooms
+        self.rate = rate
+        self.duration = duration
+        self.server_args = list(server_args)
+        self.port = free_port()
+        self.latencies = []
+        self.sent = 0
+        self.delivered = 0
+
+    def start_server(self, workdir):
+        """Run the server in `workdir`, so its database, search index and shared files stay out of the checkout."""
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_server.py"),
+                   "--host", "127.0.0.1", "--port", str(self.port), "--mode", self.mode,
+                   "--db", "sqlite", "--sqlite-path", os.path.join(workdir, "chat_app.db"),
+                   # Every simulated client comes from 127.0.0.1, so per-address limits would throttle the run
+                   "--login-rate", "0", "--address-rate", "0", "--max-handshakes", "0", *self.server_args]
+        process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.1).close()
+                return process
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError(f"Server exited with code {process.returncode}")
+                time.sleep(0.1)
+        process.kill()
+        raise RuntimeError("Server did not start listening")
+
+    async def run_clients(self):
+        clients = [SimClient(self, i) for i in range(self.clients)]
+        started = time.perf_counter()
+        # Connect in waves so the benchmark measures the server, not our own SYN burst
+        for offset in range(0, len(clients), 200):
+            await asyncio.gather(*(client.connect() for client in clients[offset:offset + 200]))
+        connect_seconds = time.perf_counter() - started
+
+        # The first client of each room creates it, the rest join it
+        readers = [asyncio.ensure_future(client.read_loop()) for client in clients]
+        for client in clients[:self.rooms]:
+            client.send(f"/create_room room{client.index}")
+        await asyncio.sleep(0.5)
+        for client in clients[self.rooms:]:
+            client.send(f"/join room{client.index % self.rooms}")
+        await asyncio.sleep(1.0)
+
+        deadline = time.perf_counter() + self.duration
+        await asyncio.gather(*(client.send_loop(self.rate, deadline) for client in clients))
+        await asyncio.sleep(1.0)  # Let in-flight deliveries arrive
+        for client in clients:
+            client.close()
+        await asyncio.gather(*readers, return_exceptions=True)
+        return connect_seconds
+
+    async def connect_idle(self, process):
+        """Log every client in, let the join announcements drain, and return the server's RSS before and after."""
+        await asyncio.sleep(1.0)
+        before = rss_bytes(process.pid)
+        clients = [SimClient(self, i) for i in range(self.clients)]
+        for offset in range(0, len(clients), 200):
+            await asyncio.gather(*(client.connect() for client in clients[offset:offset + 200]))
+        readers = [asyncio.ensure_future(client.read_loop()) for client in clients]
+        await asyncio.sleep(self.duration)
+        after = rss_bytes(process.pid)
+        for client in clients:
+            client.close()
+        await asyncio.gather(*readers, return_exceptions=True)
+        return before, after
+
+    def run_idle(self):
+        """Measure server memory per logged-in connection that sends nothing."""
+        # Password hashing doesn't affect memory; keep the logins cheap
+        self.server_args += ["--kdf", "pbkdf2_sha256", "--pbkdf2-iterations", "1000", "--ping-interval", "0"]
+        with tempfile.TemporaryDirectory(prefix="chat-bench-") as workdir:
+            process = self.start_server(workdir)
+            try:
+                before, after = asyncio.run(self.connect_idle(process))
+            finally:
+                process.terminate()
+                process.wait()
+        return {
+            'mode': self.mode,
+            'clients': self.clients,
+            'rss_idle_mb': round(before / 2 ** 20, 1),
+            'rss_connected_mb': round(after / 2 ** 20, 1),
+            'bytes_per_idle_connection': (after - before) // self.clients,
+            'connections_per_gb': int(2 ** 30 * self.clients / max(after - before, 1)),
+        }
+
+    def run(self):
+        with tempfile.TemporaryDirectory(prefix="chat-bench-") as workdir:
+            process = self.start_server(workdir)
+            try:
+                connect_seconds = asyncio.run(self.run_clients())
+            finally:
+                process.terminate()
+                process.wait()
+        latencies = sorted(self.latencies)
+        to_ms = lambda ns: round(ns / 1e6, 3) if ns is not None else None
+        return {
+            'mode': self.mode,
+            'clients': self.clients,
+            'rooms': self.rooms,
+            'rate_per_client': self.rate,
+            'duration': self.duration,
+            'connections_per_sec': round(self.clients / connect_seconds, 1),
+            'messages_sent_per_sec': round(self.sent / self.duration, 1),
+            'deliveries_per_sec': round(self.delivered / self.duration, 1),
+            'latency_p50_ms': to_ms(percentile(latencies, 0.50)),
+            'latency_p99_ms': to_ms(percentile(latencies, 0.99)),
+            'latency_p999_ms': to_ms(percentile(latencies, 0.999)),
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator and latency benchmark for the chat server")
+    parser.add_argument("--modes", nargs="+", choices=("threaded", "async"), default=["threaded", "async"])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second sent by each client")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of message traffic per mode")
+    parser.add_argument("--idle-memory", action="store_true",
+                        help="instead of traffic, measure server memory per idle logged-in connection")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per mode")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER,
+                        help="extra chat_server.py arguments, after --")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    raise_fd_limit()
+    server_args = [arg for arg in args.server_args if arg != "--"]
+    for mode in args.modes:
+        benchmark = Benchmark(mode, args.clients, args.rooms, args.rate, args.duration, server_args)
+        result = benchmark.run_idle() if args.idle_memory else benchmark.run()
+        if args.json:
+            print(json.dumps(result), flush=True)
+        else:
+            print(f"{mode}: " + ", ".join(f"{key}={value}" for key, value in result.items() if key != 'mode'),
+                  flush=True)
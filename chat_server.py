@@ -1,85 +1,466 @@
+import argparse
+import collections
+import functools
 import socket
+import time
 import threading
-import mysql.connector
 import os
 import logging
+import signal
+import ssl
+
+from auth_cache import AuthCache
+from cluster import ALL_SHARDS, MessageBus, run_cluster
+from compression import COMPRESS_OPTION, Compressor
+from credentials import KDFS, SCRYPT, PasswordHasher, migrate_plaintext
+from db import Database, DatabaseError, MySQLBackend, SQLiteBackend
+from file_transfer import FileStore, Transfer
+from framing import FRAMED_OPTION, FramedSocket
+from handoff import HandoffListener, request_takeover, send_message
+from history import LOBBY, MessageStore
+from lifecycle import ConnectionMonitor
+from logging_setup import LogSampler, configure_logging
+from metrics import Metrics, SamplingProfiler, StatsServer
+from outbound import CORK, DROP_OLDEST, NODELAY, SLOW_CONSUMER_POLICIES, TCP_MODES, QueuedSocket, configure_tcp
+from presence import PresenceService
+from ratelimit import AdmissionControl, RateLimiter
+from registry import SessionRegistry
+from rooms import RoomIndex
+from sanctions import BAN, MUTE, SanctionStore
+from scheduler import Scheduler
+from search import SearchIndex, parse_time
+from session import Session
+from tls import TLSSocket, server_context
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Roles for slash commands
+USER = 'user'
+ADMIN = 'admin'
+
+ACCOUNT_TABLES = {USER: 'users', ADMIN: 'admins'}
+
+RATE_LIMIT_SWEEP_INTERVAL = 60.0  # Seconds between dropping idle rate limit buckets
+
+USER_LIST_PAGE = 100  # Names per /list_users page and per /presence answer
+NAMES_ANNOUNCED = 20  # Names spelled out in a batched join/leave announcement
+
+SEARCH_RESULTS = 20  # Matches /search lists when it has no limit: filter
+MAX_SEARCH_RESULTS = 200
+SEARCH_FILTERS = ('user', 'room', 'to', 'since', 'until', 'limit')
+
+MAX_PROFILE_INTERVAL = 10.0  # Longest /profile sampling interval, in seconds
+MAX_SANCTION_MINUTES = 10 * 365 * 24 * 60  # Longest /temp_ban or timed /mute; /ban and /mute without one are permanent
+
+ACCEPT_POLL_INTERVAL = 0.25  # Seconds the accept loop blocks before checking whether it should stop
+SHUTDOWN_NOTICE = "Server is restarting, please reconnect in a few seconds."
+
+Command = collections.namedtuple('Command', ('handler', 'usage', 'min_args', 'role'), defaults=("", 0, USER))
+
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    adopts_clients = False  # Whether a hot restart can hand this server the previous process's live connections
+
+    def __init__(self, host='0.0.0.0', port=5555, backlog=128,
+                 queue_size=1024, slow_consumer_policy=DROP_OLDEST, backpressure_timeout=1.0,
+                 write_delay=0.0, write_batch_bytes=65536, tcp_mode=NODELAY,
+                 login_timeout=30.0, ping_interval=60.0, idle_timeout=180.0,
+                 max_outbound_bytes=8 * 1024 * 1024, outbound_grace=10.0,
+                 message_rate=5.0, message_burst=20, command_rate=2.0, command_burst=10,
+                 address_rate=50.0, address_burst=100, login_rate=0.5, login_burst=10, max_handshakes=256,
+                 kdf=SCRYPT, kdf_workers=None, scrypt_n=2 ** 14, pbkdf2_iterations=600000,
+                 db_backend=None, db_pool_size=10, auth_cache_size=10000, auth_cache_ttl=300.0,
+                 presence_interval=1.0, presence_history=10000,
+                 history_size=200, stats_port=None, log_message_bodies=False, message_log_rate=10.0,
+                 max_upload_size=64 * 1024 ** 3, tls_context=None, compress_threshold=1024, drain_timeout=10.0,
+                 search_dir="./search_index/", shard=0, cluster_bus=None):
         self.host = host
         self.port = port
-        self.clients = {}  # Store clients: {username: socket}
-        self.rooms = {}  # Store chat rooms: {room_name: [usernames]}
-        self.banned_users = set()
+        self.backlog = backlog  # Pending connections queued by the kernel before accept()
+        # Per-client outbound queue settings, see outbound.py
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.backpressure_timeout = backpressure_timeout
+        # Output coalescing: queued messages go out in one write, optionally held up to write_delay to fill up
+        self.write_delay = write_delay
+        self.write_batch_bytes = write_batch_bytes
+        self.tcp_mode = tcp_mode
+        # Optional TLS (an SSLContext, see tls.py) and compression of large frames for clients that ask for it
+        self.tls_context = tls_context
+        self.compressor = Compressor(compress_threshold) if compress_threshold else None
+        self.clients = SessionRegistry()  # Store clients: {username: socket}
+        self.rooms = RoomIndex()  # Room membership, indexed by room and by user
+        self.scheduler = Scheduler()  # Deadline-ordered timers, e.g. for lifting temporary bans and mutes
+        self.sessions = set()  # Every open connection's Session, logged in or not, for shutdown
+
+        # Graceful shutdown and hot restart, see stop() and take_over()
+        self.drain_timeout = drain_timeout  # Seconds clients get to finish receiving before they are cut off
+        self.stopping = threading.Event()
+        self.successor = None          # Handoff connection to the process taking over, if any
+        self.successor_adopts = False  # Whether that process wants our live connections too
+        self.handoff = None            # HandoffListener waiting for a successor
+        self.inherited = False         # The listening socket came from the previous process
+        self.adopted = []              # (state, socket) of connections the previous process handed over
 
-        # File sharing directory
+        # Cluster mode: this process is one shard and reaches the others through a bus, see cluster.py
+        self.shard = shard
+        self.cluster_bus = cluster_bus
+        self.bus = None
+        self.remote_users = {}  # username -> shard, for users connected to other worker processes
+
+        # Everyone online, on every shard: paged listing, deltas since a version and batched announcements
+        self.presence = PresenceService(self.scheduler, lambda *batch: self.call_soon(self.announce_presence, *batch),
+                                        presence_interval, presence_history)
+
+        # Per-message debug logs are rate limited and leave out message text unless asked for
+        self.message_log = LogSampler(message_log_rate)
+        self.log_message_bodies = log_message_bodies
+
+        # Runtime instrumentation, read with /stats or the optional local HTTP endpoint
+        self.metrics = Metrics()
+        self.profiler = SamplingProfiler()
+        self.stats_server = StatsServer(self.metrics, self.profiler, port=stats_port) if stats_port else None
+
+        # Dead and idle connections: login timeout, PING after ping_interval of silence, close after idle_timeout
+        self.monitor = ConnectionMonitor(self.scheduler, self.call_soon, login_timeout, ping_interval, idle_timeout,
+                                         self.metrics)
+        # Clients whose queued output stays over this many bytes for outbound_grace seconds are disconnected
+        self.max_outbound_bytes = max_outbound_bytes
+        self.outbound_grace = outbound_grace
+
+        # Flood control with token buckets, see ratelimit.py: chat lines and commands per user, everything
+        # from one source address, and login attempts per address and per account
+        self.message_limits = RateLimiter(message_rate, message_burst)
+        self.command_limits = RateLimiter(command_rate, command_burst)
+        self.address_limits = RateLimiter(address_rate, address_burst)
+        self.login_limits = RateLimiter(login_rate, login_burst)
+        self.admission = AdmissionControl(max_handshakes)  # Logins past the database at once
+        self.scheduler.schedule(RATE_LIMIT_SWEEP_INTERVAL, self.sweep_rate_limits)
+
+        # Recently verified logins, so reconnect storms don't all reach the database
+        self.auth_cache = AuthCache(auth_cache_size, auth_cache_ttl)
+        # Password hashing and checking, on its own pool of kdf_workers threads
+        self.credentials = PasswordHasher(kdf, scrypt_n=scrypt_n, pbkdf2_iterations=pbkdf2_iterations,
+                                          workers=kdf_workers, metrics=self.metrics)
+
+        # File sharing directory; transfers use their own data connections, see file_transfer.py
         self.file_dir = "./shared_files/"
-        os.makedirs(self.file_dir, exist_ok=True)
+        self.files = FileStore(self.file_dir, max_size=max_upload_size)
 
-        # Connect to MySQL database
+        # Connect to the database (MySQL unless another backend is passed in)
         try:
-            self.db = mysql.connector.connect(
-                host='localhost',
-                user='root',
-                password='admin',  
-                database='chat_app'
-            )
+            self.db = Database(db_backend or MySQLBackend(), pool_size=db_pool_size)
             logging.info("Successfully connected to the database")
-        except mysql.connector.Error as err:
-            logging.error(f"Error connecting to MySQL database: {err}")
+        except DatabaseError as err:
+            logging.error(f"Error connecting to the database: {err}")
             raise
 
+        # Admin full-text search over every message this process sees, in its own index files (one set per shard)
+        self.search = SearchIndex(os.path.join(search_dir, f"shard-{shard}") if cluster_bus else search_dir)
+
+        # Chat history: per-room ring buffers in memory, batched writes to the messages table
+        self.history = MessageStore(self.db, ring_size=history_size, index=self.search)
+
+        # Bans and mutes: checked from memory, stored in the sanctions table so they survive restarts
+        self.sanctions = SanctionStore(self.db, self.scheduler, on_expire=lambda kind, username: self.call_soon(
+            self.sanction_expired, kind, username))
+        self.sanctions.load()
+        self.load_rooms()
+        self.register_gauges()
+
         # Create server socket
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Prevent socket binding issues
+            if cluster_bus:
+                # Every worker listens on the same port; the kernel balances new connections between them
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             logging.info("Server socket created successfully")
         except socket.error as e:
             logging.error(f"Socket creation error: {e}")
             raise
 
-    def start(self):
+    def register_gauges(self):
+        counters = self.metrics.counters
+        self.metrics.gauge('connections.active',
+                           lambda: counters['connections.accepted'].value - counters['connections.closed'].value)
+        self.metrics.gauge('users.online', lambda: len(self.clients))
+        self.metrics.gauge('rooms', lambda: len(self.rooms.keys()))
+        self.metrics.gauge('queue.outbound_total', lambda: sum(len(c.queue) for _, c in self.clients.items()))
+        self.metrics.gauge('queue.outbound_max',
+                           lambda: max((len(c.queue) for _, c in self.clients.items()), default=0))
+        self.metrics.gauge('queue.history_pending', lambda: self.history.pending.qsize())
+        self.metrics.gauge('db.pool_open', lambda: self.db.pool.created)
+        self.metrics.gauge('db.pool_idle', lambda: self.db.pool.idle.qsize())
+        self.metrics.gauge('auth_cache', self.auth_cache.stats)
+        self.metrics.gauge('sanctions', lambda: len(self.sanctions))
+        self.metrics.gauge('cluster.remote_users', lambda: len(self.remote_users))
+        self.metrics.gauge('presence.version', lambda: self.presence.version)
+        self.metrics.gauge('search', self.search.stats)
+        if self.compressor:
+            self.metrics.gauge('compression', self.compressor.stats)
+        if self.tls_context:
+            self.metrics.gauge('tls.sessions', self.tls_context.session_stats)
+        self.metrics.gauge('handshakes.active', lambda: self.admission.active)
+        self.metrics.gauge('ratelimit.keys', lambda: sum(len(limits) for limits in self.rate_limiters()))
+        self.metrics.gauge('ratelimit.refused', lambda: sum(limits.limited for limits in self.rate_limiters()))
+
+    def bind(self):
         try:
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            logging.info(f"Server is listening on {self.host}:{self.port}")
+            if self.inherited:
+                logging.info(f"Server is listening on {self.host}:{self.port} (socket handed over)")
+            else:
+                self.server_socket.bind((self.host, self.port))
+                self.server_socket.listen(self.backlog)
+                logging.info(f"Server is listening on {self.host}:{self.port} (backlog {self.backlog})")
         except socket.error as e:
             logging.error(f"Socket binding error: {e}")
             raise
+        if self.stats_server:
+            self.stats_server.start()
+        if self.cluster_bus:
+            self.connect_bus()
+
+    def connect_bus(self):
+        self.bus = MessageBus(self.cluster_bus, self.shard, lambda event: self.call_soon(self.on_bus_event, event))
+        self.files.on_reserve = lambda token, transfer: self.publish(
+            {'type': 'file_token', 'token': token, 'transfer': [getattr(transfer, f) for f in Transfer.__slots__]})
+        self.files.on_claim = lambda token: self.publish({'type': 'file_claimed', 'token': token})
+        self.publish({'type': 'sync'})  # Ask the other shards who is online and which rooms exist
+        logging.info(f"Shard {self.shard} connected to the cluster bus")
+
+    def call_soon(self, func, *args):
+        """Run work handed over by a background thread (bus, scheduler); the async server moves it to its loop."""
+        func(*args)
+
+    def publish(self, event, target=ALL_SHARDS):
+        if self.bus:
+            self.bus.publish(event, target)
+
+    def on_bus_event(self, event):
+        """Apply an event from another shard. Only local clients are sent to, and nothing is re-published.
+
+        Runs on the bus reader thread (in threaded mode), so sends never wait
+        for a slow client: that would hold up every shard's traffic.
+        """
+        kind = event['type']
+        if kind == 'broadcast':
+            self.broadcast(event['message'], event['sender'], relay=False, block=False)
+            if event['body'] is not None:
+                self.history.record(LOBBY, event['sender'], event['body'], persist=False, created_at=event['sent_at'])
+        elif kind == 'room':
+            self.room_broadcast(event['room'], event['message'], event['sender'], relay=False, block=False)
+            if event['body'] is not None:
+                self.history.record(event['room'], event['sender'], event['body'], persist=False,
+                                    created_at=event['sent_at'])
+        elif kind == 'private':
+            client_socket = self.clients.get(event['recipient'])
+            if client_socket:
+                client_socket.send(f"Private message from {event['sender']}: {event['message']}".encode('utf-8'),
+                                   block=False)
+            # Stored by the sender's shard; recorded here so this shard's search index has it too
+            self.history.record(None, event['sender'], event['message'], event['recipient'], persist=False)
+        elif kind == 'online':
+            self.remote_users[event['user']] = event['shard']
+            self.presence.join(event['user'], event['shard'])
+        elif kind == 'offline':
+            if self.remote_users.get(event['user']) == event['shard']:
+                del self.remote_users[event['user']]
+            self.presence.leave(event['user'], event['shard'])
+        elif kind == 'room_create':
+            self.rooms.create(event['room'], None)
+        elif kind == 'room_delete':
+            members = self.rooms.delete(event['room'])
+            self.history.forget(event['room'])
+            self.send_to_users(members, f"Room '{event['room']}' has been deleted.", block=False)
+        elif kind == 'sync':
+            self.publish({'type': 'state', 'users': self.clients.keys(), 'rooms': self.rooms.keys()}, event['shard'])
+        elif kind == 'state':
+            for username in event['users']:
+                self.remote_users[username] = event['shard']
+                self.presence.join(username, event['shard'])
+            for room_name in event['rooms']:
+                self.rooms.create(room_name, None)
+        elif kind == 'shard_down':
+            for username, shard in list(self.remote_users.items()):
+                if shard == event['shard']:
+                    self.remote_users.pop(username, None)
+            self.presence.drop_shard(event['shard'])
+        elif kind == 'sanction':
+            self.apply_sanction(event['action'], event['user'], event['seconds'], relay=False)
+        elif kind == 'kick':
+            self.kick(event['user'], event['reason'], relay=False)
+        elif kind == 'file_token':
+            self.files.reserve(Transfer(*event['transfer']), event['token'], notify=False)
+        elif kind == 'file_claimed':
+            self.files.claim(event['token'], notify=False)
+
+    def start(self):
+        self.bind()
+        self.server_socket.settimeout(ACCEPT_POLL_INTERVAL)
 
-        while True:
+        while not self.stopping.is_set():
             try:
                 client_socket, address = self.server_socket.accept()
-                logging.info(f"New connection from {address}")
-                client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
+                client_socket.settimeout(None)  # Accepted sockets inherit the listener's timeout
+                logging.info("New connection from %s", address)
+                client_thread = threading.Thread(target=self.handle_client, args=(client_socket, address[0]))
                 client_thread.start()
+            except socket.timeout:
+                continue
             except Exception as e:
                 logging.error(f"Error accepting client connection: {e}")
+        self.shut_down()
+
+    def stop(self, successor=None, adopt_clients=False):
+        """Stop accepting and shut down; with `successor`, hand the listening socket to that process."""
+        if self.stopping.is_set():
+            if successor:
+                successor.close()  # Already on the way out
+            return
+        self.successor = successor
+        self.successor_adopts = adopt_clients and self.adopts_clients
+        self.stopping.set()
+
+    def install_signal_handlers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.stop())
+
+    def listen_for_successor(self, path):
+        """Let a new server process started with --takeover replace this one, see handoff.py."""
+        try:
+            self.handoff = HandoffListener(path, lambda conn, request: self.stop(conn, request.get('clients')))
+        except OSError as e:
+            logging.error(f"Hot restart is unavailable, cannot listen on {path}: {e}")
+            return
+        self.handoff.start()
+
+    def take_over(self, path):
+        """Start from the state of the server listening for a successor at `path`, which then exits.
+
+        We serve as soon as it has handed over the listening socket (and its
+        clients); it drains its other connections and stores its state
+        meanwhile, and previous_state_stored() picks that state up.
+        """
+        takeover = request_takeover(path, self.adopts_clients)
+        self.server_socket.close()
+        self.server_socket = takeover.listener
+        self.inherited = True
+        self.adopted = takeover.clients
+        self.search.hold()  # Its indexer still writes segment files to the same directory
+        takeover.wait_until_stored(self.previous_state_stored)
+
+    def previous_state_stored(self):
+        """Re-read what the previous process stored on its way out: rooms, sanctions, history and search index."""
+        self.load_rooms()
+        self.sanctions.flush()  # Sanctions given here since we started, before reload() replaces them
+        self.sanctions.reload()
+        self.history.cool()
+        self.search.reload()
+
+    def shut_down(self):
+        """Pass the listening socket on, let connected clients drain, then store what must survive the restart."""
+        started = time.monotonic()
+        successor = self.successor
+        if successor:
+            send_message(successor, {'type': 'listener'}, [self.server_socket.fileno()])
+            send_message(successor, {'type': 'handed_over'})  # It starts accepting while we drain
+        self.server_socket.close()
+        closed = self.drain()
+        self.persist_state()
+        if successor:
+            send_message(successor, {'type': 'done'})
+            successor.close()
+        elif self.handoff:
+            self.handoff.close()
+        logging.info(f"Server stopped in {time.monotonic() - started:.1f}s: {closed} connections closed"
+                     + (", listening socket handed over" if successor else ""))
+
+    def drain(self):
+        """Tell every client the server is going away and wait up to drain_timeout for them to disconnect."""
+        sessions = list(self.sessions)
+        for session in sessions:
+            if not session.closed:
+                session.conn.send(SHUTDOWN_NOTICE.encode('utf-8'))
+            session.conn.hangup()
+        deadline = time.monotonic() + self.drain_timeout
+        while self.sessions and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for session in list(self.sessions):
+            session.conn.abort()  # Clients that are still downloading, or not reading at all
+        return len(sessions)
+
+    def persist_state(self):
+        """Write out everything the next server process starts from: rooms, queued history, sanctions, search."""
+        if self.shard == 0:
+            self.save_rooms()  # Every shard knows every room; one copy is enough
+        self.history.flush()
+        self.sanctions.flush()
+        self.search.flush()
 
-    def handle_client(self, client_socket):
+    def save_rooms(self):
+        names = self.rooms.keys()
+        try:
+            self.db.execute("DELETE FROM rooms")
+            if names:
+                self.db.executemany("INSERT INTO rooms (name) VALUES (%s)", [(name,) for name in names])
+        except DatabaseError as err:
+            logging.error(f"Failed to store {len(names)} rooms: {err}")
+
+    def load_rooms(self):
+        try:
+            rows = self.db.fetchall("SELECT name FROM rooms")
+        except DatabaseError as err:
+            logging.error(f"Failed to load rooms: {err}")
+            return
+        for (name,) in rows:
+            self.rooms.create(name, None)
+        if rows:
+            logging.info(f"Loaded {len(rows)} rooms")
+
+    def handle_client(self, client_socket, address):
+        configure_tcp(client_socket, self.tcp_mode)
+        if self.tls_context:
+            client_socket = self.start_tls(client_socket)
+            if client_socket is None:
+                return
+        client_socket = QueuedSocket(FramedSocket(client_socket), self.queue_size,
+                                     self.slow_consumer_policy, self.backpressure_timeout, self.metrics,
+                                     self.write_delay, self.write_batch_bytes, self.tcp_mode == CORK,
+                                     self.max_outbound_bytes, self.outbound_grace)
+        session = client_socket.session = Session(client_socket, address, self.message_limits.bucket(),
+                                                  self.command_limits.bucket())
+        self.sessions.add(session)
+        self.monitor.watch(session)
+        self.metrics.inc('connections.accepted')
         username = None
         try:
-            username = self.authenticate(client_socket)
+            with self.metrics.timer('auth.handshake'):
+                username = self.authenticate(client_socket, address)
             if not username:
                 logging.info(f"Authentication failed for a client")
                 return
 
-            logging.info(f"User {username} authenticated successfully")
-            self.clients[username] = client_socket
-            self.broadcast(f"{username} has joined the chat!", None)
+            logging.info("User %s authenticated successfully", username)
+            session.username = username
+            self.monitor.logged_in(session)
+            self.add_client(username, client_socket)
 
             while True:
                 try:
-                    message = client_socket.recv(1024).decode('utf-8')
+                    data = client_socket.recv(1024)
+                    session.received(len(data))
+                    self.metrics.inc('bytes.in', len(data))
+                    message = data.decode('utf-8')
                     if message:
-                        logging.info(f"Received message from {username}: {message}")
+                        self.metrics.inc('messages.in')
+                        if self.message_log.allow():
+                            logging.debug("Received message from %s: %s", username, self.loggable(message))
+                        if not self.within_rate(session, message):
+                            continue
                         if message.startswith('/'):
                             self.handle_command(message, username, client_socket)
                         else:
-                            formatted_message = self.apply_formatting(message)
-                            self.broadcast(f"{username}: {formatted_message}", username)
+                            self.handle_chat(message, username)
                     else:
                         logging.info(f"Empty message received from {username}, closing connection")
                         break
@@ -91,66 +472,212 @@ class ChatServer:
         except Exception as e:
             logging.error(f"Unexpected error with client {username}: {str(e)}", exc_info=True)
         finally:
+            self.monitor.stop(session)
+            if username:
+                logging.info("Session of %s ended: %s", username, session.summary())
             self.remove_client(username)
+            client_socket.close(flush=True)  # Still open if authentication failed
+            self.sessions.discard(session)
+            self.metrics.inc('connections.closed')
 
-    def authenticate(self, client_socket):
+    def start_tls(self, sock):
+        """Server side of the TLS handshake, limited to the login timeout; returns None if it fails."""
+        tls_socket = TLSSocket(sock, self.tls_context)
+        sock.settimeout(self.monitor.login_timeout or None)
         try:
-            client_socket.send("Do you want to login, register, or admin? (login/register/admin): ".encode('utf-8'))
-            choice = client_socket.recv(1024).decode('utf-8').strip().lower()
-            logging.info(f"Authentication choice: {choice}")
-
-            cursor = self.db.cursor()
+            tls_socket.handshake()
+        except (ssl.SSLError, OSError) as e:
+            logging.info(f"TLS handshake failed: {e}")
+            self.metrics.inc('tls.failed')
+            sock.close()
+            return None
+        sock.settimeout(None)
+        self.tls_established(tls_socket)
+        return tls_socket
 
-            if choice == 'register':
-                return self.register_user(client_socket, cursor)
+    def tls_established(self, tls):
+        self.metrics.inc('tls.resumed' if tls.session_reused else 'tls.full_handshakes')
 
-            elif choice == 'login':
-                return self.handle_login(client_socket, cursor)
+    def authenticate(self, client_socket, address):
+        try:
+            client_socket.send("Do you want to login, register, or admin? (login/register/admin): ".encode('utf-8'))
+            choice, options = self.parse_choice(self.read_reply(client_socket))
+            logging.debug("Authentication choice: %s", choice)
+            self.negotiate(client_socket, options)
 
-            elif choice == 'admin':
-                return self.handle_admin_login(client_socket, cursor)
+            if choice == 'file':
+                self.handle_file_channel(client_socket, options)
+                return None
 
-            else:
+            if choice not in ('register', 'login', 'admin'):
                 logging.warning(f"Invalid authentication choice: {choice}")
                 client_socket.send("Invalid choice. Connection closed.".encode('utf-8'))
                 return None
+
+            if not self.admit_login(client_socket, address):
+                return None
+            if choice == 'register':
+                return self.register_user(client_socket)
+            elif choice == 'login':
+                return self.handle_login(client_socket)
+            else:
+                return self.handle_admin_login(client_socket)
+        except ConnectionError as e:
+            logging.info(f"Client left during authentication: {e}")
+            return None
         except Exception as e:
             logging.error(f"Error during authentication: {e}")
             return None
 
-    def register_user(self, client_socket, cursor):
+    def handle_file_channel(self, client_socket, options):
+        """Data connection opened with "file <token>": move the bytes of one reserved transfer.
+
+        Downloads start straight away; uploads get "READY" first so the file
+        bytes never share a read with the token.
+        """
+        transfer = self.files.claim(options[0]) if options else None
+        if transfer is None and options and self.bus:
+            time.sleep(0.2)  # A token reserved on another shard may still be on its way over the bus
+            transfer = self.files.claim(options[0])
+        if transfer is None:
+            client_socket.send("Invalid or expired transfer token.".encode('utf-8'))
+            return
+        self.monitor.stop(client_socket.session)  # Transfers may legitimately take longer than a login
+        if transfer.kind == 'download':
+            with self.metrics.timer('files.download'):
+                sent = self.files.send_download(transfer, client_socket)
+            self.metrics.inc('files.bytes_out', sent)
+        else:
+            client_socket.send("READY".encode('utf-8'))
+            with self.metrics.timer('files.upload'):
+                result = self.files.receive_upload(transfer, client_socket)
+            self.upload_finished(transfer, result, client_socket)
+
+    def upload_finished(self, transfer, result, client_socket):
+        """Report a completed upload on the data connection and to the uploader's chat session."""
+        if result is None:
+            return  # Interrupted; the .part file is kept for a resumed upload
+        self.metrics.inc('files.bytes_in', transfer.size - transfer.offset)
+        client_socket.send(result.encode('utf-8'))
+        owner = self.clients.get(transfer.username)
+        if owner:
+            owner.send(f"Upload of '{transfer.name}': {result}".encode('utf-8'))
+
+    def admit_login(self, client_socket, address):
+        """Turn a login attempt away early if its address is over the login rate."""
+        if not self.login_limits.allow(('address', address)):
+            self.metrics.inc('connections.rejected.rate')
+            client_socket.send("Too many login attempts from your address. Please wait and try again.".encode('utf-8'))
+            return False
+        return True
+
+    def enter_verification(self, client_socket):
+        """Take a handshake slot for checking credentials; the caller leaves it once the DB and KDF are done.
+
+        Taken only after the username and password have been read, so a
+        client that is slow to type holds nothing.
+        """
+        if self.admission.try_enter():
+            return True
+        self.metrics.inc('connections.rejected.busy')
+        client_socket.send("Server busy, please try again in a few seconds.".encode('utf-8'))
+        return False
+
+    def login_limited(self, kind, username, client_socket):
+        if self.login_limits.allow((kind, username)):
+            return False
+        self.metrics.inc('connections.rejected.rate')
+        logging.info(f"Too many login attempts for {kind} {username}")
+        client_socket.send("Too many login attempts for this account. Please wait and try again.".encode('utf-8'))
+        return True
+
+    def within_rate(self, session, message):
+        """Spend a token for one incoming line; over the limit it is dropped and the sender told so."""
+        if message.startswith('/'):
+            allowed = self.command_limits.spend(session.command_bucket)
+        else:
+            allowed = self.message_limits.spend(session.message_bucket)
+        if allowed and self.address_limits.allow(session.address):
+            return True
+        self.metrics.inc('messages.rate_limited')
+        session.conn.send("You are sending messages too fast; that one was dropped.".encode('utf-8'))
+        return False
+
+    def rate_limiters(self):
+        return self.message_limits, self.command_limits, self.address_limits, self.login_limits
+
+    def sweep_rate_limits(self):
+        for limits in self.rate_limiters():
+            limits.sweep()
+        self.scheduler.schedule(RATE_LIMIT_SWEEP_INTERVAL, self.sweep_rate_limits)
+
+    def read_reply(self, client_socket):
+        """Read the answer to a login prompt; a closed connection ends the handshake."""
+        data = client_socket.recv(1024)
+        if not data:
+            raise ConnectionError("Connection closed during login")
+        return data.decode('utf-8').strip()
+
+    def parse_choice(self, text):
+        """Split the login choice from protocol options such as '+framed'."""
+        words = text.strip().lower().split()
+        return (words[0] if words else ''), words[1:]
+
+    def negotiate(self, client_socket, options):
+        """Apply the protocol options sent with the login choice; compression needs framing."""
+        if FRAMED_OPTION in options:
+            client_socket.enable_framing()
+            if COMPRESS_OPTION in options and self.compressor:
+                client_socket.enable_compression(self.compressor)
+
+    def register_user(self, client_socket):
         try:
             client_socket.send("Enter username: ".encode('utf-8'))
-            username = client_socket.recv(1024).decode('utf-8').strip()
+            username = self.read_reply(client_socket)
 
             client_socket.send("Enter password: ".encode('utf-8'))
-            password = client_socket.recv(1024).decode('utf-8').strip()
+            password = self.read_reply(client_socket)
 
-            cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", (username, password))
-            self.db.commit()
+            if not self.enter_verification(client_socket):
+                return None
+            try:
+                with self.metrics.timer('auth.verify'):
+                    self.create_user(username, self.credentials.hash(password))
+            finally:
+                self.admission.leave()
+            client_socket.session.role = USER
             logging.info(f"New user registered: {username}")
             return username
-        except mysql.connector.Error as err:
+        except DatabaseError as err:
             logging.error(f"Database error during registration: {err}")
             client_socket.send("Registration failed. Please try again.".encode('utf-8'))
             return None
 
-    def handle_login(self, client_socket, cursor):
+    def handle_login(self, client_socket):
         try:
             client_socket.send("Enter username: ".encode('utf-8'))
-            username = client_socket.recv(1024).decode('utf-8').strip()
+            username = self.read_reply(client_socket)
 
             client_socket.send("Enter password: ".encode('utf-8'))
-            password = client_socket.recv(1024).decode('utf-8').strip()
+            password = self.read_reply(client_socket)
+
+            if self.login_limited('user', username, client_socket):
+                return None
 
-            cursor.execute("SELECT * FROM users WHERE username=%s AND password=%s", (username, password))
-            user = cursor.fetchone()
+            if not self.enter_verification(client_socket):
+                return None
+            try:
+                with self.metrics.timer('auth.verify'):
+                    user = self.find_user(username, password)
+            finally:
+                self.admission.leave()
 
             if user:
-                if username in self.banned_users:
+                if username in self.sanctions.banned:
                     client_socket.send("You are banned from this server.".encode('utf-8'))
                     logging.info(f"Banned user {username} attempted to log in")
                     return None
+                client_socket.session.role = USER
                 logging.info(f"User {username} authenticated successfully")
                 client_socket.send("Login successful".encode('utf-8'))
                 return username
@@ -158,23 +685,32 @@ class ChatServer:
                 client_socket.send("Invalid credentials. Try again.".encode('utf-8'))
                 logging.info(f"Invalid credentials for user {username}")
                 return None
-        except mysql.connector.Error as err:
+        except DatabaseError as err:
             logging.error(f"Database error during login: {err}")
             client_socket.send("Login failed. Please try again.".encode('utf-8'))
             return None
 
-    def handle_admin_login(self, client_socket, cursor):
+    def handle_admin_login(self, client_socket):
         try:
             client_socket.send("Enter admin username: ".encode('utf-8'))
-            username = client_socket.recv(1024).decode('utf-8').strip()
+            username = self.read_reply(client_socket)
 
             client_socket.send("Enter admin password: ".encode('utf-8'))
-            password = client_socket.recv(1024).decode('utf-8').strip()
+            password = self.read_reply(client_socket)
 
-            cursor.execute("SELECT * FROM admins WHERE username=%s AND password=%s", (username, password))
-            admin = cursor.fetchone()
+            if self.login_limited('admin', username, client_socket):
+                return None
+
+            if not self.enter_verification(client_socket):
+                return None
+            try:
+                with self.metrics.timer('auth.verify'):
+                    admin = self.find_admin(username, password)
+            finally:
+                self.admission.leave()
 
             if admin:
+                client_socket.session.role = ADMIN  # Rights belong to this connection, not to the name
                 logging.info(f"Admin {username} authenticated successfully")
                 client_socket.send("Admin login successful ".encode('utf-8'))
                 return username
@@ -182,57 +718,389 @@ class ChatServer:
                 client_socket.send("Invalid admin credentials. Try again.".encode('utf-8'))
                 logging.info(f"Invalid admin credentials for {username}")
                 return None
-        except mysql.connector.Error as err:
+        except DatabaseError as err:
             logging.error(f"Database error during admin login: {err}")
             client_socket.send("Admin login failed. Please try again.".encode('utf-8'))
             return None
 
+    # Database queries shared by the threaded and asyncio login paths
+    def create_user(self, username, password_hash):
+        with self.metrics.timer('auth.db'):
+            self.db.execute("INSERT INTO users (username, password) VALUES (%s, %s)", (username, password_hash))
+        self.auth_cache.invalidate(username)
+
+    def find_user(self, username, password):
+        return self.auth_cache.lookup(USER, username, password) or self.check_password(USER, username, password)
+
+    def find_admin(self, username, password):
+        return self.auth_cache.lookup(ADMIN, username, password) or self.check_password(ADMIN, username, password)
+
+    def load_password(self, kind, username):
+        with self.metrics.timer('auth.db'):
+            row = self.db.fetchone(f"SELECT password FROM {ACCOUNT_TABLES[kind]} WHERE username=%s", (username,))
+        return row[0] if row else None
+
+    def store_password(self, kind, username, password_hash):
+        with self.metrics.timer('auth.db'):
+            self.db.execute(f"UPDATE {ACCOUNT_TABLES[kind]} SET password=%s WHERE username=%s",
+                            (password_hash, username))
+
+    def check_password(self, kind, username, password):
+        """Verify against the stored hash on the KDF pool, rehashing plaintext or outdated entries on success."""
+        matches, upgrade = self.credentials.verify(password, self.load_password(kind, username))
+        if matches:
+            if upgrade:
+                self.store_password(kind, username, self.credentials.hash(password))
+            self.auth_cache.store(kind, username, password)
+        return matches
+
+    def migrate_passwords(self):
+        """Hash every plaintext password left from before hashing, instead of waiting for each account to log in."""
+        for table in ACCOUNT_TABLES.values():
+            migrate_plaintext(self.db, self.credentials, table)
+
+    def apply_sanction(self, action, username, seconds=None, relay=True):
+        """Apply 'ban', 'unban', 'mute' or 'unmute' now; a ban or mute with `seconds` is lifted by the scheduler.
+
+        In a cluster every shard applies the same sanction and keeps its own
+        timer; only the shard where the command was given stores it.
+        """
+        kind = BAN if action in ('ban', 'unban') else MUTE
+        active = action in ('ban', 'mute')
+        if active:
+            self.sanctions.add(kind, username, seconds, persist=relay)
+        else:
+            self.sanctions.remove(kind, username, persist=relay)
+        if kind == BAN:
+            self.auth_cache.invalidate(username)
+            if active:
+                self.kick(username, "You have been banned from this server.", relay=False)
+        else:
+            client_socket = self.clients.get(username)
+            if client_socket:
+                client_socket.send(("You have been muted." if active else "You are no longer muted.").encode('utf-8'))
+        if relay:
+            self.publish({'type': 'sanction', 'action': action, 'user': username, 'seconds': seconds})
+
+    def sanction_expired(self, kind, username):
+        client_socket = self.clients.get(username)  # One lookup: the client may be removed meanwhile
+        if kind == MUTE and client_socket:
+            client_socket.send("You are no longer muted.".encode('utf-8'), block=False)  # Scheduler thread
+
+    def is_muted(self, username, client_socket=None):
+        """Checked before any fan-out, so a muted sender's messages cost nothing downstream."""
+        if username not in self.sanctions.muted:
+            return False
+        if client_socket:
+            client_socket.send("You are muted.".encode('utf-8'))
+        return True
+
+    def kick(self, username, reason, relay=True):
+        """End a user's session; the reason and anything else queued is still delivered."""
+        client_socket = self.clients.get(username)
+        if client_socket:
+            client_socket.send(reason.encode('utf-8'))
+            client_socket.hangup()
+            logging.info(f"Kicked {username}")
+            return True
+        if relay and username in self.remote_users:
+            self.publish({'type': 'kick', 'user': username, 'reason': reason}, self.remote_users[username])
+            return True
+        return False
+
+    # Slash commands: name -> Command(handler method, usage, minimum argument count, role)
+    COMMANDS = {
+        "/msg": Command('msg_command', "<recipient> <message>", 2),
+        "/pm": Command('msg_command', "<recipient> <message>", 2),
+        "/list_users": Command('list_users_command', "[prefix] [page]"),
+        "/presence": Command('presence_command', "[since_version]"),
+        "/create_room": Command('create_room_command', "<room_name>", 1),
+        "/delete_room": Command('delete_room_command', "<room_name>", 1, ADMIN),
+        "/list_rooms": Command('list_rooms_command'),
+        "/join": Command('join_command', "<room_name>", 1),
+        "/leave": Command('leave_command', "<room_name>", 1),
+        "/room": Command('room_command', "<room_name> <message>", 2),
+        "/broadcast_room": Command('room_command', "<room_name> <message>", 2, ADMIN),
+        "/history": Command('history_command', "<room_name> [count]", 1),
+        "/files": Command('files_command'),
+        "/upload": Command('upload_command', "<file_name> <size> [sha256]", 2),
+        "/download": Command('download_command', "<file_name> [offset]", 1),
+        "/quit": Command('quit_command'),
+        "/pong": Command('pong_command'),
+        "/auth_stats": Command('auth_stats_command'),
+        "/stats": Command('stats_command', role=ADMIN),
+        "/search": Command('search_command', "<words> [user:<name>] [room:<room>] [to:<name>] [since:<2h|date>] "
+                                             "[until:<2h|date>] [limit:<n>]", 1, ADMIN),
+        "/profile": Command('profile_command', "start [interval_ms] | stop | report", role=ADMIN),
+        "/kick": Command('kick_command', "<username>", 1, ADMIN),
+        "/ban": Command('ban_command', "<username>", 1, ADMIN),
+        "/unban": Command('unban_command', "<username>", 1, ADMIN),
+        "/temp_ban": Command('ban_command', "<username> <minutes>", 2, ADMIN),
+        "/mute": Command('mute_command', "<username> [minutes]", 1, ADMIN),
+        "/unmute": Command('unmute_command', "<username>", 1, ADMIN),
+    }
+
     def handle_command(self, message, username, client_socket):
+        command = message.split(maxsplit=1)[0]
+        with self.metrics.timer(f"command.{command if command in self.COMMANDS else 'other'}"):
+            self.dispatch_command(message, username, client_socket)
+
+    def dispatch_command(self, message, username, client_socket):
         parts = message.split()
-        command = parts[0]
+        name, args = parts[0], parts[1:]
+        command = self.COMMANDS.get(name)
+        if command is None:
+            client_socket.send("Unknown command.".encode('utf-8'))
+        elif command.role == ADMIN and client_socket.session.role != ADMIN:
+            client_socket.send(f"Only admins can use {name}.".encode('utf-8'))
+        elif len(args) < command.min_args:
+            client_socket.send(f"Usage: {name} {command.usage}".encode('utf-8'))
+        else:
+            getattr(self, command.handler)(name, username, args, client_socket)
 
-        if command == "/msg":
-            if len(parts) < 3:
-                client_socket.send("Usage: /msg <recipient> <message>".encode('utf-8'))
-                return
-            recipient = parts[1]
-            msg = " ".join(parts[2:])
-            self.private_message(username, recipient, msg)
+    def msg_command(self, name, username, args, client_socket):
+        if not self.is_muted(username, client_socket):
+            self.private_message(username, args[0], " ".join(args[1:]))
 
-        elif command == "/list_users":
-            self.list_users(client_socket)
+    def list_users_command(self, name, username, args, client_socket):
+        page = int(args.pop()) if args and args[-1].isdigit() else 1
+        self.list_users(client_socket, args[0] if args else "", max(page, 1))
 
-        elif command == "/delete_room":
-            if len(parts) < 2:
-                client_socket.send("Usage: /delete_room <room_name>".encode('utf-8'))
-                return
-            room_name = parts[1]
-            self.delete_room(room_name, client_socket)
+    def presence_command(self, name, username, args, client_socket):
+        if not args:
+            client_socket.send(f"Presence v{self.presence.version}: {len(self.presence)} users online."
+                               .encode('utf-8'))
+        elif not args[0].isdigit():
+            client_socket.send(f"Usage: {name} {self.COMMANDS[name].usage}".encode('utf-8'))
+        else:
+            self.send_presence_changes(int(args[0]), client_socket)
+
+    def create_room_command(self, name, username, args, client_socket):
+        self.create_room(username, args[0])
+
+    def delete_room_command(self, name, username, args, client_socket):
+        self.delete_room(args[0], client_socket)
+
+    def list_rooms_command(self, name, username, args, client_socket):
+        self.list_rooms(client_socket)
+
+    def join_command(self, name, username, args, client_socket):
+        self.join_room(username, args[0], client_socket)
+
+    def leave_command(self, name, username, args, client_socket):
+        self.leave_room(username, args[0], client_socket)
+
+    def room_command(self, name, username, args, client_socket):
+        """/room posts to a room you are in; admins can /broadcast_room to any room."""
+        room_name, msg = args[0], " ".join(args[1:])
+        if room_name not in self.rooms:
+            client_socket.send(f"Room '{room_name}' does not exist.".encode('utf-8'))
+        elif name == "/room" and username not in self.rooms.room_members(room_name):
+            client_socket.send(f"You are not in room '{room_name}'.".encode('utf-8'))
+        elif not self.is_muted(username, client_socket):
+            self.room_broadcast(room_name, f"[{room_name}] {username}: {msg}", username, body=msg)
+            self.history.record(room_name, username, msg)
+
+    def history_command(self, name, username, args, client_socket):
+        count = int(args[1]) if len(args) > 1 and args[1].isdigit() else 20
+        self.send_history(args[0], count, client_socket)
+
+    def quit_command(self, name, username, args, client_socket):
+        client_socket.send("Goodbye.".encode('utf-8'))
+        client_socket.hangup()
+
+    def pong_command(self, name, username, args, client_socket):
+        pass  # Heartbeat reply; receiving it already counted as activity
 
-        elif command == "/create_room":
-            if len(parts) < 2:
-                client_socket.send("Usage: /create_room <room_name>".encode('utf-8'))
+    def auth_stats_command(self, name, username, args, client_socket):
+        stats = ", ".join(f"{key}={value}" for key, value in self.auth_cache.stats().items())
+        client_socket.send(f"Auth cache: {stats}".encode('utf-8'))
+
+    def stats_command(self, name, username, args, client_socket):
+        client_socket.send(self.metrics.format().encode('utf-8'))
+
+    def search_command(self, name, username, args, client_socket):
+        """/search words with optional filters; words may end in * to match any word starting with them."""
+        client_socket.send(self.search_reply(name, args).encode('utf-8'))
+
+    def search_reply(self, name, args):
+        """Run a /search and format the answer; safe to call from any thread."""
+        words, filters = [], {}
+        for arg in args:
+            key, separator, value = arg.partition(':')
+            if separator and key in SEARCH_FILTERS and value:
+                filters[key] = value
+            else:
+                words.append(arg)
+        try:
+            since = parse_time(filters['since']) if 'since' in filters else None
+            until = parse_time(filters['until']) if 'until' in filters else None
+            limit = min(max(int(filters.get('limit', SEARCH_RESULTS)), 1), MAX_SEARCH_RESULTS)
+        except ValueError:
+            limit = None
+        if limit is None or not words and not {'user', 'room', 'to'} & filters.keys():
+            return f"Usage: {name} {self.COMMANDS[name].usage}"
+        started = time.perf_counter()
+        total, results = self.search.search(words, filters.get('user'), filters.get('room'), filters.get('to'),
+                                            since, until, limit)
+        elapsed = (time.perf_counter() - started) * 1000
+        lines = [f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created_at))}] "
+                 + (f"{sender} -> {recipient}: " if recipient else f"#{room} {sender}: ") + body
+                 for created_at, sender, room, recipient, body in results]
+        shown = f", newest {len(results)} shown" if total > len(results) else ""
+        return "\n".join([f"Search: {total} matches in {elapsed:.1f} ms{shown}"] + lines)
+
+    def profile_command(self, name, username, args, client_socket):
+        """/profile start [interval_ms] | stop | report"""
+        action = args[0] if args else "report"
+        if action == "start":
+            try:
+                interval = float(args[1]) / 1000 if len(args) > 1 else None
+            except ValueError:
+                interval = 0.0
+            if interval is not None and not 0 < interval <= MAX_PROFILE_INTERVAL:  # Also rules out nan
+                client_socket.send(f"Usage: {name} {self.COMMANDS[name].usage}".encode('utf-8'))
                 return
-            room_name = parts[1]
-            self.create_room(username, room_name)
+            started = self.profiler.start(interval)
+            client_socket.send(("Profiler started." if started else "Profiler already running.").encode('utf-8'))
+        elif action == "stop":
+            self.profiler.stop()
+            client_socket.send(self.profiler.format().encode('utf-8'))
+        else:
+            client_socket.send(self.profiler.format().encode('utf-8'))
+
+    def files_command(self, name, username, args, client_socket):
+        files = self.files.list_files()
+        listing = "\n".join(f"{file_name} ({size} bytes)" for file_name, size in files)
+        client_socket.send((f"Shared files:\n{listing}" if files else "No shared files.").encode('utf-8'))
+
+    def upload_command(self, name, username, args, client_socket):
+        """/upload only reserves a transfer and replies with the token for a data connection.
 
-        elif command == "/list_rooms":
-            self.list_rooms(client_socket)
+        The chat connection never carries file bytes. The offset in the reply
+        is how much of an earlier attempt is already stored.
+        """
+        if not args[1].isdigit():
+            client_socket.send(f"Usage: {name} {self.COMMANDS[name].usage}".encode('utf-8'))
+            return
+        try:
+            sha256 = args[2] if len(args) > 2 else None
+            token, offset = self.files.prepare_upload(username, args[0], int(args[1]), sha256)
+            reply = f"FILE UPLOAD {token} {offset}"
+        except ValueError as e:
+            reply = str(e)
+        client_socket.send(reply.encode('utf-8'))
+
+    def download_command(self, name, username, args, client_socket):
+        try:
+            offset = int(args[1]) if len(args) > 1 and args[1].isdigit() else 0
+            token, size, sha256 = self.files.prepare_download(username, args[0], offset)
+            reply = f"FILE DOWNLOAD {token} {offset} {size} {sha256 or '-'}"
+        except ValueError as e:
+            reply = str(e)
+        client_socket.send(reply.encode('utf-8'))
 
+    # Moderation. Sanctions apply to the user's live session at once; timed ones are lifted by the scheduler
+    def kick_command(self, name, username, args, client_socket):
+        target = args[0]
+        if self.kick(target, f"You have been kicked by {username}."):
+            client_socket.send(f"{target} has been kicked.".encode('utf-8'))
         else:
-            client_socket.send("Unknown command.".encode('utf-8'))
+            client_socket.send(f"User {target} is not online.".encode('utf-8'))
+
+    def ban_command(self, name, username, args, client_socket):
+        """/ban <username> | /temp_ban <username> <minutes>"""
+        target = args[0]
+        seconds = self.parse_minutes(args[1:], client_socket) if name == "/temp_ban" else None
+        if name == "/temp_ban" and seconds is None:
+            return
+        self.apply_sanction('ban', target, seconds)
+        until = f" for {args[1]} minutes" if seconds else ""
+        client_socket.send(f"{target} has been banned{until}.".encode('utf-8'))
+        logging.info(f"{username} banned {target}{until}")
 
-    def list_users(self, client_socket):
-        """Send the list of online users to the requesting client."""
-        user_list = ", ".join(self.clients.keys())
-        client_socket.send(f"Online users: {user_list}".encode('utf-8'))
-        logging.info(f"Sent user list to client")
+    def unban_command(self, name, username, args, client_socket):
+        self.apply_sanction('unban', args[0])
+        client_socket.send(f"{args[0]} has been unbanned.".encode('utf-8'))
+
+    def mute_command(self, name, username, args, client_socket):
+        target = args[0]
+        seconds = self.parse_minutes(args[1:], client_socket) if len(args) > 1 else None
+        if len(args) > 1 and seconds is None:
+            return
+        self.apply_sanction('mute', target, seconds)
+        until = f" for {args[1]} minutes" if seconds else ""
+        client_socket.send(f"{target} has been muted{until}.".encode('utf-8'))
+        logging.info(f"{username} muted {target}{until}")
+
+    def unmute_command(self, name, username, args, client_socket):
+        self.apply_sanction('unmute', args[0])
+        client_socket.send(f"{args[0]} has been unmuted.".encode('utf-8'))
+
+    def parse_minutes(self, args, client_socket):
+        try:
+            minutes = float(args[0])
+            if 0 < minutes <= MAX_SANCTION_MINUTES:  # Also rules out inf and nan
+                return minutes * 60
+        except (IndexError, ValueError):
+            pass
+        client_socket.send(f"Duration must be a positive number of minutes, at most {MAX_SANCTION_MINUTES}."
+                           .encode('utf-8'))
+        return None
+
+    def list_users(self, client_socket, prefix="", page=1):
+        """Send one page of online users, optionally only those whose names start with `prefix`."""
+        offset = (page - 1) * USER_LIST_PAGE
+        version, names, total = self.presence.page(prefix, offset, USER_LIST_PAGE)
+        matching = f" matching '{prefix}'" if prefix else ""
+        if not names:
+            found = f"no page {page} of {total} users{matching}" if total else f"nobody{matching}"
+            client_socket.send(f"Online users (v{version}): {found}.".encode('utf-8'))
+            return
+        reply = (f"Online users (v{version}, {offset + 1}-{offset + len(names)} of {total}{matching}): "
+                 f"{', '.join(names)}")
+        if offset + len(names) < total:
+            reply += f" -- more with /list_users {prefix + ' ' if prefix else ''}{page + 1}"
+        client_socket.send(reply.encode('utf-8'))
+        logging.debug("Sent user list to client")
+
+    def send_presence_changes(self, since, client_socket):
+        """Send the users who came online or went offline after presence version `since`."""
+        changes = self.presence.changes_since(since)
+        if changes is None:
+            client_socket.send(f"Presence v{since} is too old; use /list_users for the full list.".encode('utf-8'))
+            return
+        version, joined, left = changes
+        client_socket.send(f"Presence v{version} since v{since}: joined {self.name_sample(joined, USER_LIST_PAGE)}; "
+                           f"left {self.name_sample(left, USER_LIST_PAGE)}".encode('utf-8'))
+
+    def name_sample(self, names, limit):
+        if not names:
+            return "nobody"
+        more = f" and {len(names) - limit} more" if len(names) > limit else ""
+        return ", ".join(names[:limit]) + more
+
+    def announce_presence(self, version, joined, left):
+        """Tell local clients who joined and left during the last presence interval, in one line."""
+        if len(joined) + len(left) == 1:
+            message = f"{joined[0]} has joined the chat!" if joined else f"{left[0]} left the chat."
+        else:
+            changes = []
+            if joined:
+                changes.append(f"joined: {self.name_sample(joined, NAMES_ANNOUNCED)}")
+            if left:
+                changes.append(f"left: {self.name_sample(left, NAMES_ANNOUNCED)}")
+            message = f"Presence v{version}, {len(self.presence)} online; " + "; ".join(changes)
+        # Every shard announces from its own presence view; runs on the Scheduler thread, which must not wait
+        self.broadcast(message, None, relay=False, block=False)
 
     def delete_room(self, room_name, client_socket):
-        """Delete a room if it exists and notify the admin."""
+        """Delete a room if it exists and notify its members and the admin."""
         if room_name in self.rooms:
-            del self.rooms[room_name]
-            self.broadcast(f"Room '{room_name}' has been deleted.", None)
+            members = self.rooms.delete(room_name)
+            self.history.forget(room_name)
+            self.send_to_users(members, f"Room '{room_name}' has been deleted.")
+            self.publish({'type': 'room_delete', 'room': room_name})
             client_socket.send(f"Room '{room_name}' deleted successfully.".encode('utf-8'))
             logging.info(f"Room {room_name} deleted")
         else:
@@ -242,43 +1110,276 @@ class ChatServer:
     def private_message(self, sender, recipient, message):
         if recipient in self.clients:
             self.clients[recipient].send(f"Private message from {sender}: {message}".encode('utf-8'))
-            logging.info(f"Private message sent from {sender} to {recipient}")
+            self.history.record(None, sender, message, recipient)
+            if self.message_log.allow():
+                logging.debug("Private message sent from %s to %s: %s", sender, recipient, self.loggable(message))
+        elif recipient in self.remote_users:
+            self.publish({'type': 'private', 'sender': sender, 'recipient': recipient, 'message': message},
+                         self.remote_users[recipient])
+            self.history.record(None, sender, message, recipient)
         else:
             self.clients[sender].send("User not found.".encode('utf-8'))
             logging.info(f"Failed to send private message from {sender} to {recipient} (user not found)")
 
     def create_room(self, username, room_name):
-        if room_name not in self.rooms:
-            self.rooms[room_name] = [username]
+        if self.rooms.create(room_name, username):
+            self.publish({'type': 'room_create', 'room': room_name})
             self.clients[username].send(f"Room '{room_name}' created successfully.".encode('utf-8'))
             logging.info(f"Room {room_name} created by {username}")
         else:
             self.clients[username].send(f"Room '{room_name}' already exists.".encode('utf-8'))
             logging.info(f"User {username} attempted to create existing room {room_name}")
 
+    def join_room(self, username, room_name, client_socket):
+        if self.rooms.join(username, room_name):
+            client_socket.send(f"Joined room '{room_name}'.".encode('utf-8'))
+            self.room_broadcast(room_name, f"{username} joined room '{room_name}'.", username)
+            logging.info(f"User {username} joined room {room_name}")
+        else:
+            client_socket.send(f"Room '{room_name}' does not exist.".encode('utf-8'))
+
+    def leave_room(self, username, room_name, client_socket):
+        if self.rooms.leave(username, room_name):
+            client_socket.send(f"Left room '{room_name}'.".encode('utf-8'))
+            self.room_broadcast(room_name, f"{username} left room '{room_name}'.", username)
+            logging.info(f"User {username} left room {room_name}")
+        else:
+            client_socket.send(f"You are not in room '{room_name}'.".encode('utf-8'))
+
+    def has_history(self, room_name):
+        """Whether a room name can have history; checked before MessageStore keeps anything for it."""
+        return room_name == LOBBY or room_name in self.rooms
+
+    def send_history(self, room_name, count, client_socket):
+        """Send the last messages of a room ('lobby' for chat outside rooms)."""
+        if not self.has_history(room_name):
+            client_socket.send(f"Room '{room_name}' does not exist.".encode('utf-8'))
+            return
+        if not self.history.is_warm(room_name):
+            self.history.load(room_name)
+        messages = self.history.recent(room_name, count)
+        if not messages:
+            client_socket.send(f"No history for '{room_name}'.".encode('utf-8'))
+            return
+        lines = [f"[{time.strftime('%H:%M:%S', time.localtime(created_at))}] {sender}: {body}"
+                 for created_at, sender, body in messages]
+        client_socket.send((f"History for '{room_name}':\n" + "\n".join(lines)).encode('utf-8'))
+
     def list_rooms(self, client_socket):
         room_list = ", ".join(self.rooms.keys())
         client_socket.send(f"Available rooms: {room_list}".encode('utf-8'))
-        logging.info(f"Room list sent to client")
+        logging.debug("Room list sent to client")
+
+    def loggable(self, message):
+        return message if self.log_message_bodies else f"<{len(message)} chars>"
+
+    def apply_formatting(self, message):
+        return message.strip()
 
-    def broadcast(self, message, sender_username):
-        for client_username, client_socket in self.clients.items():
-            if client_username != sender_username:
-                client_socket.send(message.encode('utf-8'))
-        logging.info(f"Broadcast message sent: {message}")
+    def handle_chat(self, message, username):
+        """Send a plain chat line to the sender's active room, or to everyone if they are in none."""
+        if self.is_muted(username, self.clients.get(username)):
+            return
+        formatted_message = self.apply_formatting(message)
+        room_name = self.rooms.active_room(username)
+        if room_name:
+            self.room_broadcast(room_name, f"[{room_name}] {username}: {formatted_message}", username,
+                                body=formatted_message)
+        else:
+            self.broadcast(f"{username}: {formatted_message}", username, body=formatted_message)
+        self.history.record(room_name or LOBBY, username, formatted_message)
+
+    def room_broadcast(self, room_name, message, sender_username, body=None, relay=True, block=True):
+        """Send to the room's members; in a cluster, other shards get it too (with body for their history)."""
+        with self.metrics.timer('fanout.room'):
+            self.send_to_users(self.rooms.room_members(room_name), message, sender_username, block)
+        if relay and self.bus:
+            self.publish({'type': 'room', 'room': room_name, 'message': message, 'sender': sender_username,
+                          'body': body, 'sent_at': time.time()})
+        if self.message_log.allow():
+            logging.debug("Room message sent to %s: %s", room_name, self.loggable(message))
+
+    def send_to_users(self, usernames, message, sender_username=None, block=True):
+        payload = message.encode('utf-8')
+        for member in usernames:
+            client_socket = self.clients.get(member)
+            if client_socket and member != sender_username:
+                client_socket.send(payload, block)
+
+    def broadcast(self, message, sender_username, body=None, relay=True, block=True):
+        payload = message.encode('utf-8')  # Encoded once and shared by every recipient's queue
+        with self.metrics.timer('fanout.broadcast'):
+            for client_username, client_socket in self.clients.items():
+                if client_username != sender_username:
+                    client_socket.send(payload, block)
+        if relay and self.bus:
+            self.publish({'type': 'broadcast', 'message': message, 'sender': sender_username, 'body': body,
+                          'sent_at': time.time()})
+        if self.message_log.allow():
+            logging.debug("Broadcast message sent: %s", self.loggable(message))
+
+    def add_client(self, username, client_socket, announce=True):
+        """Register a logged-in client; connections carried over a hot restart pass announce=False."""
+        self.clients[username] = client_socket
+        self.publish({'type': 'online', 'user': username})
+        self.presence.join(username, self.shard, announce)
+        if not announce:
+            return
+        # Others hear about the login in the next presence batch
+        client_socket.send(f"Welcome, {username}! {len(self.presence)} users online "
+                           f"(presence v{self.presence.version}).".encode('utf-8'))
 
     def remove_client(self, username):
-        if username in self.clients:
+        client_socket = self.clients.pop(username)
+        if client_socket is not None:
             logging.info(f"Removing {username}")
-            self.clients[username].close()
-            del self.clients[username]
-            self.broadcast(f"{username} left the chat.", None)
+            self.publish({'type': 'offline', 'user': username})
+            client_socket.close(flush=True)  # A kick reason or shutdown notice may be queued just before hangup()
+            self.rooms.remove_user(username)
+            self.presence.leave(username, self.shard)
         else:
             logging.warning(f"Attempted to remove non-existent client {username}")
 
-if __name__ == "__main__":
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat Messenger App server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--mode", choices=("threaded", "async"), default="threaded",
+                        help="threaded: one thread per client; async: all clients on one asyncio event loop")
+    parser.add_argument("--backlog", type=int, default=128, help="listen() backlog for the server socket")
+    parser.add_argument("--queue-size", type=int, default=1024, help="outbound messages buffered per client")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default=DROP_OLDEST,
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument("--write-delay-ms", type=float, default=0.0,
+                        help="hold a small outbound batch up to this long so more messages share one write")
+    parser.add_argument("--write-batch-bytes", type=int, default=65536,
+                        help="flush an outbound batch at once when it reaches this size")
+    parser.add_argument("--login-timeout", type=float, default=30.0, help="seconds to finish logging in, 0 for none")
+    parser.add_argument("--ping-interval", type=float, default=60.0,
+                        help="send PING after this many idle seconds, 0 to disable heartbeats")
+    parser.add_argument("--idle-timeout", type=float, default=180.0,
+                        help="disconnect clients silent for this many seconds, 0 for never")
+    parser.add_argument("--max-outbound-bytes", type=int, default=8 * 1024 * 1024,
+                        help="disconnect clients whose unsent output stays above this size")
+    parser.add_argument("--outbound-grace", type=float, default=10.0,
+                        help="seconds a client may stay over --max-outbound-bytes")
+    parser.add_argument("--message-rate", type=float, default=5.0,
+                        help="chat lines per second per user, with bursts of 4x; 0 for no limit")
+    parser.add_argument("--command-rate", type=float, default=2.0,
+                        help="commands per second per user, with bursts of 5x; 0 for no limit")
+    parser.add_argument("--address-rate", type=float, default=50.0,
+                        help="lines per second from one IP address across its users; 0 for no limit")
+    parser.add_argument("--login-rate", type=float, default=0.5,
+                        help="login attempts per second per IP address and per account; 0 for no limit")
+    parser.add_argument("--max-handshakes", type=int, default=256,
+                        help="logins processed at once before new ones are turned away; 0 for no limit")
+    parser.add_argument("--kdf", choices=KDFS, default=SCRYPT, help="password hashing function for new hashes")
+    parser.add_argument("--kdf-workers", type=int, default=None,
+                        help="threads hashing passwords at once (default: one per CPU)")
+    parser.add_argument("--scrypt-n", type=int, default=2 ** 14, help="scrypt CPU/memory cost, a power of two")
+    parser.add_argument("--pbkdf2-iterations", type=int, default=600000)
+    parser.add_argument("--migrate-passwords", action="store_true",
+                        help="hash all plaintext passwords at startup instead of on each account's next login")
+    parser.add_argument("--tcp-mode", choices=TCP_MODES, default=NODELAY,
+                        help="nodelay: TCP_NODELAY; nagle: kernel default; cork: TCP_CORK around each batch")
+    parser.add_argument("--db", choices=("mysql", "sqlite"), default="mysql")
+    parser.add_argument("--sqlite-path", default="chat_app.db", help="database file for --db sqlite")
+    parser.add_argument("--db-pool-size", type=int, default=10, help="maximum open database connections")
+    parser.add_argument("--auth-cache-size", type=int, default=10000, help="verified logins kept in memory")
+    parser.add_argument("--auth-cache-ttl", type=float, default=300.0, help="seconds a verified login stays cached")
+    parser.add_argument("--stats-port", type=int,
+                        help="serve JSON stats on http://127.0.0.1:PORT/stats (PORT+shard for each cluster worker)")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"))
+    parser.add_argument("--sync-logging", action="store_true",
+                        help="write log lines from the calling thread instead of a background listener")
+    parser.add_argument("--log-message-bodies", action="store_true", help="include message text in debug logs")
+    parser.add_argument("--message-log-rate", type=float, default=10.0,
+                        help="maximum per-message debug log lines per second")
+    parser.add_argument("--presence-interval", type=float, default=1.0,
+                        help="seconds of logins and logouts announced together in one line")
+    parser.add_argument("--presence-history", type=int, default=10000,
+                        help="presence changes kept for /presence <since_version>")
+    parser.add_argument("--history-size", type=int, default=200, help="recent messages kept in memory per room")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port (SO_REUSEPORT) and a message bus; 1 runs unclustered")
+    parser.add_argument("--bus-path", help="Unix socket for the cluster bus (default /tmp/chat-bus-PORT.sock)")
+    parser.add_argument("--max-upload-size", type=int, default=64 * 1024 ** 3, help="largest accepted upload in bytes")
+    parser.add_argument("--tls-cert", help="PEM certificate chain; enables TLS on the chat port")
+    parser.add_argument("--tls-key", help="PEM private key, if not in --tls-cert")
+    parser.add_argument("--tls-tickets", type=int, default=2,
+                        help="TLS 1.3 session tickets issued per handshake, used to resume reconnects")
+    parser.add_argument("--compress-threshold", type=int, default=1024,
+                        help="compress frames of at least this many bytes for clients that send +zlib; 0 disables")
+    parser.add_argument("--search-dir", default="./search_index/",
+                        help="directory for the /search index files (one subdirectory per worker in a cluster)")
+    parser.add_argument("--reindex-search", action="store_true",
+                        help="rebuild the /search index from the messages table at startup")
+    parser.add_argument("--drain-timeout", type=float, default=10.0,
+                        help="seconds clients get to disconnect on shutdown before they are cut off")
+    parser.add_argument("--handoff-path",
+                        help="Unix socket for hot restarts (default /tmp/chat-handoff-PORT.sock)")
+    parser.add_argument("--takeover", action="store_true",
+                        help="take the listening socket, and in async mode the clients, from the running server")
+    args = parser.parse_args(argv)
+    if args.takeover and args.workers > 1:
+        parser.error("--takeover needs a single server process (--workers 1)")
+    return args
+
+def start_server(args, shard=0, cluster_bus=None, tls_context=None):
+    """Build the server described by the command line and run it; in a cluster this runs in every worker."""
+    if cluster_bus:
+        # The parent's log listener thread does not survive fork()
+        configure_logging(getattr(logging, args.log_level), queued=not args.sync_logging)
     try:
-        server = ChatServer()
+        if args.mode == "async":
+            from async_server import AsyncChatServer
+            server_class = AsyncChatServer
+        else:
+            server_class = ChatServer
+        db_backend = SQLiteBackend(args.sqlite_path) if args.db == "sqlite" else MySQLBackend()
+        server = server_class(args.host, args.port, backlog=args.backlog,
+                              queue_size=args.queue_size, slow_consumer_policy=args.slow_consumer,
+                              write_delay=args.write_delay_ms / 1000, write_batch_bytes=args.write_batch_bytes,
+                              tcp_mode=args.tcp_mode, login_timeout=args.login_timeout,
+                              ping_interval=args.ping_interval, idle_timeout=args.idle_timeout,
+                              max_outbound_bytes=args.max_outbound_bytes, outbound_grace=args.outbound_grace,
+                              message_rate=args.message_rate, message_burst=args.message_rate * 4,
+                              command_rate=args.command_rate, command_burst=args.command_rate * 5,
+                              address_rate=args.address_rate, address_burst=args.address_rate * 2,
+                              login_rate=args.login_rate, login_burst=args.login_rate * 20,
+                              max_handshakes=args.max_handshakes, kdf=args.kdf, kdf_workers=args.kdf_workers,
+                              scrypt_n=args.scrypt_n, pbkdf2_iterations=args.pbkdf2_iterations,
+                              db_backend=db_backend, db_pool_size=args.db_pool_size,
+                              auth_cache_size=args.auth_cache_size, auth_cache_ttl=args.auth_cache_ttl,
+                              presence_interval=args.presence_interval, presence_history=args.presence_history,
+                              history_size=args.history_size,
+                              stats_port=args.stats_port + shard if args.stats_port else None,
+                              log_message_bodies=args.log_message_bodies, message_log_rate=args.message_log_rate,
+                              max_upload_size=args.max_upload_size, tls_context=tls_context,
+                              compress_threshold=args.compress_threshold, drain_timeout=args.drain_timeout,
+                              search_dir=args.search_dir, shard=shard, cluster_bus=cluster_bus)
+        handoff_path = args.handoff_path or f"/tmp/chat-handoff-{args.port}.sock"
+        if args.takeover:
+            server.take_over(handoff_path)
+        if args.migrate_passwords and shard == 0:
+            server.migrate_passwords()
+        if args.reindex_search:
+            server.search.rebuild(server.db)
+        if not cluster_bus:
+            server.listen_for_successor(handoff_path)
+        server.install_signal_handlers()
         server.start()
     except Exception as e:
         logging.critical(f"Critical error: {e}", exc_info=True)
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_logging(getattr(logging, args.log_level), queued=not args.sync_logging)
+    # Made before forking, so every worker shares the session ticket keys
+    tls_context = server_context(args.tls_cert, args.tls_key, args.tls_tickets) if args.tls_cert else None
+    if args.workers > 1:
+        bus_path = args.bus_path or f"/tmp/chat-bus-{args.port}.sock"
+        run_cluster(functools.partial(start_server, args, cluster_bus=bus_path, tls_context=tls_context),
+                    args.workers, bus_path)
+    else:
+        start_server(args, tls_context=tls_context)
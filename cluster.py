@@ -0,0 +1,201 @@
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import socket
+import struct
+import sys
+import threading
+
+# Bus frame: payload length and target shard, followed by a JSON payload
+BUS_HEADER = struct.Struct('!Ii')
+ALL_SHARDS = -1
+
+
+def read_frame(stream):
+    """Read one bus frame from a buffered stream; returns (target, payload) or None at EOF."""
+    try:
+        header = stream.read(BUS_HEADER.size)
+    except OSError:
+        return None
+    if len(header) < BUS_HEADER.size:
+        return None
+    length, target = BUS_HEADER.unpack(header)
+    try:
+        payload = stream.read(length)
+    except OSError:
+        return None
+    if len(payload) < length:
+        return None
+    return target, payload
+
+
+def encode_event(event, target=ALL_SHARDS):
+    payload = json.dumps(event).encode('utf-8')
+    return BUS_HEADER.pack(len(payload), target) + payload
+
+
+class BusHub:
+    """Relay between the worker processes of a cluster, listening on a Unix socket.
+
+    Each worker opens one connection and announces its shard number with an
+    empty frame. Frames are forwarded on the header alone, to one shard or to
+    every shard but the sender, so the hub never decodes the JSON payloads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.peers = {}  # shard -> (socket, send lock)
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+
+    def start(self):
+        threading.Thread(target=self.accept_loop, name="bus-hub", daemon=True).start()
+        logging.info(f"Cluster bus listening on {self.path}")
+
+    def accept_loop(self):
+        while True:
+            conn, _ = self.server.accept()
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        stream = conn.makefile('rb')
+        hello = read_frame(stream)
+        if hello is None:
+            conn.close()
+            return
+        shard = hello[0]
+        with self.lock:
+            self.peers[shard] = (conn, threading.Lock())
+        logging.info(f"Shard {shard} joined the cluster bus")
+        try:
+            while True:
+                frame = read_frame(stream)
+                if frame is None:
+                    break
+                target, payload = frame
+                self.forward(shard, target, BUS_HEADER.pack(len(payload), target) + payload)
+        finally:
+            with self.lock:
+                if self.peers.get(shard, (None,))[0] is conn:
+                    del self.peers[shard]
+            conn.close()
+            logging.warning(f"Shard {shard} left the cluster bus")
+            self.forward(shard, ALL_SHARDS, encode_event({'type': 'shard_down', 'shard': shard}))
+
+    def forward(self, source, target, frame):
+        with self.lock:
+            peers = list(self.peers.items())
+        for shard, (conn, send_lock) in peers:
+            if shard == source or target not in (ALL_SHARDS, shard):
+                continue
+            try:
+                with send_lock:
+                    conn.sendall(frame)
+            except OSError as e:
+                logging.warning(f"Could not forward bus frame to shard {shard}: {e}")
+
+    def close(self):
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class MessageBus:
+    """A worker's connection to the hub.
+
+    publish() only queues the encoded frame; a writer thread sends everything
+    queued since its last write in one sendall(), so a burst of chat lines
+    costs one system call. Events from other shards are passed to `handler`
+    on the reader thread.
+    """
+
+    def __init__(self, path, shard, handler):
+        self.shard = shard
+        self.handler = handler
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock.sendall(BUS_HEADER.pack(0, shard))
+        self.outgoing = queue.SimpleQueue()
+        threading.Thread(target=self.run_writer, name="bus-writer", daemon=True).start()
+        threading.Thread(target=self.run_reader, name="bus-reader", daemon=True).start()
+
+    def publish(self, event, target=ALL_SHARDS):
+        event['shard'] = self.shard
+        self.outgoing.put(encode_event(event, target))
+
+    def run_writer(self):
+        while True:
+            frames = [self.outgoing.get()]
+            while True:
+                try:
+                    frames.append(self.outgoing.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.sock.sendall(b''.join(frames))
+            except OSError as e:
+                logging.error(f"Cluster bus write failed: {e}")
+                return
+
+    def run_reader(self):
+        stream = self.sock.makefile('rb')
+        while True:
+            frame = read_frame(stream)
+            if frame is None:
+                break
+            try:
+                self.handler(json.loads(frame[1]))
+            except Exception as e:
+                logging.error(f"Error handling cluster bus event: {e}", exc_info=True)
+        logging.error("Lost connection to the cluster bus")
+
+
+def run_worker(start_worker, shard):
+    # Not the parent's handler: after its SystemExit, multiprocessing would wait for the non-daemon client threads.
+    # Until start_server() installs the graceful handler a SIGTERM kills the worker; after that it drains clients
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    start_worker(shard)
+
+
+def run_cluster(start_worker, workers, bus_path):
+    """Run `workers` forked processes that each call start_worker(shard), relaying between them.
+
+    Every worker binds the same port with SO_REUSEPORT, so the kernel spreads
+    new connections across them. A worker that dies is started again with
+    the same shard number.
+    """
+    hub = BusHub(bus_path)
+    hub.start()
+    # Turn SIGTERM into SystemExit so the finally block below stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    context = multiprocessing.get_context('fork')
+
+    def spawn(shard):
+        process = context.Process(target=run_worker, args=(start_worker, shard), name=f"chat-shard-{shard}")
+        process.start()
+        return process
+
+    processes = {shard: spawn(shard) for shard in range(workers)}
+    try:
+        while True:
+            sentinels = {process.sentinel: shard for shard, process in processes.items()}
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                shard = sentinels[sentinel]
+                logging.error(f"Shard {shard} exited with code {processes[shard].exitcode}, restarting it")
+                processes[shard] = spawn(shard)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+        hub.close()
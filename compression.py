@@ -0,0 +1,76 @@
+import collections
+import threading
+import zlib
+
+# Appended to the login choice ("login +framed +zlib") to accept compressed frames; needs framing
+COMPRESS_OPTION = '+zlib'
+
+# Set in a frame's length header when the payload is zlib data made with ZLIB_DICTIONARY. Frames are
+# limited to 16 MiB, so the top bit of the 32-bit length is never needed for the length itself.
+COMPRESSED = 0x80000000
+
+# Preset dictionary shared by both ends: text that recurs in server output. Later bytes are cheaper
+# to refer back to, so the most common phrases come last.
+ZLIB_DICTIONARY = (
+    b"Available rooms: Online users (v, 1-100 of ) -- more with /list_users Presence v since v: joined ; left "
+    b"nobody Room '' created successfully. Joined room ''. Left room ''. has been deleted. "
+    b"Private message from : has joined the chat! left the chat. joined room left room "
+    b"History for '':\n[00:00:00] \n[10:\n[11:\n[12:\n[13:\n[14:\n[15:\n[16:\n[17:\n[18:\n[19:\n[20:\n[21:\n"
+)
+
+
+def inflate(payload, limit):
+    """Decompress a COMPRESSED frame payload, refusing to expand it beyond `limit` bytes."""
+    decompressor = zlib.decompressobj(zdict=ZLIB_DICTIONARY)
+    data = decompressor.decompress(payload, limit)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed frame expands beyond the {limit} byte limit")
+    return data
+
+
+class Compressor:
+    """Compresses large outbound payloads for connections that negotiated COMPRESS_OPTION.
+
+    Each payload is compressed on its own with the preset dictionary, so a
+    frame never depends on earlier ones and the same compressed bytes suit
+    every recipient. Broadcasts hand one bytes object to every client's
+    queue, so the last few results are cached by payload and a room
+    message is compressed once however many members are on compressing
+    connections. Payloads under `threshold` bytes, and ones that don't get
+    smaller, are sent as they are.
+    """
+
+    def __init__(self, threshold=1024, level=6, cache_size=64):
+        self.threshold = threshold
+        self.level = level
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()  # payload -> compressed bytes, or None when not worth it
+        self.lock = threading.Lock()
+        self.compressed = 0  # Payloads compressed, cache hits included
+        self.bytes_saved = 0
+
+    def stats(self):
+        return {'compressed': self.compressed, 'bytes_saved': self.bytes_saved, 'cached': len(self.cache)}
+
+    def compress(self, data):
+        """Return the compressed payload, or None if `data` should go out uncompressed."""
+        if len(data) < self.threshold:
+            return None
+        with self.lock:
+            packed = self.cache.get(data, False)
+            if packed is not False:
+                self.cache.move_to_end(data)
+        if packed is False:
+            compressor = zlib.compressobj(self.level, zdict=ZLIB_DICTIONARY)
+            packed = compressor.compress(data) + compressor.flush()
+            if len(packed) >= len(data):
+                packed = None
+            with self.lock:
+                self.cache[data] = packed
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        if packed is not None:
+            with self.lock:
+                self.compressed += 1
+                self.bytes_saved += len(data) - len(packed)
+        return packed
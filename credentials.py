@@ -0,0 +1,119 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Key derivation functions for stored passwords
+SCRYPT = 'scrypt'
+PBKDF2 = 'pbkdf2_sha256'
+KDFS = (SCRYPT, PBKDF2)
+
+HASH_SIZE = 32
+SALT_SIZE = 16
+
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def lower_priority(niceness=10):
+    """Renice the calling thread, so on busy cores message handling runs ahead of password hashing."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)  # Per thread on Linux
+    except (AttributeError, OSError):
+        pass
+
+
+class PasswordHasher:
+    """Salted password hashes made with scrypt or PBKDF2 on a bounded thread pool.
+
+    Stored values read "scrypt$n$r$p$salt$hash" or
+    "pbkdf2_sha256$iterations$salt$hash". hashlib releases the GIL while it
+    derives a key, so the pool's workers run on separate cores, and no more
+    than `workers` hashes are ever computed at once however many clients are
+    logging in; threads serving connected users never do the hashing
+    themselves. A stored value in neither format is a plaintext password
+    from before hashing was introduced. verify() accepts it, and reports it
+    (like a hash made with older cost settings) as needing an upgrade.
+    """
+
+    def __init__(self, kdf=SCRYPT, scrypt_n=2 ** 14, scrypt_r=8, scrypt_p=1, pbkdf2_iterations=600000,
+                 workers=None, metrics=None):
+        if kdf not in KDFS:
+            raise ValueError(f"Unknown password hashing function: {kdf}")
+        self.kdf = kdf
+        self.params = (scrypt_n, scrypt_r, scrypt_p) if kdf == SCRYPT else (pbkdf2_iterations,)
+        self.metrics = metrics
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4, thread_name_prefix="kdf",
+                                       initializer=lower_priority)
+        # Checked when a username doesn't exist, so unknown names take as long as wrong passwords
+        self.dummy = self.compute_hash(os.urandom(SALT_SIZE).hex())
+
+    def hash(self, password):
+        return self.pool.submit(self.compute_hash, password).result()
+
+    def verify(self, password, stored):
+        """Return (matches, needs_upgrade); `stored` None means no such account."""
+        return self.pool.submit(self.compute_verify, password, stored).result()
+
+    async def hash_async(self, password):
+        return await asyncio.wrap_future(self.pool.submit(self.compute_hash, password))
+
+    async def verify_async(self, password, stored):
+        return await asyncio.wrap_future(self.pool.submit(self.compute_verify, password, stored))
+
+    def derive(self, kdf, params, password, salt):
+        if self.metrics:
+            self.metrics.inc('auth.kdf')
+        password = password.encode('utf-8')
+        if kdf == SCRYPT:
+            n, r, p = params
+            return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=HASH_SIZE)
+        return hashlib.pbkdf2_hmac('sha256', password, salt, params[0], dklen=HASH_SIZE)
+
+    def compute_hash(self, password):
+        salt = os.urandom(SALT_SIZE)
+        key = self.derive(self.kdf, self.params, password, salt)
+        return "$".join([self.kdf, *map(str, self.params), b64(salt), b64(key)])
+
+    def parse(self, stored):
+        """Split a stored hash into (kdf, params, salt, key), or return None for a plaintext password."""
+        fields = stored.split("$")
+        kdf = fields[0]
+        if (kdf, len(fields)) not in ((SCRYPT, 6), (PBKDF2, 4)):
+            return None
+        try:
+            params = tuple(int(value) for value in fields[1:-2])
+            return kdf, params, base64.b64decode(fields[-2], validate=True), base64.b64decode(fields[-1], validate=True)
+        except ValueError:
+            return None
+
+    def is_hashed(self, stored):
+        return self.parse(stored) is not None
+
+    def compute_verify(self, password, stored):
+        parsed = self.parse(stored if stored is not None else self.dummy)
+        if parsed is None:
+            # Legacy plaintext row
+            return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8')), True
+        kdf, params, salt, key = parsed
+        matches = hmac.compare_digest(self.derive(kdf, params, password, salt), key)
+        return matches and stored is not None, (kdf, params) != (self.kdf, self.params)
+
+
+def migrate_plaintext(db, hasher, table):
+    """Replace every plaintext password in `table` with a hash; returns how many rows were converted."""
+    rows = [(username, password) for username, password in db.fetchall(f"SELECT username, password FROM {table}")
+            if not hasher.is_hashed(password)]
+    if not rows:
+        return 0
+    hashes = hasher.pool.map(hasher.compute_hash, [password for _, password in rows])
+    # The old value is part of the match, so a password changed meanwhile is left alone
+    db.executemany(f"UPDATE {table} SET password=%s WHERE username=%s AND password=%s",
+                   [(hashed, username, password) for (username, password), hashed in zip(rows, hashes)])
+    logging.info(f"Hashed {len(rows)} plaintext passwords in {table}")
+    return len(rows)
@@ -0,0 +1,205 @@
+import contextlib
+import logging
+import queue
+import sqlite3
+import threading
+
+
+class DatabaseError(Exception):
+    """Raised for any backend error, so callers don't depend on a specific driver."""
+
+
+class PoolTimeout(DatabaseError):
+    """Raised when no pooled connection became free in time."""
+
+
+class MySQLBackend:
+    # users and admins are managed outside the server; only tables the server owns are created
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS messages (id BIGINT AUTO_INCREMENT PRIMARY KEY, room VARCHAR(255), "
+        "sender VARCHAR(255) NOT NULL, recipient VARCHAR(255), body TEXT NOT NULL, created_at DOUBLE NOT NULL, "
+        "INDEX messages_room (room, id))",
+        "CREATE TABLE IF NOT EXISTS sanctions (username VARCHAR(255) NOT NULL, kind VARCHAR(16) NOT NULL, "
+        "expires_at DOUBLE, PRIMARY KEY (username, kind))",
+        "CREATE TABLE IF NOT EXISTS rooms (name VARCHAR(255) PRIMARY KEY)",
+    )
+
+    def __init__(self, host='localhost', user='root', password='admin', database='chat_app'):
+        import mysql.connector  # Only needed when this backend is selected
+        self.driver = mysql.connector
+        self.params = dict(host=host, user=user, password=password, database=database)
+        self.errors = mysql.connector.Error
+        self.connection_errors = (mysql.connector.InterfaceError, mysql.connector.OperationalError)
+
+    def connect(self):
+        return self.driver.connect(**self.params)
+
+    def is_alive(self, conn):
+        return conn.is_connected()
+
+    def prepare(self, query):
+        return query
+
+
+class SQLiteBackend:
+    """File-backed SQLite stand-in for local testing without a MySQL server."""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS users (username VARCHAR(255) PRIMARY KEY, password VARCHAR(255) NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS admins (username VARCHAR(255) PRIMARY KEY, password VARCHAR(255) NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, room VARCHAR(255), "
+        "sender VARCHAR(255) NOT NULL, recipient VARCHAR(255), body TEXT NOT NULL, created_at DOUBLE NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS messages_room ON messages (room, id)",
+        "CREATE TABLE IF NOT EXISTS sanctions (username VARCHAR(255) NOT NULL, kind VARCHAR(16) NOT NULL, "
+        "expires_at DOUBLE, PRIMARY KEY (username, kind))",
+        "CREATE TABLE IF NOT EXISTS rooms (name VARCHAR(255) PRIMARY KEY)",
+    )
+
+    def __init__(self, path='chat_app.db'):
+        self.path = path
+        self.errors = sqlite3.Error
+        self.connection_errors = (sqlite3.InterfaceError, sqlite3.OperationalError)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+
+    def is_alive(self, conn):
+        return True
+
+    def prepare(self, query):
+        return query.replace('%s', '?')
+
+
+class ConnectionPool:
+    """Bounded pool of backend connections, handed out to one thread at a time."""
+
+    def __init__(self, backend, size=10, timeout=5.0):
+        self.backend = backend
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()  # Most recently used first, so idle extras go stale together
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            grow = self.created < self.size
+            if grow:
+                self.created += 1
+        if grow:
+            try:
+                return self.backend.connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"No database connection free after {self.timeout}s")
+
+    def release(self, conn, discard=False):
+        if discard:
+            with self.lock:
+                self.created -= 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+        else:
+            self.idle.put(conn)
+
+
+class Database:
+    """Thread-safe query layer: every call runs on its own cursor over a pooled connection.
+
+    Connections that have dropped are discarded and the query is retried once
+    on a fresh connection, so a MySQL restart doesn't need a server restart.
+    """
+
+    def __init__(self, backend, pool_size=10, timeout=5.0):
+        self.backend = backend
+        self.pool = ConnectionPool(backend, pool_size, timeout)
+        # Open one connection up front so configuration errors surface at startup
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                for statement in backend.SCHEMA:
+                    cursor.execute(statement)
+                cursor.close()
+                conn.commit()
+        except backend.errors as err:
+            raise DatabaseError(str(err)) from err
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        if not self.backend.is_alive(conn):
+            self.pool.release(conn, discard=True)
+            conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except self.backend.connection_errors:
+            discard = True
+            raise
+        except Exception:
+            try:
+                conn.rollback()  # Never hand the next caller a connection with a transaction left open
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.pool.release(conn, discard)
+
+    def acquire(self):
+        try:
+            return self.pool.acquire()
+        except self.backend.errors as err:
+            raise DatabaseError(str(err)) from err
+
+    def run(self, query, params=(), fetch=None, many=False):
+        for attempt in (1, 2):
+            try:
+                with self.connection() as conn:
+                    cursor = conn.cursor()
+                    try:
+                        if many:
+                            cursor.executemany(self.backend.prepare(query), params)
+                        else:
+                            cursor.execute(self.backend.prepare(query), params)
+                        if fetch == 'one':
+                            result = cursor.fetchone()
+                        elif fetch == 'all':
+                            result = cursor.fetchall()
+                        else:
+                            result = cursor.rowcount
+                        # Reads too: on MySQL (REPEATABLE READ, no autocommit) an open read transaction
+                        # would keep this pooled connection on an old snapshot
+                        conn.commit()
+                        return result
+                    finally:
+                        cursor.close()
+            except self.backend.connection_errors as err:
+                if attempt == 2:
+                    raise DatabaseError(str(err)) from err
+                logging.warning(f"Database connection lost ({err}), reconnecting")
+            except self.backend.errors as err:
+                raise DatabaseError(str(err)) from err
+
+    def execute(self, query, params=()):
+        return self.run(query, params)
+
+    def executemany(self, query, rows):
+        """Run one statement for many parameter rows in a single round trip and commit."""
+        return self.run(query, rows, many=True)
+
+    def fetchone(self, query, params=()):
+        return self.run(query, params, fetch='one')
+
+    def fetchall(self, query, params=()):
+        return self.run(query, params, fetch='all')
@@ -0,0 +1,255 @@
+import fcntl
+import hashlib
+import logging
+import os
+import secrets
+import threading
+import time
+
+CHUNK_SIZE = 256 * 1024
+PART_SUFFIX = '.part'
+CHECKSUM_SUFFIX = '.sha256'
+UPLOAD_CONFLICT = "ERROR another upload of this file is in progress or has finished"
+
+
+class Transfer:
+    __slots__ = ('kind', 'username', 'name', 'size', 'sha256', 'offset', 'expires')
+
+    def __init__(self, kind, username, name, size, sha256, offset, expires):
+        self.kind = kind          # 'upload' or 'download'
+        self.username = username
+        self.name = name
+        self.size = size
+        self.sha256 = sha256      # Expected (upload) or stored (download) checksum, may be None
+        self.offset = offset      # Byte to start from, for resumed transfers
+        self.expires = expires
+
+
+class FileStore:
+    """Files in the shared_files directory, moved over separate data connections.
+
+    A chat command (/upload, /download) reserves a one-time token; the client
+    then opens a second connection to the server port and sends "file <token>"
+    as its login choice. File bytes never travel on the chat connection, so a
+    multi-GB transfer doesn't delay anyone's messages. Downloads use
+    sendfile() so the data goes from the page cache to the socket without
+    being copied through Python. Uploads are written chunk by chunk to a
+    .part file, so an interrupted upload resumes from the bytes already on
+    disk, and are checked against the client's SHA-256 when complete. A
+    name has one upload at a time: /upload reserves it until the token
+    expires or the upload ends, and the .part file is locked while it is
+    written, which also covers uploads handled by other cluster workers.
+    """
+
+    def __init__(self, directory, max_size=64 * 1024 ** 3, token_ttl=60.0):
+        self.directory = directory
+        self.max_size = max_size
+        self.token_ttl = token_ttl
+        self.pending = {}  # token -> Transfer
+        self.uploads = {}  # name -> (Transfer, monotonic time it is reserved until), for uploads not finished yet
+        self.lock = threading.Lock()
+        # Optional callbacks so a cluster can share tokens between worker processes
+        self.on_reserve = None
+        self.on_claim = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name, suffix=''):
+        return os.path.join(self.directory, name + suffix)
+
+    @staticmethod
+    def valid_name(name):
+        return (name == os.path.basename(name) and not name.startswith('.')
+                and not name.endswith((PART_SUFFIX, CHECKSUM_SUFFIX)))
+
+    def list_files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and self.valid_name(entry.name):
+                files.append((entry.name, entry.stat().st_size))
+        return sorted(files)
+
+    def stored_checksum(self, name):
+        try:
+            with open(self.path(name, CHECKSUM_SUFFIX)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def reserve(self, transfer, token=None, notify=True):
+        token = token or secrets.token_hex(16)
+        now = time.monotonic()
+        with self.lock:
+            for stale in [t for t, pending in self.pending.items() if pending.expires < now]:
+                del self.pending[stale]
+            self.pending[token] = transfer
+        if notify and self.on_reserve:
+            self.on_reserve(token, transfer)
+        return token
+
+    def claim(self, token, notify=True):
+        """Return the transfer for a token once; expired or unknown tokens give None."""
+        with self.lock:
+            transfer = self.pending.pop(token, None)
+            valid = transfer is not None and transfer.expires >= time.monotonic()
+            if transfer and transfer.kind == 'upload' and self.uploads.get(transfer.name, (None,))[0] is transfer:
+                if valid and notify:
+                    self.uploads[transfer.name] = (transfer, float('inf'))  # Until end_upload()
+                else:
+                    del self.uploads[transfer.name]  # Expired, or claimed by another worker whose .part lock holds it
+        if transfer and notify and self.on_claim:
+            self.on_claim(token)
+        return transfer if valid else None
+
+    def prepare_upload(self, username, name, size, sha256=None):
+        """Reserve an upload; returns (token, offset) where offset is how much is already stored."""
+        if not self.valid_name(name):
+            raise ValueError(f"Invalid file name '{name}'")
+        if size < 0 or size > self.max_size:
+            raise ValueError(f"File size must be between 0 and {self.max_size} bytes")
+        if os.path.exists(self.path(name)):
+            raise ValueError(f"File '{name}' already exists")
+        try:
+            offset = min(os.path.getsize(self.path(name, PART_SUFFIX)), size)
+        except OSError:
+            offset = 0
+        now = time.monotonic()
+        transfer = Transfer('upload', username, name, size, sha256, offset, now + self.token_ttl)
+        with self.lock:
+            held = self.uploads.get(name)
+            if held and held[1] >= now:
+                raise ValueError(f"File '{name}' is already being uploaded")
+            self.uploads[name] = (transfer, transfer.expires)
+        return self.reserve(transfer), offset
+
+    def end_upload(self, transfer):
+        """Release the name reserved for an upload, finished or not."""
+        with self.lock:
+            if self.uploads.get(transfer.name, (None,))[0] is transfer:
+                del self.uploads[transfer.name]
+
+    def prepare_download(self, username, name, offset=0):
+        """Reserve a download; returns (token, size, checksum or None)."""
+        if not self.valid_name(name) or not os.path.isfile(self.path(name)):
+            raise ValueError(f"File '{name}' does not exist")
+        size = os.path.getsize(self.path(name))
+        if offset < 0 or offset > size:
+            raise ValueError(f"Offset must be between 0 and {size}")
+        sha256 = self.stored_checksum(name)
+        transfer = Transfer('download', username, name, size, sha256, offset, time.monotonic() + self.token_ttl)
+        return self.reserve(transfer), size, sha256
+
+    def open_upload(self, transfer):
+        """Open and lock the .part file at the resume offset, with a hash already fed the stored prefix.
+
+        Returns (None, None) if another upload of the same name holds the
+        lock, or has published the file or changed the .part file since this
+        one was reserved.
+        """
+        part = open(self.path(transfer.name, PART_SUFFIX), 'ab+')
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)  # Held until the file is closed
+            if os.path.exists(self.path(transfer.name)) or os.fstat(part.fileno()).st_size < transfer.offset:
+                raise BlockingIOError
+        except BlockingIOError:
+            part.close()
+            logging.info("Upload of %s by %s refused, another upload got there first", transfer.name,
+                         transfer.username)
+            return None, None
+        part.truncate(transfer.offset)
+        part.seek(0)
+        hasher = hashlib.sha256()
+        remaining = transfer.offset
+        while remaining:
+            chunk = part.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+        part.seek(transfer.offset)
+        return part, hasher
+
+    def finish_upload(self, transfer, part, hasher):
+        """Verify and publish a fully received upload; returns the reply for the data connection."""
+        digest = hasher.hexdigest()
+        try:  # Renamed while still locked, so no other upload can open the .part file in between
+            if transfer.sha256 and transfer.sha256.lower() != digest:
+                os.remove(self.path(transfer.name, PART_SUFFIX))
+                logging.warning("Checksum mismatch on upload of %s by %s", transfer.name, transfer.username)
+                return f"ERROR checksum mismatch, got {digest}"
+            os.replace(self.path(transfer.name, PART_SUFFIX), self.path(transfer.name))
+        finally:
+            part.close()
+        with open(self.path(transfer.name, CHECKSUM_SUFFIX), 'w') as f:
+            f.write(digest)
+        logging.info("Upload of %s (%d bytes) by %s complete", transfer.name, transfer.size, transfer.username)
+        return f"OK {digest}"
+
+    def receive_upload(self, transfer, sock):
+        """Blocking upload: stream socket data into the .part file with a reusable buffer."""
+        try:
+            part, hasher = self.open_upload(transfer)
+            if part is None:
+                return UPLOAD_CONFLICT
+            buffer = bytearray(CHUNK_SIZE)
+            view = memoryview(buffer)
+            received = transfer.offset
+            try:
+                while received < transfer.size:
+                    nbytes = sock.recv_into(view, min(CHUNK_SIZE, transfer.size - received))
+                    if not nbytes:
+                        logging.info("Upload of %s interrupted at %d bytes", transfer.name, received)
+                        part.close()
+                        return None
+                    part.write(view[:nbytes])
+                    hasher.update(view[:nbytes])
+                    received += nbytes
+            except BaseException:
+                part.close()
+                raise
+            part.flush()
+            return self.finish_upload(transfer, part, hasher)
+        finally:
+            self.end_upload(transfer)
+
+    def send_download(self, transfer, sock):
+        """Blocking download using zero-copy sendfile()."""
+        count = transfer.size - transfer.offset
+        if not count:
+            return 0  # sendfile() reads a zero count as "to the end of the file"
+        with open(self.path(transfer.name), 'rb') as f:
+            return sock.sendfile(f, transfer.offset, count)
+
+    async def receive_upload_async(self, transfer, loop, reader):
+        try:
+            # Re-hashing the prefix of a resumed upload can read GBs; do it off the loop
+            part, hasher = await loop.run_in_executor(None, self.open_upload, transfer)
+            if part is None:
+                return UPLOAD_CONFLICT
+            received = transfer.offset
+            try:
+                while received < transfer.size:
+                    chunk = await reader.read(min(CHUNK_SIZE, transfer.size - received))
+                    if not chunk:
+                        logging.info("Upload of %s interrupted at %d bytes", transfer.name, received)
+                        part.close()
+                        return None
+                    part.write(chunk)
+                    hasher.update(chunk)
+                    received += len(chunk)
+            except BaseException:
+                part.close()
+                raise
+            part.flush()
+            return self.finish_upload(transfer, part, hasher)
+        finally:
+            self.end_upload(transfer)
+
+    async def send_download_async(self, transfer, loop, writer):
+        """Download through the event loop's sendfile(), which uses os.sendfile() where available."""
+        count = transfer.size - transfer.offset
+        if not count:
+            return 0
+        with open(self.path(transfer.name), 'rb') as f:
+            sent = await loop.sendfile(writer.transport, f, transfer.offset, count)
+        await writer.drain()
+        return sent
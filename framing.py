@@ -0,0 +1,179 @@
+import os
+import struct
+
+from compression import COMPRESSED, inflate
+
+# Every frame is a 4-byte big-endian payload length followed by the UTF-8 payload (or, with the COMPRESSED
+# bit set in the length, by that payload compressed, see compression.py)
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Appended to the login choice ("admin +framed") to switch the connection to framed mode
+FRAMED_OPTION = '+framed'
+
+# Most buffers one sendmsg() call accepts
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def encode_frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+def sendall_parts(sock, parts):
+    """Write a list of buffers with scatter/gather sendmsg, retrying after partial writes."""
+    parts = [memoryview(part) for part in parts]
+    index = 0
+    while index < len(parts):
+        sent = sock.sendmsg(parts[index:index + IOV_MAX])
+        while index < len(parts) and sent >= len(parts[index]):
+            sent -= len(parts[index])
+            index += 1
+        if sent:
+            parts[index] = parts[index][sent:]
+
+
+def frame_parts(items, compressor=None):
+    """Interleave length headers with payloads, ready for one gathered write."""
+    parts = []
+    for data in items:
+        packed = compressor.compress(data) if compressor else None
+        if packed is None:
+            parts.append(HEADER.pack(len(data)))
+            parts.append(data)
+        else:
+            parts.append(HEADER.pack(len(packed) | COMPRESSED))
+            parts.append(packed)
+    return parts
+
+
+def frame_length(value):
+    """Split a length header into (payload length, compressed), enforcing MAX_FRAME_SIZE."""
+    length = value & ~COMPRESSED
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return length, bool(value & COMPRESSED)
+
+
+class FrameBuffer:
+    """Reusable receive buffer that splits a byte stream into length-prefixed frames.
+
+    Socket data is read straight into the bytearray through a memoryview, so one
+    recv can yield many small frames and a large frame needs only as many reads
+    as the kernel hands over, without any intermediate string joins.
+    """
+
+    __slots__ = ('buf', 'start', 'end', 'size')
+
+    def __init__(self, size=4096):
+        self.size = size  # Starting size, returned to once a large frame has been consumed
+        self.buf = bytearray(size)
+        self.start = 0  # First unparsed byte
+        self.end = 0    # One past the last received byte
+
+    def writable(self, min_free=4096):
+        """Return a memoryview over the free tail of the buffer, compacting or growing it first."""
+        min_free = max(min_free, 4096)
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > self.size and min_free <= self.size:
+                self.buf = bytearray(self.size)  # Don't keep a buffer sized for the largest frame ever seen
+        if len(self.buf) - self.end < min_free:
+            pending = self.end - self.start
+            if self.start:
+                self.buf[:pending] = self.buf[self.start:self.end]
+                self.start, self.end = 0, pending
+            if len(self.buf) - self.end < min_free:
+                self.buf.extend(bytes(max(min_free, len(self.buf))))
+        return memoryview(self.buf)[self.end:]
+
+    def commit(self, nbytes):
+        self.end += nbytes
+
+    def next_frame(self):
+        """Pop the next complete frame payload, or return None if more data is needed."""
+        available = self.end - self.start
+        if available < HEADER.size:
+            return None
+        length, compressed = frame_length(HEADER.unpack_from(self.buf, self.start)[0])
+        if available < HEADER.size + length:
+            return None
+        begin = self.start + HEADER.size
+        self.start = begin + length
+        if compressed:
+            return inflate(memoryview(self.buf)[begin:self.start], MAX_FRAME_SIZE)
+        return bytes(self.buf[begin:self.start])
+
+    def missing(self):
+        """Bytes still needed to complete the frame at the head of the buffer."""
+        available = self.end - self.start
+        if available < HEADER.size:
+            return HEADER.size - available
+        length, _ = frame_length(HEADER.unpack_from(self.buf, self.start)[0])
+        return HEADER.size + length - available
+
+
+class FramedSocket:
+    """Blocking socket wrapper that speaks raw text until framing is negotiated.
+
+    send() and recv() keep the plain socket signatures so existing callers work
+    in both modes; in framed mode recv() returns exactly one message. Other
+    attributes (close, shutdown, connect, ...) are delegated to the socket.
+    Compressed frames are always understood on receive; large outgoing ones
+    are compressed once enable_compression() is called.
+    """
+
+    __slots__ = ('sock', 'framed', 'frames', 'compressor')
+
+    def __init__(self, sock, framed=False):
+        self.sock = sock
+        self.framed = False
+        self.frames = None  # Allocated on negotiation so raw connections don't pay for it
+        self.compressor = None
+        if framed:
+            self.enable_framing()
+
+    def enable_framing(self):
+        self.framed = True
+        if self.frames is None:
+            self.frames = FrameBuffer()
+
+    def enable_compression(self, compressor):
+        self.compressor = compressor
+
+    def send(self, data):
+        if not self.framed:
+            self.sock.sendall(data)
+        else:
+            # The header goes out alongside the caller's buffer, so shared payloads are never copied
+            sendall_parts(self.sock, frame_parts([data], self.compressor))
+        return len(data)
+
+    def send_batch(self, items):
+        """Write several frames with one sendmsg() call (more only after partial writes).
+
+        Raw text has no delimiter, so there each payload still gets its own
+        write, as clients that read one message per recv() expect.
+        """
+        if not self.framed:
+            for data in items:
+                self.sock.sendall(data)
+        else:
+            sendall_parts(self.sock, frame_parts(items, self.compressor))
+
+    def recv(self, bufsize=1024):
+        if not self.framed:
+            return self.sock.recv(bufsize)
+        while True:
+            frame = self.frames.next_frame()
+            if frame is not None:
+                return frame
+            nbytes = self.sock.recv_into(self.frames.writable(self.frames.missing()))
+            if not nbytes:
+                return b''
+            self.frames.commit(nbytes)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
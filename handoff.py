@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import socket
+import threading
+
+# Largest handoff message; a client's unread input travels in its message, base64 encoded
+MAX_MESSAGE_SIZE = 1024 * 1024
+MAX_UNREAD_BYTES = 64 * 1024  # Clients with more input buffered than this are asked to reconnect instead
+
+
+def send_message(sock, message, fds=()):
+    socket.send_fds(sock, [json.dumps(message).encode('utf-8')], list(fds))
+
+
+def recv_message(sock):
+    data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE_SIZE, 1)
+    if not data:
+        for fd in fds:
+            os.close(fd)
+        raise ConnectionError("Handoff connection closed")
+    return json.loads(data), fds
+
+
+class HandoffListener:
+    """Unix socket where a new server process asks this one to hand over and exit.
+
+    Messages are JSON in SOCK_SEQPACKET packets, each carrying at most one
+    file descriptor. The successor sends {"type": "takeover"}; the running
+    server answers with the listening socket ("listener"), then one
+    "client" message per connection it can pass on, with the connection's
+    socket and session state, then "handed_over". The successor starts
+    serving at that point, while this process drains its other clients; it
+    sends "done" once its rooms, bans and history are in the database. The
+    socket file is only accessible to the user running the server.
+    """
+
+    def __init__(self, path, on_takeover):
+        self.path = path
+        self.on_takeover = on_takeover  # Called with (connection, request) on the listener thread
+        if os.path.exists(path):
+            os.remove(path)  # Left by the process we took over from, or by a crash
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(path)
+        os.chmod(path, 0o600)
+        self.sock.listen(1)
+
+    def start(self):
+        threading.Thread(target=self.accept_loop, name="handoff", daemon=True).start()
+        logging.info(f"Accepting hot restart requests on {self.path}")
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+                request, _ = recv_message(conn)
+            except (OSError, ValueError) as e:
+                logging.error(f"Bad hot restart request: {e}")
+                continue
+            if request.get('type') == 'takeover':
+                logging.info("A new server process is taking over")
+                self.on_takeover(conn, request)
+                return
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class Takeover:
+    """What the previous server process handed over: its listening socket and live connections."""
+
+    def __init__(self, connection):
+        self.connection = connection  # Stays open until the previous process has stored its state
+        self.listener = None
+        self.clients = []  # (session state, connected socket)
+
+    def wait_until_stored(self, on_stored):
+        """Call `on_stored` from a background thread once the previous process has stored its state."""
+        threading.Thread(target=self.wait_for_done, args=(on_stored,), name="handoff", daemon=True).start()
+
+    def wait_for_done(self, on_stored):
+        self.connection.settimeout(None)  # It may take the whole drain timeout
+        try:
+            while recv_message(self.connection)[0]['type'] != 'done':
+                pass
+            logging.info("The previous server process has stored its state")
+        except (OSError, ValueError) as e:
+            logging.warning(f"The previous server process ended without confirming its state was stored: {e}")
+        finally:
+            self.connection.close()
+        on_stored()
+
+
+def request_takeover(path, adopt_clients=True, timeout=60.0):
+    """Take over from the server listening at `path`; returns once it has handed over its socket and clients."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.settimeout(timeout)
+    sock.connect(path)
+    takeover = Takeover(sock)
+    try:
+        send_message(sock, {'type': 'takeover', 'clients': adopt_clients})
+        while True:
+            message, fds = recv_message(sock)
+            kind = message['type']
+            if kind == 'listener':
+                takeover.listener = socket.socket(fileno=fds[0])
+            elif kind == 'client':
+                takeover.clients.append((message['state'], socket.socket(fileno=fds[0])))
+            elif kind == 'handed_over':
+                break
+        if takeover.listener is None:
+            raise ConnectionError("The running server did not hand over its listening socket")
+    except Exception:
+        sock.close()
+        raise
+    logging.info(f"Took over the listening socket and {len(takeover.clients)} connections")
+    return takeover
@@ -0,0 +1,129 @@
+import collections
+import logging
+import queue
+import threading
+import time
+
+from db import DatabaseError
+
+# History key for chat lines sent by users who are not in any room
+LOBBY = 'lobby'
+
+
+class MessageStore:
+    """Asynchronous message persistence with an in-memory ring buffer per room.
+
+    record() only appends to the room's ring buffer and to a queue, so delivery
+    never waits on the database. A writer thread drains the queue and stores
+    messages with one multi-row INSERT per batch. Recent history for a room is
+    served from its ring buffer; the database is read once per room, the first
+    time its history is asked for, to cover messages from before a restart.
+    Every message recorded, stored here or not, is also handed to `index`
+    (a search.SearchIndex) when there is one.
+    """
+
+    def __init__(self, db, ring_size=200, batch_size=500, flush_interval=0.5, max_pending=100000, index=None):
+        self.db = db
+        self.index = index
+        self.ring_size = ring_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(max_pending)
+        self.rings = {}     # room -> deque of (created_at, sender, body)
+        self.warm = set()   # Rooms whose ring buffer already includes stored history
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.run_writer, name="message-writer", daemon=True)
+        self.writer.start()
+
+    def record(self, room, sender, body, recipient=None, persist=True, created_at=None):
+        """Remember a message; persist=False only fills the ring (another shard stores the row)."""
+        created_at = created_at or time.time()
+        if room is not None:
+            with self.lock:
+                ring = self.rings.get(room)
+                if ring is None:
+                    ring = self.rings[room] = collections.deque(maxlen=self.ring_size)
+                ring.append((created_at, sender, body))
+        if self.index:
+            self.index.add(room, sender, body, recipient, created_at)
+        if not persist:
+            return
+        try:
+            self.pending.put_nowait((room, sender, recipient, body, created_at))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logging.warning(f"Message store backlog full, {self.dropped} messages not persisted")
+
+    def is_warm(self, room):
+        return room in self.warm
+
+    def load(self, room):
+        """Merge the room's stored history into its ring buffer (blocking, first read only)."""
+        if room in self.warm:
+            return
+        try:
+            rows = self.db.fetchall(
+                "SELECT created_at, sender, body FROM messages WHERE room=%s ORDER BY id DESC LIMIT %s",
+                (room, self.ring_size))
+        except DatabaseError as err:
+            logging.error(f"Could not load history for room {room}: {err}")
+            return
+        with self.lock:
+            ring = self.rings.get(room, ())
+            # Messages recorded since startup may not be flushed yet, so keep them and skip their stored copies
+            oldest_live = ring[0][0] if ring else float('inf')
+            stored = [tuple(row) for row in reversed(rows) if row[0] < oldest_live]
+            merged = collections.deque(stored, maxlen=self.ring_size)
+            merged.extend(ring)
+            self.rings[room] = merged
+            self.warm.add(room)
+
+    def recent(self, room, count):
+        with self.lock:
+            ring = self.rings.get(room, ())
+            return list(ring)[-count:] if count > 0 else []
+
+    def cool(self):
+        """Read every room's stored history again on its next request, e.g. after another process added to it."""
+        with self.lock:
+            self.warm.clear()
+
+    def forget(self, room):
+        with self.lock:
+            self.rings.pop(room, None)
+            self.warm.discard(room)
+
+    def run_writer(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        try:
+            self.db.executemany(
+                "INSERT INTO messages (room, sender, recipient, body, created_at) VALUES (%s, %s, %s, %s, %s)",
+                batch)
+        except DatabaseError as err:
+            logging.error(f"Failed to persist {len(batch)} messages: {err}")
+
+    def flush(self):
+        """Write out everything queued so far (used on shutdown)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.write_batch(batch)
@@ -0,0 +1,86 @@
+import logging
+import time
+
+# Sent to a client that has been quiet for ping_interval; any reply (normally "/pong") counts as activity
+PING = "PING"
+
+
+class ConnectionMonitor:
+    """Login timeouts, heartbeats and idle eviction, driven by the server's Scheduler.
+
+    Each connection has at most one pending timer, set for its next deadline
+    (login timeout, PING due, idle timeout). Receiving a message only stores
+    a timestamp; the timer notices the activity when it fires and re-arms
+    itself, so busy connections never touch the timer heap.
+    """
+
+    def __init__(self, scheduler, call_soon, login_timeout=30.0, ping_interval=60.0, idle_timeout=180.0,
+                 metrics=None):
+        self.scheduler = scheduler
+        self.call_soon = call_soon  # Runs the check where the connection may be used (the event loop in async mode)
+        self.login_timeout = login_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics
+
+    def watch(self, session):
+        self.arm(session, self.login_timeout or None)
+        return session
+
+    def logged_in(self, session):
+        session.authenticated = True
+        session.touch()
+        if session.timer is None:
+            # Otherwise the pending login timer re-arms for the heartbeat when it fires
+            self.arm(session, self.next_deadline(session))
+
+    def stop(self, session):
+        session.closed = True
+        if session.timer:
+            session.timer.cancel()
+
+    def arm(self, session, delay):
+        if session.timer:
+            session.timer.cancel()
+        session.timer = None
+        if delay is None or session.closed:
+            return
+        session.timer = self.scheduler.schedule(delay, self.call_soon, self.check, session)
+
+    def next_deadline(self, session):
+        """Seconds until the next thing to check on this connection, or None if nothing is enabled."""
+        now = time.monotonic()
+        if not session.authenticated:
+            return max(0.0, session.started + self.login_timeout - now) if self.login_timeout else None
+        deadlines = []
+        if self.idle_timeout:
+            deadlines.append(session.last_seen + self.idle_timeout)
+        if self.ping_interval and session.pinged != session.last_seen:
+            deadlines.append(session.last_seen + self.ping_interval)
+        return max(0.0, min(deadlines) - now) if deadlines else None
+
+    def check(self, session):
+        if session.closed:
+            return
+        now = time.monotonic()
+        if not session.authenticated:
+            if self.login_timeout and now - session.started >= self.login_timeout:
+                self.evict(session, 'login', "Login timed out.")
+                return
+        else:
+            idle = now - session.last_seen
+            if self.idle_timeout and idle >= self.idle_timeout:
+                self.evict(session, 'idle', f"Disconnected after {int(idle)}s without activity.")
+                return
+            if self.ping_interval and idle >= self.ping_interval and session.pinged != session.last_seen:
+                session.pinged = session.last_seen
+                session.conn.send(PING.encode('utf-8'), block=False)
+        self.arm(session, self.next_deadline(session))
+
+    def evict(self, session, reason, message):
+        logging.info(f"Closing connection: {reason} timeout")
+        if self.metrics:
+            self.metrics.inc(f"connections.evicted.{reason}")
+        session.closed = True
+        session.conn.send(message.encode('utf-8'), block=False)
+        session.conn.hangup()
@@ -0,0 +1,79 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+listener = None  # QueueListener started by configure_logging(), if any
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that hands the raw record to the listener thread.
+
+    The stock prepare() formats the message in the calling thread; here the
+    %-style arguments are merged and written out by the listener instead.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=logging.INFO, queued=True):
+    """Route all logging through a background listener so client threads never block on log I/O."""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if not queued:
+        logging.basicConfig(level=level, handlers=[stream_handler], force=True)
+        return None
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=level, handlers=[DeferredQueueHandler(log_queue)], force=True)
+    global listener
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
+    return listener
+
+
+def stop_logging():
+    """Write out every queued record; for processes that leave with os._exit(), which skips atexit."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+    logging.shutdown()
+
+
+class LogSampler:
+    """Token bucket for per-message log lines: at most `rate` lines per second, the rest are counted.
+
+    allow() returns False straight away when the logger would drop the line
+    anyway, so a disabled debug log costs one cached level check.
+    """
+
+    def __init__(self, rate=10.0, level=logging.DEBUG, logger=None):
+        self.rate = rate
+        self.level = level
+        self.logger = logger or logging.getLogger()
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.logger.isEnabledFor(self.level):
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                if self.suppressed:
+                    self.logger.log(self.level, "%d message log lines suppressed by rate limit", self.suppressed)
+                    self.suppressed = 0
+                return True
+            self.suppressed += 1
+            return False
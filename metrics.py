@@ -0,0 +1,234 @@
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Counter:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """Fixed log2 buckets from 1us to ~2 minutes; percentiles are bucket upper bounds capped at the max."""
+
+    BOUNDS = tuple(1e-6 * 2 ** i for i in range(28))
+
+    __slots__ = ('counts', 'count', 'total', 'max', 'lock')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.BOUNDS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return 0.0
+
+    def snapshot(self):
+        with self.lock:
+            if not self.count:
+                return {'count': 0}
+            return {
+                'count': self.count,
+                'mean_ms': round(1000 * self.total / self.count, 3),
+                'p50_ms': round(1000 * self.percentile(0.50), 3),
+                'p99_ms': round(1000 * self.percentile(0.99), 3),
+                'max_ms': round(1000 * self.max, 3),
+            }
+
+
+class Metrics:
+    """Named counters, latency histograms and on-demand gauges for the running server."""
+
+    def __init__(self):
+        self.counters = collections.defaultdict(Counter)
+        self.histograms = collections.defaultdict(Histogram)
+        self.gauges = {}  # name -> zero-argument callable, evaluated at snapshot time
+        self.started = time.time()
+
+    def inc(self, name, amount=1):
+        self.counters[name].inc(amount)
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[name].observe(time.perf_counter() - started)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def snapshot(self):
+        gauges = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'counters': {name: counter.snapshot() for name, counter in sorted(self.counters.items())},
+            'gauges': gauges,
+            'histograms': {name: hist.snapshot() for name, hist in sorted(self.histograms.items())},
+        }
+
+    def format(self):
+        snapshot = self.snapshot()
+        lines = [f"uptime: {snapshot['uptime_seconds']}s"]
+        lines += [f"{name}: {value}" for name, value in snapshot['counters'].items()]
+        lines += [f"{name}: {value}" for name, value in snapshot['gauges'].items()]
+        for name, hist in snapshot['histograms'].items():
+            lines.append(f"{name}: " + ", ".join(f"{key}={value}" for key, value in hist.items()))
+        return "\n".join(lines)
+
+
+class SamplingProfiler:
+    """Statistical profiler that samples every thread's stack from a background thread.
+
+    It can be switched on and off while the server runs; sampling costs nothing
+    while it is stopped and only a few microseconds per interval while running.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread = None
+        self.running = threading.Event()
+        self.self_samples = collections.Counter()   # Innermost frame only
+        self.total_samples = collections.Counter()  # Any frame on the stack
+        self.samples = 0
+
+    def start(self, interval=None):
+        if self.thread and self.thread.is_alive():
+            return False
+        if interval:
+            self.interval = interval
+        self.self_samples.clear()
+        self.total_samples.clear()
+        self.samples = 0
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+        logging.info(f"Sampling profiler started ({self.interval * 1000:.1f} ms interval)")
+        return True
+
+    def stop(self):
+        self.running.clear()
+        if self.thread:
+            self.thread.join()
+            logging.info(f"Sampling profiler stopped after {self.samples} samples")
+
+    def run(self):
+        own_id = threading.get_ident()
+        while self.running.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self.self_samples[self.describe(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    key = self.describe(frame)
+                    if key not in seen:
+                        seen.add(key)
+                        self.total_samples[key] += 1
+                    frame = frame.f_back
+            self.samples += 1
+            time.sleep(self.interval)
+
+    @staticmethod
+    def describe(frame):
+        code = frame.f_code
+        return f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno} {code.co_name}"
+
+    def report(self, top=15):
+        return {
+            'samples': self.samples,
+            'running': self.running.is_set(),
+            'self': self.self_samples.most_common(top),
+            'total': self.total_samples.most_common(top),
+        }
+
+    def format(self, top=15):
+        report = self.report(top)
+        lines = [f"Profiler {'running' if report['running'] else 'stopped'}, {report['samples']} samples",
+                 "Self:"]
+        lines += [f"  {count:6d}  {name}" for name, count in report['self']]
+        lines.append("Total:")
+        lines += [f"  {count:6d}  {name}" for name, count in report['total']]
+        return "\n".join(lines)
+
+
+class StatsServer:
+    """Local HTTP endpoint: GET /stats, /profile, /profile/start and /profile/stop return JSON."""
+
+    def __init__(self, metrics, profiler, host='127.0.0.1', port=5556):
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/stats':
+                    body = outer.metrics.snapshot()
+                elif self.path == '/profile/start':
+                    body = {'started': outer.profiler.start()}
+                elif self.path == '/profile/stop':
+                    outer.profiler.stop()
+                    body = outer.profiler.report()
+                elif self.path == '/profile':
+                    body = outer.profiler.report()
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.metrics = metrics
+        self.profiler = profiler
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="stats-server", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logging.info(f"Stats endpoint on http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}/stats")
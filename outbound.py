@@ -0,0 +1,247 @@
+import collections
+import logging
+import socket
+import threading
+import time
+
+# What to do when a client's outbound queue is full
+DROP_OLDEST = 'drop_oldest'    # Discard the oldest queued message to make room
+DISCONNECT = 'disconnect'      # Drop the slow client
+BACKPRESSURE = 'backpressure'  # Make the sender wait for room, disconnecting after a timeout
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DISCONNECT, BACKPRESSURE)
+
+# Seconds a QueuedSocket's writer thread waits for more output before exiting
+WRITER_IDLE_TIMEOUT = 10.0
+
+# TCP options for client sockets. The writers already coalesce queued messages, so Nagle mostly adds delay
+NODELAY = 'nodelay'  # TCP_NODELAY: each batch goes out immediately
+NAGLE = 'nagle'      # Leave Nagle's algorithm on
+CORK = 'cork'        # TCP_NODELAY, plus TCP_CORK around each batch so it leaves in full segments (Linux)
+TCP_MODES = (NODELAY, NAGLE, CORK)
+
+
+def configure_tcp(sock, mode):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0 if mode == NAGLE else 1)
+
+
+def set_cork(sock, corked):
+    if hasattr(socket, 'TCP_CORK'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if corked else 0)
+
+
+class OutboundQueue:
+    """Bounded per-client queue of encoded payloads waiting to be written.
+
+    Payloads are shared bytes objects, so a broadcast costs one encode and one
+    deque append per recipient no matter how slow the recipient's link is.
+    Writers take everything queued at once and, on framed connections, send
+    it in one call; with flush_delay set they wait up to that long for a
+    batch to reach flush_bytes, trading a bounded delay for fewer, fuller
+    writes.
+
+    Independently of the message count, a client whose queued bytes stay
+    over byte_limit for byte_limit_grace seconds is disconnected.
+    """
+    __slots__ = ('maxlen', 'policy', 'block_timeout', 'flush_delay', 'flush_bytes', 'items', 'nbytes', 'byte_limit',
+                 'byte_limit_grace', 'over_limit_since', 'cond', 'closed', 'dropped', 'on_ready')
+
+    def __init__(self, maxlen=1024, policy=DROP_OLDEST, block_timeout=1.0, flush_delay=0.0, flush_bytes=65536,
+                 byte_limit=None, byte_limit_grace=10.0):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.maxlen = maxlen
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        self.items = collections.deque()
+        self.nbytes = 0  # Total size of the queued payloads
+        self.byte_limit = byte_limit
+        self.byte_limit_grace = byte_limit_grace
+        self.over_limit_since = None
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.on_ready = None  # Optional callback for writers that don't block in get()
+
+    def __len__(self):
+        return len(self.items)
+
+    def full(self):
+        return len(self.items) >= self.maxlen
+
+    def put(self, data, block=True):
+        """Queue a payload. Returns False if the client should be disconnected.
+
+        With block=False the backpressure policy lets the queue run over its
+        limit (up to twice maxlen) and leaves the waiting to the caller.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if self.byte_limit and self.nbytes > self.byte_limit:
+                now = time.monotonic()
+                if self.over_limit_since is None:
+                    self.over_limit_since = now
+                elif now - self.over_limit_since > self.byte_limit_grace:
+                    return False
+            if self.full():
+                if self.policy == DROP_OLDEST:
+                    self.nbytes -= len(self.items.popleft())
+                    self.dropped += 1
+                elif self.policy == DISCONNECT:
+                    return False
+                elif block:
+                    if not self.cond.wait_for(lambda: self.closed or not self.full(), self.block_timeout):
+                        return False
+                    if self.closed:
+                        return False
+                elif len(self.items) >= 2 * self.maxlen:
+                    return False
+            self.items.append(data)
+            self.nbytes += len(data)
+            self.cond.notify_all()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def get(self, timeout=None):
+        """Block until a payload is available; returns None once closed and empty."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.items or self.closed, timeout)
+            if not self.items:
+                return None
+            data = self.items.popleft()
+            self.nbytes -= len(data)
+            if self.over_limit_since and self.nbytes <= self.byte_limit:
+                self.over_limit_since = None
+            self.cond.notify_all()
+            return data
+
+    def get_batch(self, timeout=None):
+        """Wait up to `timeout` for a payload, then take everything queued; None if none came or closed and empty."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.items or self.closed, timeout)
+            if not self.items:
+                return None
+            if self.flush_delay and self.nbytes < self.flush_bytes:
+                self.cond.wait_for(lambda: self.closed or self.nbytes >= self.flush_bytes, self.flush_delay)
+            return self.pop_all()
+
+    def pop_all(self):
+        with self.cond:
+            items = list(self.items)
+            self.items.clear()
+            self.nbytes = 0
+            self.over_limit_since = None
+            self.cond.notify_all()
+            return items
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.on_ready:
+            self.on_ready()
+
+
+class QueuedSocket:
+    """Socket wrapper whose send() only enqueues; a writer thread does the blocking writes.
+
+    A stalled reader therefore only fills its own queue instead of holding up
+    the thread that is broadcasting. The writer thread is started when there
+    is something to send and exits after writer_idle seconds without output,
+    so idle clients cost one thread instead of two. Other attributes (recv,
+    enable_framing, ...) are delegated to the wrapped socket.
+    """
+    __slots__ = ('sock', 'queue', 'metrics', 'cork', 'closed', 'writer', 'writer_idle', 'session')
+
+    def __init__(self, sock, maxlen=1024, policy=DROP_OLDEST, block_timeout=1.0, metrics=None,
+                 flush_delay=0.0, flush_bytes=65536, cork=False, byte_limit=None, byte_limit_grace=10.0,
+                 writer_idle=WRITER_IDLE_TIMEOUT):
+        self.sock = sock
+        self.queue = OutboundQueue(maxlen, policy, block_timeout, flush_delay, flush_bytes,
+                                   byte_limit, byte_limit_grace)
+        self.metrics = metrics
+        self.cork = cork
+        self.closed = False
+        self.session = None
+        self.writer = None
+        self.writer_idle = writer_idle
+        self.queue.on_ready = self.wake_writer
+
+    def send(self, data, block=True):
+        """Queue data for the writer thread.
+
+        Background threads (the Scheduler) pass block=False so one congested
+        client can't stall them: under the backpressure policy the message is
+        queued over the limit, and the client dropped if that is full too.
+        """
+        if not self.queue.put(data, block) and not self.queue.closed:
+            logging.warning(f"Disconnecting slow client: {len(self.queue)} messages "
+                            f"({self.queue.nbytes} bytes) waiting to be sent")
+            if self.metrics:
+                self.metrics.inc('connections.evicted.slow')
+            self.abort()
+        return len(data)
+
+    def wake_writer(self):
+        with self.queue.cond:
+            if self.writer is None and self.queue.items:
+                self.writer = threading.Thread(target=self.run_writer, daemon=True)
+                self.writer.start()
+
+    def run_writer(self):
+        while True:
+            items = self.queue.get_batch(self.writer_idle)
+            if items is None:
+                with self.queue.cond:
+                    if self.queue.items:
+                        continue  # Queued just after the wait timed out
+                    self.writer = None
+                    return
+            cork = self.cork and self.sock.framed  # Corking would merge raw messages the client reads apart
+            try:
+                if cork:
+                    set_cork(self.sock, True)
+                self.sock.send_batch(items)
+                if cork:
+                    set_cork(self.sock, False)
+            except OSError:
+                self.abort()
+                break
+            if self.metrics:
+                self.metrics.inc('writes.batches', 1 if self.sock.framed else len(items))
+                self.metrics.inc('messages.out', len(items))
+                self.metrics.inc('bytes.out', sum(len(data) for data in items))
+
+    def abort(self):
+        """Stop writing and unblock the reader thread so the client is cleaned up."""
+        self.queue.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def hangup(self):
+        """End the session from the server side: the reader sees EOF, queued messages still go out."""
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def close(self, flush=False):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        writer = self.writer
+        if flush and writer is not None and writer is not threading.current_thread():
+            writer.join(self.queue.block_timeout)
+        else:
+            self.queue.pop_all()
+        self.abort()
+        self.sock.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
@@ -0,0 +1,118 @@
+import bisect
+import collections
+import itertools
+import threading
+
+
+class PresenceService:
+    """Who is online, on this shard and on the others, with a version number that counts every change.
+
+    Names are kept sorted, so a page of the user list, with or without a
+    name prefix, costs a binary search plus the page itself instead of
+    joining every name. The last `history` changes are kept, and
+    changes_since() answers with the net joins and leaves after a version a
+    client already has. Changes are also collected for `interval` seconds
+    and handed to `notify` as one batch, which the server announces with a
+    single line per client instead of one broadcast per login or logout.
+    Versions are local to one server process.
+    """
+
+    def __init__(self, scheduler, notify=None, interval=1.0, history=10000):
+        self.scheduler = scheduler
+        self.notify = notify  # Called with (version, joined, left) once per interval that had changes
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.online = {}     # username -> shard
+        self.names = []      # Sorted usernames
+        self.version = 0
+        self.changes = collections.deque(maxlen=history)  # (version, username, joined); versions are consecutive
+        self.pending = {}    # username -> joined, net change since the last batch
+        self.scheduled = False
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, username):
+        return username in self.online
+
+    def shard_of(self, username):
+        return self.online.get(username)
+
+    def join(self, username, shard, announce=True):
+        with self.lock:
+            if username in self.online:
+                self.online[username] = shard  # Moved to another shard; still online
+                return False
+            self.online[username] = shard
+            bisect.insort(self.names, username)
+            self.record(username, True, announce)
+            return True
+
+    def leave(self, username, shard=None):
+        """Mark a user offline; with `shard`, only if that is still where they are connected."""
+        with self.lock:
+            if username not in self.online or shard is not None and self.online[username] != shard:
+                return False
+            del self.online[username]
+            del self.names[bisect.bisect_left(self.names, username)]
+            self.record(username, False)
+            return True
+
+    def drop_shard(self, shard):
+        """Mark everyone connected to a shard that went away offline."""
+        with self.lock:
+            gone = [username for username, where in self.online.items() if where == shard]
+        for username in gone:
+            self.leave(username, shard)
+        return len(gone)
+
+    def record(self, username, joined, announce=True):
+        self.version += 1
+        self.changes.append((self.version, username, joined))
+        if not announce:
+            return
+        if username in self.pending:
+            del self.pending[username]  # Joined and left again (or the reverse) within one batch: nothing to announce
+        else:
+            self.pending[username] = joined
+        if self.notify and not self.scheduled:
+            self.scheduled = True
+            self.scheduler.schedule(self.interval, self.flush)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.scheduled = False
+            version = self.version
+        if batch:
+            self.notify(version, sorted(username for username, state in batch.items() if state),
+                        sorted(username for username, state in batch.items() if not state))
+
+    def page(self, prefix="", offset=0, limit=100):
+        """Return (version, names, total matching) for one page of users whose names start with `prefix`."""
+        with self.lock:
+            start = bisect.bisect_left(self.names, prefix)
+            end = bisect.bisect_left(self.names, prefix_end(prefix)) if prefix else len(self.names)
+            return self.version, self.names[start + offset:min(start + offset + limit, end)], end - start
+
+    def changes_since(self, version):
+        """Return (version, joined, left) after `version`, or None if it is older than the kept history."""
+        with self.lock:
+            if version >= self.version:
+                return self.version, [], []
+            oldest = self.changes[0][0] if self.changes else self.version + 1
+            if version < oldest - 1 or version < 0:
+                return None
+            before = {}  # username -> online at `version`
+            after = {}
+            for _, username, joined in itertools.islice(self.changes, version + 1 - oldest, None):
+                before.setdefault(username, not joined)
+                after[username] = joined
+            joined = sorted(username for username, state in after.items() if state and not before[username])
+            left = sorted(username for username, state in after.items() if not state and before[username])
+            return self.version, joined, left
+
+
+def prefix_end(prefix):
+    """Smallest string greater than every string starting with `prefix`."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
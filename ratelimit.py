@@ -0,0 +1,96 @@
+import threading
+import time
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+
+
+class RateLimiter:
+    """Token buckets keyed by username or source address.
+
+    Each key may spend `burst` tokens at once and earns back `rate` tokens a
+    second. Buckets are refilled lazily when a key is checked, and sweep()
+    drops the ones that have filled up again, so memory only follows the
+    clients that were active recently. A rate of 0 disables the limit.
+    Limits on something that already has a per-connection object keep the
+    bucket there instead (see bucket() and spend()), skipping the dictionary.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.limited = 0  # Requests refused so far
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def bucket(self):
+        """A full bucket for the caller to keep, or None when the limit is disabled."""
+        return TokenBucket(self.burst, time.monotonic()) if self.rate else None
+
+    def allow(self, key, cost=1.0):
+        if not self.rate:
+            return True
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.burst, time.monotonic())
+            return self.take(bucket, cost)
+
+    def spend(self, bucket, cost=1.0):
+        """Like allow() for a bucket from bucket(); the caller makes sure only one thread uses it."""
+        return bucket is None or self.take(bucket, cost)
+
+    def take(self, bucket, cost):
+        now = time.monotonic()
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if bucket.tokens < cost:
+            self.limited += 1
+            return False
+        bucket.tokens -= cost
+        return True
+
+    def sweep(self):
+        """Forget keys whose buckets are full again; they behave exactly like new ones."""
+        if not self.rate:
+            return
+        now = time.monotonic()
+        with self.lock:
+            full = [key for key, bucket in self.buckets.items()
+                    if bucket.tokens + (now - bucket.updated) * self.rate >= self.burst]
+            for key in full:
+                del self.buckets[key]
+
+
+class AdmissionControl:
+    """Cap on logins being processed at once.
+
+    A slot covers only the credential check (database and password hashing),
+    not the prompts before it. During a reconnect storm the clients over the
+    cap are turned away with a reply once they have sent their credentials,
+    before they reach the database, instead of queueing behind everyone else.
+    """
+
+    def __init__(self, limit=256):
+        self.limit = limit
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def try_enter(self):
+        with self.lock:
+            if self.limit and self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
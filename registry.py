@@ -0,0 +1,72 @@
+import threading
+
+
+class _Shard:
+    __slots__ = ('lock', 'sessions', 'snapshot')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.snapshot = ()  # Immutable copy of sessions.items(), rebuilt lazily after a write
+
+
+class SessionRegistry:
+    """Username -> client connection map shared by every client thread.
+
+    Entries are spread over lock-striped shards, so logins and disconnects only
+    contend with others on the same shard. Iteration goes over per-shard
+    copy-on-write snapshots: a broadcast never sees the map change under it and
+    never holds a lock while sending, and a write only invalidates one shard.
+    """
+
+    def __init__(self, shards=16):
+        self.shards = [_Shard() for _ in range(shards)]
+
+    def shard(self, username):
+        return self.shards[hash(username) % len(self.shards)]
+
+    def __contains__(self, username):
+        return username in self.shard(username).sessions
+
+    def __getitem__(self, username):
+        return self.shard(username).sessions[username]
+
+    def __len__(self):
+        return sum(len(shard.sessions) for shard in self.shards)
+
+    def get(self, username, default=None):
+        return self.shard(username).sessions.get(username, default)
+
+    def __setitem__(self, username, client_socket):
+        shard = self.shard(username)
+        with shard.lock:
+            shard.sessions[username] = client_socket
+            shard.snapshot = None
+
+    def pop(self, username, default=None):
+        shard = self.shard(username)
+        with shard.lock:
+            if username not in shard.sessions:
+                return default
+            shard.snapshot = None
+            return shard.sessions.pop(username)
+
+    def __delitem__(self, username):
+        if self.pop(username) is None:
+            raise KeyError(username)
+
+    def items(self):
+        """Consistent per-shard snapshot of (username, connection) pairs."""
+        items = []
+        for shard in self.shards:
+            snapshot = shard.snapshot
+            if snapshot is None:
+                with shard.lock:
+                    if shard.snapshot is None:
+                        shard.snapshot = tuple(shard.sessions.items())
+                    snapshot = shard.snapshot
+            items.extend(snapshot)
+        return items
+
+    def keys(self):
+        return [username for username, _ in self.items()]
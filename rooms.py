@@ -0,0 +1,97 @@
+import threading
+
+
+class RoomIndex:
+    """Room membership kept as forward (room -> members) and reverse (user -> rooms) set indexes.
+
+    Joining, leaving and dropping a disconnected user touch only the sets
+    involved, and a room message only walks that room's members. Changes
+    hold the index lock, and readers get copies they can iterate while other
+    threads keep changing the index.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.members = {}      # room_name -> set of usernames
+        self.memberships = {}  # username -> set of room names
+        self.active = {}       # username -> room that plain chat lines go to
+
+    def __contains__(self, room_name):
+        return room_name in self.members
+
+    def keys(self):
+        with self.lock:
+            return list(self.members)
+
+    def create(self, room_name, owner):
+        with self.lock:
+            if room_name in self.members:
+                return False
+            self.members[room_name] = set()
+            if owner is not None:  # None when the room was created on another shard
+                self.join(owner, room_name)
+            return True
+
+    def delete(self, room_name):
+        """Remove a room and return the users that were in it."""
+        with self.lock:
+            members = self.members.pop(room_name, set())
+            for username in members:
+                self.memberships[username].discard(room_name)
+                self.set_fallback_active(username)
+            return members
+
+    def join(self, username, room_name):
+        with self.lock:
+            if room_name not in self.members:
+                return False
+            self.members[room_name].add(username)
+            self.memberships.setdefault(username, set()).add(room_name)
+            self.active[username] = room_name
+            return True
+
+    def leave(self, username, room_name):
+        with self.lock:
+            if username not in self.members.get(room_name, ()):
+                return False
+            self.members[room_name].discard(username)
+            self.memberships[username].discard(room_name)
+            self.set_fallback_active(username)
+            return True
+
+    def set_fallback_active(self, username):
+        if self.active.get(username) in self.memberships.get(username, ()):
+            return
+        remaining = self.memberships.get(username)
+        if remaining:
+            self.active[username] = next(iter(remaining))
+        else:
+            self.memberships.pop(username, None)
+            self.active.pop(username, None)
+
+    def restore(self, username, room_names, active):
+        """Put back the memberships of a user handed over by another server process."""
+        with self.lock:
+            for room_name in room_names:
+                self.members.setdefault(room_name, set())  # It may have been created there after we started
+                self.join(username, room_name)
+            if active in self.memberships.get(username, ()):
+                self.active[username] = active
+
+    def remove_user(self, username):
+        """Drop a disconnected user from every room they were in."""
+        with self.lock:
+            for room_name in self.memberships.pop(username, ()):
+                self.members[room_name].discard(username)
+            self.active.pop(username, None)
+
+    def room_members(self, room_name):
+        with self.lock:
+            return tuple(self.members.get(room_name, ()))
+
+    def rooms_of(self, username):
+        with self.lock:
+            return tuple(self.memberships.get(username, ()))
+
+    def active_room(self, username):
+        return self.active.get(username)
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+
+from db import DatabaseError
+
+BAN = 'ban'
+MUTE = 'mute'
+REMOVED = object()  # Pending-write marker for a lifted sanction
+
+
+class SanctionStore:
+    """Bans and mutes, enforced from memory and kept in the sanctions table.
+
+    `banned` and `muted` are frozensets that are replaced on every change, so
+    the login check and the per-message mute check are one lock-free set
+    lookup. Temporary sanctions are lifted by the shared Scheduler instead of
+    comparing clocks per message. Changes are coalesced per user and written
+    by a background thread in batches, and load() brings them back after a
+    restart.
+    """
+
+    def __init__(self, db, scheduler, on_expire=None, flush_interval=0.5):
+        self.db = db
+        self.scheduler = scheduler
+        self.on_expire = on_expire  # Called with (kind, username) after a temporary sanction runs out
+        self.flush_interval = flush_interval
+        self.banned = frozenset()
+        self.muted = frozenset()
+        self.expires = {}  # (kind, username) -> wall-clock expiry, or None for permanent
+        self.timers = {}   # (kind, username) -> scheduler Timer
+        self.lock = threading.Lock()
+        self.pending = {}  # (kind, username) -> expiry to store, or REMOVED; the latest change wins
+        self.dirty = threading.Event()
+        self.writer = threading.Thread(target=self.run_writer, name="sanction-writer", daemon=True)
+        self.writer.start()
+
+    def __len__(self):
+        return len(self.expires)
+
+    def load(self):
+        """Restore sanctions from the database, dropping the ones that ran out while we were down."""
+        rows = self.db.fetchall("SELECT username, kind, expires_at FROM sanctions")
+        now = time.time()
+        for username, kind, expires_at in rows:
+            if expires_at is not None and expires_at <= now:
+                self.remove(kind, username)
+            else:
+                self.add(kind, username, expires_at - now if expires_at else None, persist=False)
+        logging.info(f"Loaded {len(self.expires)} active bans and mutes")
+
+    def reload(self):
+        """Replace what is in memory with the stored sanctions, e.g. after another process changed them."""
+        with self.lock:
+            for kind, username in list(self.timers):
+                self.cancel_timer(kind, username)
+            self.expires.clear()
+            self.banned = frozenset()
+            self.muted = frozenset()
+        self.load()
+
+    def add(self, kind, username, seconds=None, persist=True):
+        expires_at = time.time() + seconds if seconds else None
+        with self.lock:
+            self.cancel_timer(kind, username)
+            self.expires[(kind, username)] = expires_at
+            self.update_index(kind, username, True)
+            if seconds:
+                self.timers[(kind, username)] = self.scheduler.schedule(
+                    seconds, self.expire, kind, username, expires_at)
+        if persist:
+            self.queue_write(kind, username, expires_at)
+
+    def remove(self, kind, username, persist=True):
+        with self.lock:
+            self.cancel_timer(kind, username)
+            self.expires.pop((kind, username), None)
+            self.update_index(kind, username, False)
+        if persist:
+            self.queue_write(kind, username, REMOVED)
+
+    def expire(self, kind, username, expires_at):
+        with self.lock:
+            if self.expires.get((kind, username), REMOVED) != expires_at:
+                return  # Replaced or lifted since this timer was set
+            self.timers.pop((kind, username), None)
+            self.expires.pop((kind, username))
+            self.update_index(kind, username, False)
+        self.queue_write(kind, username, REMOVED)
+        if self.on_expire:
+            self.on_expire(kind, username)
+
+    def cancel_timer(self, kind, username):
+        timer = self.timers.pop((kind, username), None)
+        if timer:
+            timer.cancel()
+
+    def update_index(self, kind, username, active):
+        if kind == BAN:
+            self.banned = self.banned | {username} if active else self.banned - {username}
+        else:
+            self.muted = self.muted | {username} if active else self.muted - {username}
+
+    def queue_write(self, kind, username, expires_at):
+        with self.lock:
+            self.pending[(kind, username)] = expires_at
+        self.dirty.set()
+
+    def run_writer(self):
+        while True:
+            self.dirty.wait()
+            time.sleep(self.flush_interval)  # Let a burst of changes coalesce into one batch
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.dirty.clear()
+        if not batch:
+            return
+        upserts = [(username, kind, expires_at) for (kind, username), expires_at in batch.items()
+                   if expires_at is not REMOVED]
+        deletes = [(username, kind) for (kind, username), expires_at in batch.items() if expires_at is REMOVED]
+        try:
+            if upserts:
+                self.db.executemany("REPLACE INTO sanctions (username, kind, expires_at) VALUES (%s, %s, %s)",
+                                    upserts)
+            if deletes:
+                self.db.executemany("DELETE FROM sanctions WHERE username=%s AND kind=%s", deletes)
+        except DatabaseError as err:
+            logging.error(f"Failed to store {len(batch)} sanction changes, will retry: {err}")
+            with self.lock:
+                for key, value in batch.items():
+                    self.pending.setdefault(key, value)
+            self.dirty.set()
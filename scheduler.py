@@ -0,0 +1,62 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ('deadline', 'func', 'args', 'cancelled')
+
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """One thread running deadline-ordered callbacks from a heap.
+
+    Scheduling and cancelling are O(log n) and O(1); cancelled timers stay in
+    the heap until their deadline comes up and are skipped then. Expiring
+    sanctions this way means no per-message clock checks anywhere.
+    """
+
+    def __init__(self, name="scheduler"):
+        self.heap = []  # (deadline, sequence, Timer)
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, delay, func, *args):
+        """Call func(*args) on the scheduler thread after `delay` seconds; returns a cancellable Timer."""
+        timer = Timer(time.monotonic() + delay, func, args)
+        with self.cond:
+            heapq.heappush(self.heap, (timer.deadline, next(self.sequence), timer))
+            if self.heap[0][2] is timer:
+                self.cond.notify()
+        return timer
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    # Capped: a far-off deadline would overflow the lock's timeout and end this thread
+                    timeout = min(self.heap[0][0] - time.monotonic(), threading.TIMEOUT_MAX) if self.heap else None
+                    self.cond.wait(timeout)
+                _, _, timer = heapq.heappop(self.heap)
+            if timer.cancelled:
+                continue
+            try:
+                timer.func(*timer.args)
+            except Exception as e:
+                logging.error(f"Scheduled task {getattr(timer.func, '__name__', timer.func)} failed: {e}",
+                              exc_info=True)
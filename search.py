@@ -0,0 +1,460 @@
+import array
+import bisect
+import heapq
+import json
+import logging
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from db import DatabaseError
+
+TOKEN = re.compile(r"\w+")
+MAX_TOKEN_LENGTH = 64
+MAX_PREFIX_TERMS = 1000  # Words a trailing * may expand to in one segment
+
+# Filter terms, indexed next to the words of each message. Names keep their case; \x01 sorts them before any word.
+SENDER = "\x01s:"
+ROOM = "\x01r:"
+RECIPIENT = "\x01t:"
+
+# Segment file: magic and header length, a JSON header, then the SECTIONS arrays, each 8-byte aligned
+MAGIC = b'CHATSEG1'
+PREAMBLE = struct.Struct('<8sI')
+SECTIONS = (('times', 'd'), ('senders', 'I'), ('rooms', 'I'), ('recipients', 'I'), ('text_offsets', 'Q'),
+            ('text', 'B'), ('term_offsets', 'Q'), ('terms', 'B'), ('posting_offsets', 'Q'), ('postings', 'I'))
+NO_NAME = 0xFFFFFFFF  # Name index for a missing room or recipient
+SEGMENT_PATTERN = re.compile(r"segment-(\d+)\.idx$")
+
+# Intersections binary-search the longer postings list when it is this many times longer, else scan it
+SPARSE_RATIO = 16
+
+INDEX_BATCH = 1000  # Queued messages indexed per pass of the indexer thread
+
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def tokenize(text):
+    """Distinct lowercase words of `text`, in order of first appearance."""
+    return list(dict.fromkeys(word for word in TOKEN.findall(text.lower()) if len(word) <= MAX_TOKEN_LENGTH))
+
+
+def index_terms(doc):
+    _, sender, room, recipient, body = doc
+    terms = tokenize(body)
+    terms.append(SENDER + sender)
+    if room is not None:
+        terms.append(ROOM + room)
+    if recipient is not None:
+        terms.append(RECIPIENT + recipient)
+    return terms
+
+
+def parse_time(value, now=None):
+    """Epoch seconds for "30m"/"2h"/"7d" (that long ago) or a local "2024-05-01" / "2024-05-01T12:30"."""
+    unit = TIME_UNITS.get(value[-1:])
+    if unit and value[:-1].isdigit():
+        return (now or time.time()) - int(value[:-1]) * unit
+    for pattern in ("%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, pattern))
+        except ValueError:
+            pass
+    raise ValueError(f"Not a time: {value}")
+
+
+def contains(postings, number, lo=0):
+    """Position of `number` in sorted `postings` from `lo` on, or -1."""
+    i = bisect.bisect_left(postings, number, lo)
+    return i if i < len(postings) and postings[i] == number else -1
+
+
+class MemorySegment:
+    """Messages indexed since the last flush, searchable straight away.
+
+    Postings are arrays of local document numbers, appended in order, so
+    they are sorted like the ones in segment files.
+    """
+
+    def __init__(self):
+        self.docs = []      # (created_at, sender, room, recipient, body)
+        self.times = array.array('d')
+        self.postings = {}  # term -> array('I') of document numbers
+        self.min_time = float('inf')
+        self.max_time = float('-inf')
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc, terms):
+        number = len(self.docs)
+        self.docs.append(doc)
+        self.times.append(doc[0])
+        self.min_time = min(self.min_time, doc[0])
+        self.max_time = max(self.max_time, doc[0])
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array.array('I')
+            postings.append(number)
+
+    def lookup(self, term):
+        return self.postings.get(term, ())
+
+    def prefix_lookup(self, prefix):
+        lists = [postings for term, postings in self.postings.items() if term.startswith(prefix)]
+        return sorted(set().union(*lists[:MAX_PREFIX_TERMS]))
+
+    def doc(self, number):
+        return self.docs[number]
+
+
+def write_segment(path, docs, postings, replaces=()):
+    """Write documents and their postings as a segment file, atomically."""
+    names = {}
+
+    def name_id(name):
+        return NO_NAME if name is None else names.setdefault(name, len(names))
+
+    arrays = {'times': array.array('d', (doc[0] for doc in docs)),
+              'senders': array.array('I', (name_id(doc[1]) for doc in docs)),
+              'rooms': array.array('I', (name_id(doc[2]) for doc in docs)),
+              'recipients': array.array('I', (name_id(doc[3]) for doc in docs)),
+              'text_offsets': array.array('Q', [0]), 'text': bytearray(),
+              'term_offsets': array.array('Q', [0]), 'terms': bytearray(),
+              'posting_offsets': array.array('Q', [0]), 'postings': array.array('I')}
+    for doc in docs:
+        arrays['text'] += doc[4].encode('utf-8')
+        arrays['text_offsets'].append(len(arrays['text']))
+    for term in sorted(postings):  # Code point order, which is also the byte order of the UTF-8
+        arrays['terms'] += term.encode('utf-8')
+        arrays['term_offsets'].append(len(arrays['terms']))
+        arrays['postings'].extend(postings[term])
+        arrays['posting_offsets'].append(len(arrays['postings']))
+
+    sections = {}
+    offset = 0
+    for name, _ in SECTIONS:
+        size = len(arrays[name]) * getattr(arrays[name], 'itemsize', 1)
+        sections[name] = (offset, size)
+        offset = align(offset + size)
+    header = json.dumps({'count': len(docs), 'min_time': min((doc[0] for doc in docs), default=0),
+                         'max_time': max((doc[0] for doc in docs), default=0), 'names': list(names),
+                         'replaces': list(replaces), 'sections': sections}).encode('utf-8')
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, len(header)) + header)
+        f.write(bytes(align(f.tell()) - f.tell()))
+        for name, _ in SECTIONS:
+            f.write(arrays[name])
+            f.write(bytes(align(f.tell()) - f.tell()))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # Already cleaned up by a newer server process sharing the directory
+
+
+class Segment:
+    """A memory-mapped segment file; its arrays are read in place, never loaded."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sequence = int(SEGMENT_PATTERN.search(path).group(1))
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = PREAMBLE.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a search index segment")
+        header = json.loads(self.map[PREAMBLE.size:PREAMBLE.size + length])
+        self.count = header['count']
+        self.min_time = header['min_time']
+        self.max_time = header['max_time']
+        self.names = header['names']
+        self.replaces = header['replaces']
+        self.size = len(self.map)
+        view = memoryview(self.map)
+        start = align(PREAMBLE.size + length)
+        for name, code in SECTIONS:  # self.times, self.senders, ... as typed views of the file
+            offset, size = header['sections'][name]
+            setattr(self, name, view[start + offset:start + offset + size].cast(code))
+        self.term_count = len(self.term_offsets) - 1
+
+    def __len__(self):
+        return self.count
+
+    def term(self, i):
+        return bytes(self.terms[self.term_offsets[i]:self.term_offsets[i + 1]])
+
+    def find(self, key):
+        """Index of the first term not less than `key` (UTF-8 bytes)."""
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def term_postings(self, i):
+        return self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]]
+
+    def lookup(self, term):
+        key = term.encode('utf-8')
+        i = self.find(key)
+        return self.term_postings(i) if i < self.term_count and self.term(i) == key else ()
+
+    def prefix_lookup(self, prefix):
+        key = prefix.encode('utf-8')
+        i = self.find(key)
+        lists = []
+        while i < self.term_count and len(lists) < MAX_PREFIX_TERMS and self.term(i).startswith(key):
+            lists.append(self.term_postings(i))
+            i += 1
+        return sorted(set().union(*lists))
+
+    def name(self, i):
+        return None if i == NO_NAME else self.names[i]
+
+    def doc(self, number):
+        text = bytes(self.text[self.text_offsets[number]:self.text_offsets[number + 1]]).decode('utf-8')
+        return (self.times[number], self.name(self.senders[number]), self.name(self.rooms[number]),
+                self.name(self.recipients[number]), text)
+
+
+def match(segment, terms, prefixes, since=None, until=None):
+    """Ascending numbers of the segment's documents with every term and prefix, within [since, until)."""
+    if since is not None and segment.max_time < since or until is not None and segment.min_time >= until:
+        return []
+    lists = [segment.lookup(term) for term in terms] + [segment.prefix_lookup(prefix) for prefix in prefixes]
+    lists.sort(key=len)
+    matches = list(lists[0])
+    for postings in lists[1:]:
+        if len(matches) * SPARSE_RATIO >= len(postings):
+            matches = sorted(set(matches).intersection(postings))  # One pass over the postings, in C
+        else:
+            kept = []
+            lo = 0
+            for number in matches:  # Ascending, so each search starts where the last one ended
+                i = contains(postings, number, lo)
+                if i >= 0:
+                    kept.append(number)
+                    lo = i
+            matches = kept
+        if not matches:
+            break
+    if since is not None or until is not None:
+        times = segment.times
+        matches = [number for number in matches if (since is None or times[number] >= since)
+                   and (until is None or times[number] < until)]
+    return matches
+
+
+class SearchIndex:
+    """Inverted index of chat messages for admin searches, kept on local disk instead of in the database.
+
+    add() only queues a message; an indexer thread tokenizes queued messages
+    in batches into an in-memory segment, which is searchable at once and
+    is written out as an immutable segment file once it holds
+    `segment_size` messages or `flush_interval` seconds have passed. Segment
+    files hold the messages themselves, the sorted term dictionary and the
+    postings as flat arrays, and are memory-mapped: a query is a binary
+    search per term per segment plus an intersection of postings, and only
+    the pages it touches are read. Whenever `merge_factor` small segments
+    have built up they are merged into one, so their number stays bounded.
+    """
+
+    def __init__(self, directory, segment_size=100000, flush_interval=60.0, merge_factor=10):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.merge_factor = merge_factor
+        os.makedirs(directory, exist_ok=True)
+        self.pending = queue.SimpleQueue()
+        self.lock = threading.Lock()        # Guards `segments` and `live` for searches
+        self.write_lock = threading.Lock()  # Held while adding, flushing or merging; taken before `lock`
+        self.live = MemorySegment()
+        self.segments = []
+        self.sequence = 0
+        self.held = False  # Keep new messages in memory only, see hold()
+        self.searches = 0
+        self.reload()
+        self.indexer = threading.Thread(target=self.run_indexer, name="search-indexer", daemon=True)
+        self.indexer.start()
+
+    def stats(self):
+        segments = self.segments
+        return {'segments': len(segments), 'messages': sum(len(segment) for segment in segments) + len(self.live),
+                'unflushed': len(self.live), 'bytes': sum(segment.size for segment in segments),
+                'searches': self.searches}
+
+    def add(self, room, sender, body, recipient=None, created_at=None):
+        self.pending.put((created_at or time.time(), sender, room, recipient, body))
+
+    def hold(self):
+        """Write no segment files until the next reload(), while another process may still write to the directory."""
+        with self.write_lock:
+            self.held = True
+
+    def reload(self):
+        """Open the segment files in the directory, e.g. after another process wrote to it."""
+        with self.write_lock:
+            self.held = False
+            segments = []
+            for file_name in os.listdir(self.directory):
+                path = os.path.join(self.directory, file_name)
+                if SEGMENT_PATTERN.search(file_name):  # Not *.tmp, which may still be being written
+                    try:
+                        segments.append(Segment(path))
+                    except (OSError, ValueError) as e:
+                        logging.error(f"Skipping search index segment {path}: {e}")
+            # Inputs of a merge that is unfinished, or was interrupted before they were deleted
+            replaced = {sequence for segment in segments for sequence in segment.replaces}
+            for segment in [segment for segment in segments if segment.sequence in replaced]:
+                segments.remove(segment)
+                remove(segment.path)
+            segments.sort(key=lambda segment: segment.sequence)
+            with self.lock:
+                self.segments = segments
+            self.sequence = max((segment.sequence for segment in segments), default=0)
+        if segments:
+            logging.info(f"Search index: {sum(len(segment) for segment in segments)} messages "
+                         f"in {len(segments)} segments")
+
+    def run_indexer(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                batch = [self.pending.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < INDEX_BATCH and not isinstance(batch[-1], threading.Event):
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            flushed = batch.pop() if batch and isinstance(batch[-1], threading.Event) else None
+            try:
+                with self.write_lock:
+                    self.index(batch)
+                    if self.live and not self.held and (flushed or len(self.live) >= self.segment_size
+                                      or time.monotonic() - last_flush >= self.flush_interval):
+                        self.write_live()
+                        last_flush = time.monotonic()
+            except OSError as e:
+                logging.error(f"Search index write failed, keeping {len(self.live)} messages in memory: {e}")
+            if flushed:
+                flushed.set()
+
+    def index(self, docs):
+        terms = [index_terms(doc) for doc in docs]  # Tokenized before taking the lock searches wait on
+        with self.lock:
+            for doc, doc_terms in zip(docs, terms):
+                self.live.add(doc, doc_terms)
+
+    def flush(self, timeout=30.0):
+        """Write everything added so far to disk (used on shutdown); the indexer thread does the work."""
+        done = threading.Event()
+        self.pending.put(done)  # Behind every message queued before it
+        if not done.wait(timeout):
+            logging.error(f"Search index not written out after {timeout}s")
+
+    def write_live(self):
+        self.sequence += 1
+        path = os.path.join(self.directory, f"segment-{self.sequence:08d}.idx")
+        write_segment(path, self.live.docs, self.live.postings)
+        segment = Segment(path)
+        with self.lock:
+            self.segments = self.segments + [segment]
+            self.live = MemorySegment()
+        self.merge_small()
+
+    def merge_small(self):
+        small = [segment for segment in self.segments if len(segment) < self.segment_size]
+        if len(small) < self.merge_factor:
+            return
+        merged = MemorySegment()
+        for segment in small:
+            for number in range(len(segment)):
+                doc = segment.doc(number)
+                merged.add(doc, index_terms(doc))
+        self.sequence += 1
+        path = os.path.join(self.directory, f"segment-{self.sequence:08d}.idx")
+        write_segment(path, merged.docs, merged.postings, replaces=[segment.sequence for segment in small])
+        segment = Segment(path)
+        with self.lock:
+            self.segments = [kept for kept in self.segments if kept not in small] + [segment]
+        for old in small:
+            remove(old.path)  # Open maps stay valid until the searches using them finish
+        logging.debug(f"Merged {len(small)} search index segments into {path}")
+
+    def rebuild(self, db, page_size=10000):
+        """Index the messages table from scratch (blocking): for an index that was lost or added later."""
+        with self.write_lock:
+            with self.lock:
+                old, self.segments, self.live = self.segments, [], MemorySegment()
+            for segment in old:
+                remove(segment.path)
+            last_id = 0
+            try:
+                while True:
+                    rows = db.fetchall("SELECT id, room, sender, recipient, body, created_at FROM messages "
+                                       "WHERE id > %s ORDER BY id LIMIT %s", (last_id, page_size))
+                    if not rows:
+                        break
+                    self.index([(created_at, sender, room, recipient, body)
+                                for _, room, sender, recipient, body, created_at in rows])
+                    if len(self.live) >= self.segment_size:
+                        self.write_live()
+                    last_id = rows[-1][0]
+            except DatabaseError as err:
+                logging.error(f"Search index rebuild stopped after message {last_id}: {err}")
+            if self.live:
+                self.write_live()
+        logging.info(f"Search index rebuilt: {self.stats()['messages']} messages")
+
+    def search(self, words, sender=None, room=None, recipient=None, since=None, until=None, limit=20):
+        """Return (total matches, the newest `limit` as (created_at, sender, room, recipient, body), newest first).
+
+        Every word must match; a trailing * matches words starting with the
+        rest. Filters restrict the sender, the room ('lobby' for chat outside
+        rooms) or the recipient of a private message.
+        """
+        terms, prefixes = [], []
+        for word in words:
+            tokens = tokenize(word)
+            if word.endswith('*') and tokens:
+                prefixes.append(tokens.pop())
+            terms.extend(tokens)
+        for prefix, name in ((SENDER, sender), (ROOM, room), (RECIPIENT, recipient)):
+            if name is not None:
+                terms.append(prefix + name)
+        if not terms and not prefixes:
+            return 0, []
+        self.searches += 1
+        total = 0
+        newest = []
+        with self.lock:
+            segments = self.segments
+            matches = match(self.live, terms, prefixes, since, until)
+            total += len(matches)
+            newest.extend(self.live.doc(number) for number in matches[-limit:])
+        for segment in segments:
+            matches = match(segment, terms, prefixes, since, until)
+            total += len(matches)
+            newest.extend(segment.doc(number) for number in matches[-limit:])
+        return total, heapq.nlargest(limit, newest, key=lambda doc: doc[0])
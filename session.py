@@ -0,0 +1,44 @@
+import time
+
+
+class Session:
+    """Per-connection state that isn't the socket itself, kept compact for servers with many idle clients.
+
+    One of these is created per accepted connection and reached from it as
+    `conn.session`. It replaces the locals handle_client used to carry and the
+    per-user entries in the rate limiter dictionaries, so a connection costs
+    one slotted object plus its socket wrapper. Room memberships stay in the
+    RoomIndex, which already keeps them per user.
+    """
+    __slots__ = ('conn', 'address', 'username', 'role', 'started', 'last_seen', 'pinged', 'authenticated', 'closed',
+                 'timer', 'message_bucket', 'command_bucket', 'messages_in', 'bytes_in')
+
+    def __init__(self, conn, address, message_bucket=None, command_bucket=None):
+        now = time.monotonic()
+        self.conn = conn
+        self.address = address
+        self.username = None
+        self.role = None       # 'user' or 'admin', set by the login path that authenticated this connection
+        self.started = now
+        self.last_seen = now   # Updated on every message received
+        self.pinged = None     # last_seen value when the last PING went out
+        self.authenticated = False
+        self.closed = False
+        self.timer = None      # Pending lifecycle check, see lifecycle.py
+        self.message_bucket = message_bucket  # Token buckets for this user's chat lines and commands
+        self.command_bucket = command_bucket
+        self.messages_in = 0
+        self.bytes_in = 0
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def received(self, nbytes):
+        self.last_seen = time.monotonic()
+        if nbytes:
+            self.messages_in += 1
+            self.bytes_in += nbytes
+
+    def summary(self):
+        return (f"{self.messages_in} messages, {self.bytes_in} bytes in over "
+                f"{int(time.monotonic() - self.started)}s")
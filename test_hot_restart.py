@@ -0,0 +1,85 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from chat_server import SHUTDOWN_NOTICE, ChatServer
+from db import SQLiteBackend
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class HotRestartTest(unittest.TestCase):
+    """A threaded server handing over to a successor still tells its logged-in clients to reconnect."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)  # The server keeps shared files under its working directory
+        self.addCleanup(os.chdir, cwd)
+        self.port = free_port()
+        self.handoff_path = os.path.join(self.workdir.name, "handoff.sock")
+
+    def make_server(self):
+        return ChatServer('127.0.0.1', self.port, db_backend=SQLiteBackend("chat_app.db"), scrypt_n=2 ** 10,
+                          search_dir="search_index", drain_timeout=5.0)
+
+    def log_in(self, username):
+        client = socket.create_connection(('127.0.0.1', self.port), timeout=5.0)
+        self.addCleanup(client.close)
+        for line in ("register", username, "secret"):
+            client.recv(1024)
+            client.send(line.encode('utf-8'))
+        return client
+
+    def read_until_closed(self, client):
+        received = b""
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return received.decode('utf-8')
+            received += data
+
+    def test_clients_get_the_shutdown_notice(self):
+        old = self.make_server()
+        old.listen_for_successor(self.handoff_path)
+        old_thread = threading.Thread(target=old.start, daemon=True)
+        old_thread.start()
+        time.sleep(0.2)
+        clients = [self.log_in(f"user{i}") for i in range(5)]
+        time.sleep(0.5)
+        # Let every writer thread exit, as on an idle server: the notice then has to start a new one
+        for session in old.sessions:
+            session.conn.writer_idle = 0.05
+        for client in clients:
+            client.send(b"/list_users")  # The writer picks up the shorter timeout once it has sent the reply
+            client.recv(65536)
+        time.sleep(0.3)
+        self.assertTrue(all(session.conn.writer is None for session in old.sessions))
+
+        new = self.make_server()
+        new.take_over(self.handoff_path)
+        new_thread = threading.Thread(target=new.start, daemon=True)
+        new_thread.start()
+        self.addCleanup(new_thread.join, 10.0)
+        self.addCleanup(new.stop)
+
+        for client in clients:
+            self.assertIn(SHUTDOWN_NOTICE, self.read_until_closed(client))
+        old_thread.join(10.0)
+        self.assertFalse(old_thread.is_alive())
+        deadline = time.monotonic() + 5.0
+        while new.search.held and time.monotonic() < deadline:
+            time.sleep(0.05)  # The successor re-reads what the old process stored
+        self.assertFalse(new.search.held)
+
+
+if __name__ == "__main__":
+    unittest.main()
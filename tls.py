@@ -0,0 +1,180 @@
+import collections
+import socket
+import ssl
+import threading
+
+TLS_READ_SIZE = 16384  # One full TLS record
+
+
+def server_context(certfile, keyfile=None, tickets=2):
+    """Server SSLContext that hands out session tickets, so a reconnecting client can skip the full handshake.
+
+    Ticket keys belong to the context. Create it once, before cluster workers
+    are forked, and every shard accepts tickets issued by the others.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = tickets  # TLS 1.3 tickets sent after each handshake; TLS 1.2 uses the session cache
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class TLSSocket:
+    """Blocking TLS connection that one thread may read while another writes.
+
+    An SSLSocket must not be used by two threads at once, but threaded
+    clients have a reader and a writer thread. Here the TLS state is an
+    SSLObject over memory buffers: socket reads and writes happen outside its
+    lock, which is held only to encrypt or decrypt. sendmsg(), recv_into()
+    and sendfile() are provided for FramedSocket and file transfers; anything
+    else (shutdown, setsockopt, ...) goes to the plain socket.
+    """
+
+    __slots__ = ('sock', 'tls', 'incoming', 'outgoing', 'lock', 'send_lock')
+
+    def __init__(self, sock, context, server_side=True, server_hostname=None, session=None):
+        self.sock = sock
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = context.wrap_bio(self.incoming, self.outgoing, server_side=server_side,
+                                    server_hostname=server_hostname, session=session)
+        self.lock = threading.Lock()       # Guards the SSLObject and its buffers
+        self.send_lock = threading.Lock()  # Keeps records in order on the wire; taken before `lock`
+
+    @property
+    def session(self):
+        return self.tls.session
+
+    @property
+    def session_reused(self):
+        return self.tls.session_reused
+
+    def handshake(self):
+        while True:
+            try:
+                with self.lock:
+                    self.tls.do_handshake()
+                self.send_pending()
+                return
+            except ssl.SSLWantReadError:
+                self.send_pending()
+                if not self.feed():
+                    raise ConnectionError("Connection closed during the TLS handshake")
+
+    def feed(self):
+        data = self.sock.recv(TLS_READ_SIZE)
+        if not data:
+            return False
+        with self.lock:
+            self.incoming.write(data)
+        return True
+
+    def send_pending(self):
+        """Send records produced by reading, e.g. TLS 1.3 key updates or alerts."""
+        with self.send_lock:
+            with self.lock:
+                data = self.outgoing.read()
+            if data:
+                self.sock.sendall(data)
+
+    def recv(self, bufsize=1024):
+        while True:
+            try:
+                with self.lock:
+                    data = self.tls.read(bufsize)
+            except ssl.SSLWantReadError:
+                data = None
+            except ssl.SSLZeroReturnError:
+                return b''  # close_notify from the peer
+            if self.outgoing.pending:
+                self.send_pending()
+            if data is not None:
+                return data
+            if not self.feed():
+                return b''
+
+    def recv_into(self, buffer, nbytes=0):
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self.sendmsg([data])
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendmsg(self, buffers):
+        """Encrypt every buffer and send the records in one write; returns the plaintext bytes sent."""
+        with self.send_lock:
+            with self.lock:
+                total = sum(self.tls.write(data) for data in buffers if len(data))
+                records = self.outgoing.read()
+            self.sock.sendall(records)
+        return total
+
+    def sendfile(self, file, offset=0, count=None):
+        """Copy a file through TLS; there is no kernel shortcut for encrypted data."""
+        file.seek(offset)
+        total = 0
+        while count is None or total < count:
+            chunk = file.read(TLS_READ_SIZE if count is None else min(TLS_READ_SIZE, count - total))
+            if not chunk:
+                break
+            self.sendall(chunk)
+            total += len(chunk)
+        return total
+
+    def close(self):
+        self.sock.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class SessionCache:
+    """TLS sessions from earlier connections, by server address, for clients that reconnect.
+
+    Offering the saved session lets the server resume it with an abbreviated
+    handshake, skipping the certificate exchange and key agreement. TLS 1.3
+    tickets arrive after the handshake, so call save() once the first reply
+    from the server has been read.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.sessions = collections.OrderedDict()  # (host, port) -> ssl.SSLSession
+        self.lock = threading.Lock()
+
+    def connect(self, context, address, timeout=None):
+        """Open a TLS connection to `address`, resuming a saved session when there is one."""
+        with self.lock:
+            session = self.sessions.get(address)
+        sock = socket.create_connection(address, timeout)
+        try:
+            tls_socket = TLSSocket(sock, context, server_side=False, server_hostname=address[0], session=session)
+            tls_socket.handshake()
+        except (ssl.SSLError, OSError):
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return tls_socket
+
+    def save(self, address, tls_socket):
+        session = tls_socket.session
+        if session is None or not session.has_ticket and not session.id:
+            return
+        with self.lock:
+            self.sessions[address] = session
+            self.sessions.move_to_end(address)
+            if len(self.sessions) > self.size:
+                self.sessions.popitem(last=False)